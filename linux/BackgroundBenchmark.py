@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+from sketchvision import ImageStrokeConverter as ISC
+import cv
+import numpy
+import os
+import sys
+import time
+
+def main(args):
+    """Time removeBackground at full resolution and with the pyramid search,
+    and report how closely the resulting ink masks agree"""
+    if len(args) < 2:
+        print "Usage: %s <pyramidLevels> [image1.jpg image2.jpg ...]" % (args[0])
+        exit(1)
+    levels = int(args[1])
+    fnames = args[2:]
+    if len(fnames) == 0:
+        imgDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sketchvision", "images")
+        fnames = [os.path.join(imgDir, f) for f in sorted(os.listdir(imgDir))
+                    if f.lower().endswith(".jpg")]
+
+    ISC.DEBUG = False
+    methods = (("full", 0), ("pyramid", levels))
+    totals = {"full" : 0.0, "pyramid" : 0.0}
+    for fname in fnames:
+        in_img = cv.LoadImageM(fname)
+        small_img = ISC.resizeImage(in_img, targetWidth=ISC.GETNORMWIDTH())
+        masks = {}
+        times = {}
+        for method, lvl in methods:
+            t1 = time.time()
+            ink_mask, _ = ISC.removeBackground(small_img, pyramidLevels = lvl)
+            times[method] = time.time() - t1
+            totals[method] += times[method]
+            masks[method] = numpy.asarray(ink_mask) == 0
+        score = maskAgreement(masks["full"], masks["pyramid"])
+        print "%s: full %.1f ms, pyramid(%s) %.1f ms, ink IoU %.3f" % \
+            (os.path.basename(fname), 1000 * times["full"], levels, 1000 * times["pyramid"], score)
+    if totals["pyramid"] > 0:
+        print "Total: full %.1f ms, pyramid(%s) %.1f ms, speedup %.2fx" % \
+            (1000 * totals["full"], levels, 1000 * totals["pyramid"], totals["full"] / totals["pyramid"])
+
+def maskAgreement(inkMask1, inkMask2):
+    """Return the intersection over union (0-1) of two boolean ink masks"""
+    union = numpy.logical_or(inkMask1, inkMask2).sum()
+    if union == 0:
+        return 1.0
+    return numpy.logical_and(inkMask1, inkMask2).sum() / float(union)
+
+if __name__ == "__main__":
+    main(sys.argv)
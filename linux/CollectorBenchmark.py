@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+from SketchFramework.Board import Board
+from SketchFramework.Point import Point
+from SketchFramework.Stroke import Stroke
+from Observers import ArrowObserver
+from Observers import DiGraphObserver
+from Observers import TextObserver
+import math
+import random
+import sys
+import time
+
+def main(args):
+    """Feed N synthetic letter or graph node annotations to a collector, and
+    report how long merging them into collections takes as N grows"""
+    if len(args) < 3 or args[1] not in ("text", "digraph"):
+        print "Usage: %s <text|digraph> N1 [N2 ...]" % (args[0])
+        exit(1)
+    kind = args[1]
+    for num in [int(n) for n in args[2:]]:
+        times = {}
+        results = {}
+        for full in (False, True):
+            board = Board()
+            if kind == "text":
+                collector = _fullMerge(TextObserver.TextCollector, full)(board)
+                items = letterItems(num)
+            else:
+                collector = _fullMerge(DiGraphObserver.DiGraphMarker, full)(board)
+                items = nodeItems(num)
+            t1 = time.time()
+            for strokes, anno in items:
+                board.AnnotateStrokes(strokes, anno)
+            times[full] = time.time() - t1
+            results[full] = len(collector.all_collections)
+        print "N = %s: incremental %.1f ms, full %.1f ms, speedup %.2fx (%s collections%s)" % \
+            (num, 1000 * times[False], 1000 * times[True], times[True] / max(times[False], 1e-6),
+             results[False], "" if results[False] == results[True] else ", full merge found %s" % (results[True]))
+
+def _fullMerge(collectorClass, full):
+    """collectorClass, or with full, a subclass of it that tries every pair of
+    collections on every merge (as the collectors did before merging was incremental)"""
+    if not full:
+        return collectorClass
+    class FullMergeCollector(collectorClass):
+        def mergeCandidateBox(self, collection):
+            return None
+        def _merge_new_collections(self):
+            self._dirty_collections.update(self.all_collections)
+            collectorClass._merge_new_collections(self)
+    return FullMergeCollector
+
+def letterItems(num, seed = 0):
+    """(strokes, TextAnnotation) for num letters, written as lines of four letter
+    words, in random order"""
+    items = []
+    scale = 20.0
+    for i in range(num):
+        word, letter = i / 4, i % 4
+        x = (word % 8) * 150 + letter * 15
+        y = -(word / 8) * 60
+        stroke = Stroke([Point(x, y + t) for t in range(0, int(scale), 2)])
+        anno = TextObserver.TextAnnotation("1", (["1"],), [[stroke]], scale)
+        items.append( ([stroke], anno) )
+    random.Random(seed).shuffle(items)
+    return items
+
+def nodeItems(num, seed = 0):
+    """(strokes, annotation) for num graph nodes in a grid, with an arrow from each
+    even numbered node to the one to its right, in random order"""
+    items = []
+    radius = 20
+    for i in range(num):
+        center = Point( (i % 20) * 150, -(i / 20) * 150 )
+        circle = Stroke([Point(center.X + radius * math.cos(a / 10.0), center.Y + radius * math.sin(a / 10.0))
+                            for a in range(63)])
+        items.append( ([circle], DiGraphObserver.DiGraphNodeAnnotation(0, center, radius)) )
+        if i % 2 == 0:
+            tail = Point(center.X + radius + 5, center.Y)
+            tip = Point(center.X + 150 - radius - 5, center.Y)
+            tailstroke = Stroke([Point(x, tail.Y) for x in range(int(tail.X), int(tip.X), 5)])
+            headstroke = Stroke([Point(tip.X - 10, tip.Y + 10), tip, Point(tip.X - 10, tip.Y - 10)])
+            arrow = ArrowObserver.ArrowAnnotation(tip, tail, headstroke, tailstroke)
+            items.append( ([tailstroke, headstroke], arrow) )
+    random.Random(seed).shuffle(items)
+    return items
+
+if __name__ == "__main__":
+    main(sys.argv)
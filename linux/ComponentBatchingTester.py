@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+from sketchvision import ImageStrokeConverter
+from SkeletonGraphTester import barsImage
+import cv
+import random
+import sys
+
+def main(args):
+    """Check blobsToStrokes with component batching against the whole image path, on
+    fixed images of random crossing bars. The thinned points and their thickness have
+    to match. Strokes can still differ, since tracing depends on the order the points
+    are visited in, so those differences are only counted."""
+    if len(args) > 1 and args[1] in ("-h", "--help"):
+        print "Usage: %s [numImages]" % (args[0])
+        exit(1)
+    numImages = 50
+    if len(args) > 1:
+        numImages = int(args[1])
+
+    failures = 0
+    strokeDiffs = 0
+    for seed in range(numImages):
+        img = barsImage(seed)
+        wholePoints, wholeStrokes = tracedPoints(img, False, seed)
+        compPoints, compStrokes = tracedPoints(img, True, seed)
+
+        if set(wholePoints) != set(compPoints):
+            failures += 1
+            print "Image %s: thinned points differ (%s whole, %s by component)" % (seed, len(wholePoints), len(compPoints))
+            continue
+        thickDiffs = [pt for pt in wholePoints
+                      if ImageStrokeConverter.thicknessAtPoint(pt, wholePoints[pt], cache = {}) !=
+                         ImageStrokeConverter.thicknessAtPoint(pt, compPoints[pt], cache = {})]
+        if len(thickDiffs) > 0:
+            failures += 1
+            print "Image %s: %s of %s points have a different thickness" % (seed, len(thickDiffs), len(wholePoints))
+        if normalizeStrokes(wholeStrokes) != normalizeStrokes(compStrokes):
+            strokeDiffs += 1
+    print "%s of %s images differ in thinned points or thickness" % (failures, numImages)
+    print "%s of %s images traced different strokes" % (strokeDiffs, numImages)
+    if failures > 0:
+        exit(1)
+
+def tracedPoints(img, byComponent, seed):
+    """Run blobsToStrokes on img. Returns {point : raw image it was traced with}
+    for every thinned point that was traced, and the strokes"""
+    traced = {}
+    pointsToStrokes = ImageStrokeConverter.pointsToStrokes
+    def recordPoints(pointSet, rawImg, *args, **kwargs):
+        for pt in pointSet:
+            traced[pt] = rawImg
+        return pointsToStrokes(pointSet, rawImg, *args, **kwargs)
+
+    ImageStrokeConverter.pointsToStrokes = recordPoints
+    try:
+        ImageStrokeConverter.CACHE = {}
+        random.seed(seed)
+        strokes = ImageStrokeConverter.blobsToStrokes(cv.CloneMat(img), byComponent = byComponent)
+    finally:
+        ImageStrokeConverter.pointsToStrokes = pointsToStrokes
+    return traced, strokes
+
+def normalizeStrokes(strokes):
+    """The strokes as a sorted list of point tuples, each in its smaller direction"""
+    retList = []
+    for stroke in strokes:
+        points = tuple( (int(p.X), int(p.Y)) for p in stroke.Points )
+        retList.append(min(points, points[::-1]))
+    return sorted(retList)
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+from SketchFramework.Point import Point
+from SketchFramework.PointArray import toPointArray
+from SketchFramework.Stroke import Stroke
+from Utils import GeomUtils
+import random
+import sys
+import time
+
+BENCHMARKS = [
+    ("length", lambda pts, stk: GeomUtils.pointlistLength(pts)),
+    ("angles", lambda pts, stk: GeomUtils.pointlistAnglesVector(pts)),
+    ("curvature", lambda pts, stk: GeomUtils.strokeGetPointsCurvature(stk)),
+    ("resample64", lambda pts, stk: GeomUtils.pointlistNormalizeSpacing(pts, 64)),
+    ("resample", lambda pts, stk: GeomUtils.pointlistNormalizeSpacing(pts, max(stk.length() / 5, 2))),
+    ("smooth", lambda pts, stk: GeomUtils._smooth(pts)),
+    ]
+
+def main(args):
+    """Time the GeomUtils point list primitives on random strokes of each size,
+    with the points as a list of Points and as a PointArray"""
+    if len(args) > 1 and args[1] in ("-h", "--help"):
+        print "Usage: %s [numPoints1 numPoints2 ...]" % (args[0])
+        exit(1)
+    sizes = [int(n) for n in args[1:]]
+    if len(sizes) == 0:
+        sizes = [10, 100, 1000, 10000]
+
+    print "%-12s %8s %12s %12s" % ("function", "points", "list (ms)", "array (ms)")
+    for numPoints in sizes:
+        pointList = randomStroke(numPoints)
+        strokes = {"list" : Stroke(pointList), "array" : Stroke(toPointArray(pointList))}
+        for name, func in BENCHMARKS:
+            times = {}
+            for kind, stk in strokes.items():
+                times[kind] = timeCall(func, stk.Points, stk)
+            print "%-12s %8s %12.3f %12.3f" % (name, numPoints, 1000 * times["list"], 1000 * times["array"])
+
+def timeCall(func, points, stroke, minTime = 0.2):
+    """The average time of func(points, stroke), over as many calls as fit in minTime seconds"""
+    calls = 0
+    t1 = time.time()
+    while True:
+        func(points, stroke)
+        calls += 1
+        elapsed = time.time() - t1
+        if elapsed >= minTime:
+            return elapsed / calls
+
+def randomStroke(numPoints, seed = 0):
+    """A random walk of numPoints points, with the occasional repeated point"""
+    rand = random.Random(seed)
+    x = y = 0.0
+    points = []
+    for t in range(numPoints):
+        if len(points) > 0 and rand.random() < 0.05:
+            points.append(Point(x, y, t))
+            continue
+        x += rand.uniform(-5, 5)
+        y += rand.uniform(-5, 5)
+        points.append(Point(x, y, t))
+    return points
+
+if __name__ == "__main__":
+    main(sys.argv)
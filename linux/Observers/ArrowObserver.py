@@ -33,7 +33,7 @@ from Observers.Semantics_Class1 import Class1Annotation
 
 logger = Logger.getLogger('ArrowObserver', Logger.WARN)
 
-arrowHeadMatcher = Template.TemplateDict(filename = "Utils/arrowheads.templ")
+arrowHeadMatcher = Template.getSharedTemplateDict("Utils/arrowheads.templ")
 
 class ArrowHeadAnnotation( Class1Annotation ):
     def __init__(self, end1, cusp, end2):
@@ -105,7 +105,7 @@ class ArrowMarker( BoardObserver ):
         self._arrowHeads = [] #tuples of (arrowhead_tip, arrowhead_stroke)
         self._endpoints = []  #tuples of (endpoint, tail_stroke), one for each endpoint of a tail
         
-        self.arrowHeadMatcher = Template.TemplateDict(filename = "Utils/arrowheads.templ")
+        self.arrowHeadMatcher = arrowHeadMatcher
         
         
 
@@ -409,7 +409,7 @@ def _isArrowHead(stroke, matcher):
         strkLen = GeomUtils.strokeLength(stroke)
         arrowHeadStroke = GeomUtils.strokeNormalizeSpacing(Stroke([sNorm.Points[0], sNorm.Points[maxCurvIdx], sNorm.Points[-1]]), numpoints = strkLen) #What would the approximated arrowhead look like?
         origStroke = GeomUtils.strokeNormalizeSpacing(stroke, numpoints = strkLen)
-        approxAcc = GeomUtils.strokeDTWDist(sNorm, arrowHeadStroke)
+        approxAcc = GeomUtils.strokeDTWDist(sNorm, arrowHeadStroke, threshold = 500000)
         #logger.debug("Stroke approximates arrowhead with %s accuracy" % (approxAcc))
 
         return approxAcc < 500000
@@ -279,6 +279,23 @@ class DiGraphMarker( ObserverBase.Collector ):
 
         return digraph_anno
 
+    def collectionBox( self, digraph_anno ):
+        "The box around the digraph's edge endpoints and the area around its nodes that edges can connect from"
+        points = []
+        for e in digraph_anno.edge_set:
+            points.extend( [e.tip, e.tail] )
+        for n in digraph_anno.node_set:
+            reach = n.radius * DiGraphAnnotation.MATCHING_DISTANCE
+            points.extend( [Point(n.center.X - reach, n.center.Y + reach), Point(n.center.X + reach, n.center.Y - reach)] )
+        if len(points) == 0:
+            return None
+        return ( Point( min([p.X for p in points]), max([p.Y for p in points]) ),
+                 Point( max([p.X for p in points]), min([p.Y for p in points]) ) )
+
+    def mergeCandidateBox( self, digraph_anno ):
+        "Edges only connect to nodes whose reach contains the edge's tip or tail"
+        return self.collectionBox( digraph_anno )
+
     def mergeCollections( self, from_anno, to_anno ):
         "merge from_anno into to_anno if they point to each other"
         # check all edges in one againt all nodes in the other
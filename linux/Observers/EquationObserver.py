@@ -130,6 +130,7 @@ class EquationCollector (ObserverBase.Collector):
 
 
     def onAnnotationUpdated(self, annotation):
+        ObserverBase.Collector.onAnnotationUpdated(self, annotation)
         if isinstance(annotation, EquationAnnotation):
             self.getGUI().boardChanged()
 
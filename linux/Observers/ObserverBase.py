@@ -34,6 +34,7 @@ from SketchFramework.Point import Point
 from SketchFramework.Stroke import Stroke
 from SketchFramework.Board import BoardObserver, Board
 from SketchFramework.Annotation import Annotation, AnnotatableObject
+from SketchFramework.StrokeIndex import StrokeIndex
 
 logger = Logger.getLogger('ObserverBase', Logger.WARN )
 #-------------------------------------
@@ -108,6 +109,9 @@ class Collector( BoardObserver ):
     # collectionFromItem builds a new collection of size 1 from one of the base items (or returns None).
     # mergeCollections takes two collections and merges them into one if possible.
     # If this collector adds annotations other than the collection_annotype, list them in other_target_annos
+    # Merging is incremental: only collections that are new or have changed since the last merge are
+    # tried, against every other collection.  To only try collections that are nearby, implement
+    # mergeCandidateBox (and collectionBox, if the strokes' bounding box is not what it should be tested against).
 
     def __init__(self, board, item_annotype_list, collection_annotype, other_target_annos = []):
         BoardObserver.__init__(self, board)
@@ -118,67 +122,99 @@ class Collector( BoardObserver ):
         self.all_collections = set([])   
         self.item_annotype_list = item_annotype_list      # types of the "items"  (e.g. CircleAnnotation, ArrowAnnotation)
         self.collection_annotype = collection_annotype    # type of the "collection" (e.g. DiGraphAnnotation)
+        self._dirty_collections = set([])                 # collections not yet tried against the others
+        self._collection_index = _CollectionIndex(self)   # collections by their collectionBox
 
     def onAnnotationAdded( self, strokes, annotation ):
         if type(annotation) is self.collection_annotype:
-            self.all_collections.add(annotation)
+            self._addCollection(annotation)
         else:
             for annotype in self.item_annotype_list:
                 if annotation.isType( annotype ):
                     collection = self.collectionFromItem( strokes, annotation )
                     if collection is not None:
-                        self.all_collections.add( collection )
+                        self._addCollection( collection )
+                        self.getBoard().AddAnnotationDependency( collection, annotation )
                         self.getBoard().AnnotateStrokes( strokes, collection )
-        self._merge_all_collections()
+        self._merge_new_collections()
+
+    def onAnnotationUpdated( self, annotation ):
+        "A collection changed: try merging it again the next time we merge"
+        if annotation in self.all_collections:
+            self._addCollection( annotation )
 
     def onAnnotationRemoved( self, annotation ):
         """Unique to collections, removing an annotation that was used to build a collection 
-        results in every dependent collection being removed and rebuilt from scratch.
+        results in the collections built from it (see Board.AddAnnotationDependency) being removed
+        and rebuilt from their remaining items.
         ** Ordering is NOT necessarily preserved! **"""
 
         if( annotation in self.all_collections ):
             self.all_collections.remove( annotation )
+            self._dirty_collections.discard( annotation )
+            self._collection_index.remove( annotation )
 
         if type(annotation) in self.item_annotype_list:
             logger.debug("Removing collection item: rebuilding collections")
-            all_item_annos = set([])
-            all_collection_annos = set([])
+            board = self.getBoard()
+            dependent_collections = [c for c in board.GetDerivedAnnotations(annotation) if c in self.all_collections]
+
+            #Get all of the items those collections were built from
+            rebuild_items = []
+            for col in dependent_collections:
+                for item in board.GetSourceAnnotations(col):
+                    if item is not annotation and item not in rebuild_items:
+                        rebuild_items.append(item)
+            #Items sharing the removed item's strokes that weren't collected may be collectable now
             for s in annotation.Strokes:
-                all_collection_annos.update(set(s.findAnnotations(self.collection_annotype)) )
-
-            #For all of the collections that might depend on this annotation
-            #   Get all of the item annotations that those collections might also depend on
-            for col in all_collection_annos:
-                for s in col.Strokes:
-                    for t in self.item_annotype_list:
-                        all_item_annos.update(set(s.findAnnotations(t)) )
-                  
+                for t in self.item_annotype_list:
+                    for item in s.findAnnotations(t):
+                        if item is not annotation and item not in rebuild_items \
+                          and not [c for c in board.GetDerivedAnnotations(item) if c in self.all_collections]:
+                            rebuild_items.append(item)
 
-            #Remove any collections that may depend on this annotation
-            for anno in all_collection_annos:
-                self.getBoard().RemoveAnnotation(anno)
+            #Remove the collections that depend on this annotation
+            for anno in dependent_collections:
+                board.RemoveAnnotation(anno)
 
             #Rebuild the annotations as needed from the remaining parts
-            for anno in all_item_annos:
-                if anno is not annotation:
-                    self.onAnnotationAdded(anno.Strokes, anno)
-
-            
-
-    def _merge_all_collections( self ):
-        "walk through all of the collections and merge any that should be"
-        check_set = set(self.all_collections) # make a copy of the set
-        while len(check_set)>0:
-            from_anno = check_set.pop()
-            # now iterate over the rest of the sets to find overlaps
-            for to_anno in check_set:
+            for anno in rebuild_items:
+                self.onAnnotationAdded(anno.Strokes, anno)
+
+    def _addCollection( self, collection ):
+        "Track collection (again), and mark it to be merged"
+        self.all_collections.add( collection )
+        self._dirty_collections.add( collection )
+        self._collection_index.add( collection )
+
+    def _mergeCandidates( self, collection ):
+        "The collections that collection could merge with"
+        box = self.mergeCandidateBox( collection )
+        if box is None:
+            return [c for c in self.all_collections if c is not collection]
+        tl, br = box
+        return [c for c in self._collection_index.overlapping( tl.X, br.Y, br.X, tl.Y ) if c is not collection]
+
+    def _merge_new_collections( self ):
+        "try to merge each new or changed collection into the others"
+        while len(self._dirty_collections) > 0:
+            from_anno = self._dirty_collections.pop()
+            if from_anno not in self.all_collections:
+                continue
+            for to_anno in self._mergeCandidates( from_anno ):
                 didmerge = self.mergeCollections( from_anno, to_anno )
                 if didmerge:
+                    # to_anno is now built from everything from_anno was
+                    for item in self.getBoard().GetSourceAnnotations( from_anno ):
+                        self.getBoard().AddAnnotationDependency( to_anno, item )
                     # calculate the new set of strokes for the collection
                     new_strokes = list( set(from_anno.Strokes).union( set(to_anno.Strokes) ) )
                     # now tell the board about what is happening
                     self.getBoard().UpdateAnnotation( to_anno, new_strokes )
                     self.getBoard().RemoveAnnotation( from_anno )
+                    # to_anno has grown, so it may merge with others now
+                    if to_anno in self.all_collections:
+                        self._addCollection( to_anno )
                     # we just removed the "from" anno so we don't need to try and merge 
                     # it any more. Just pop out of this inner loop and get a new "from"
                     break
@@ -195,6 +231,30 @@ class Collector( BoardObserver ):
         logger.error("failure to implement virtual method 'newCollectionAnno'")
         raise NotImplementedError
 
+    def collectionBox( self, collection ):
+        "Input: a collection annotation.  Return the (topLeft, bottomRight) box it is indexed by, or None"
+        if len(collection.Strokes) == 0:
+            return None
+        return GeomUtils.strokelistBoundingBox( collection.Strokes )
+
+    def mergeCandidateBox( self, collection ):
+        """Input: a collection annotation.  Return a (topLeft, bottomRight) box that the collectionBox
+        of every collection it might merge with overlaps, or None to try all of the collections"""
+        return None
+
+class _CollectionIndex( StrokeIndex ):
+    "Indexes a collector's collections by their collectionBox"
+    def __init__( self, collector, cellSize = 64 ):
+        StrokeIndex.__init__( self, cellSize = cellSize )
+        self.collector = collector
+
+    def boxOf( self, collection ):
+        box = self.collector.collectionBox( collection )
+        if box is None:
+            return None
+        tl, br = box
+        return ( tl.X, br.Y, br.X, tl.Y )
+
 #-------------------------------------
 # if executed by itself, run all the doc tests
 
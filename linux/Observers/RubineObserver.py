@@ -60,17 +60,16 @@ class RubineAnnotation(Annotation):
 class RubineMarker( BoardObserver ):
     """Classifies strokes based on the Rubine classifier"""
 
-    def __init__(self, board, fname, debug=False):
-        """ Initiates the Rubine classifier. fname is the name of a file containing the training data to be used. """
+    def __init__(self, board, fname, debug=False, classifier=None):
+        """ Initiates the Rubine classifier. fname is the name of a file containing the training data to be used.
+        The parsed weights are shared between markers (see Rubine.getSharedClassifier),
+        unless a preloaded classifier is given."""
         BoardObserver.__init__(self, board)
         #featureSet = Rubine.RubineFeatureSet()
-        rubineDataFile = open(fname, "r")
-        featureSet = Rubine.BCPFeatureSet()
         #featureSet = Rubine.BCPFeatureSet_Combinable()
-        self.classifier = Rubine.RubineClassifier(featureSet = featureSet, debug = debug)
-        logger.debug("Loading weights from %s" % (fname))
-        self.classifier.loadWeights(rubineDataFile)
-        rubineDataFile.close()
+        if classifier is None:
+            classifier = Rubine.getSharedClassifier(fname, featureSetClass = Rubine.BCPFeatureSet, debug = debug)
+        self.classifier = classifier
         self.getBoard().AddBoardObserver( self , [RubineAnnotation])
         self.getBoard().RegisterForStroke( self )
 
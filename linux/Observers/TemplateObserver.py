@@ -11,7 +11,7 @@ Doctest Examples:
 #-------------------------------------
 import os
 from Utils import GeomUtils
-from Utils.Template import TemplateDict
+from Utils.Template import getSharedTemplateDict
 from Utils import Logger
 
 from SketchFramework import Point
@@ -43,7 +43,7 @@ class TemplateMarker( BoardObserver ):
         self.templateRecognizers = list()
         for filename in os.listdir('./'):
             if filename.endswith('.templ'):
-                self.templateRecognizers.append( TemplateDict(filename) )
+                self.templateRecognizers.append( getSharedTemplateDict(filename) )
         
        
     def onStrokeAdded( self, stroke ):
@@ -78,11 +78,7 @@ class _LetterMarker( BoardObserver ):
         self.getBoard().RegisterForStroke( self )
         #self.getBoard().RegisterForAnnotation(  RubineAnnotation , self)
 
-        rubineDataFile = open(fname, "r")
-        featureSet = Rubine.BCPFeatureSet()
-        self.classifier = Rubine.RubineClassifier(featureSet = featureSet)
-        self.classifier.loadWeights(rubineDataFile)
-        rubineDataFile.close()
+        self.classifier = Rubine.getSharedClassifier(fname, featureSetClass = Rubine.BCPFeatureSet)
 
 
     def _makeLetterAnnotation(self, strokelist, char, alternates):
@@ -96,6 +92,16 @@ class _LetterMarker( BoardObserver ):
         "Tags 1's, dashes and 0's as letters (TextAnnotation)"
 
         scores = self.classifier.classifyVector(stroke.getFeatureVector(self.classifier.featureSet))
+        self._annotateLetter(stroke, scores)
+
+    def onStrokesAdded(self, strokes):
+        "Classifies all the strokes of a Board.batch() together"
+        featureSet = self.classifier.featureSet
+        allScores = self.classifier.classifyVectors([stk.getFeatureVector(featureSet) for stk in strokes])
+        for stroke, scores in zip(strokes, allScores):
+            self._annotateLetter(stroke, scores)
+
+    def _annotateLetter(self, stroke, scores):
         if len(scores) > 0:
             best = scores[0]['symbol']
             if best in ('R', 'L', '1', '0', '-', 'L'):
@@ -207,6 +213,8 @@ tc_logger = Logger.getLogger("TextCollector", Logger.WARN)
 
 class TextCollector( ObserverBase.Collector ):
     "Watches for strokes that look like text"
+    HORIZ_DIST_RATIO = 2.3 # How far apart (in multiples of the larger scale) texts can be to merge
+    SCALE_DIFF_RATIO = 2.0 # How much bigger one text's scale can be than the other's
     def __init__(self, board, circularity_threshold=0.90):
         # FIXME: this is for "binary" text right now
         self.letterMarker = _LetterMarker(board)
@@ -241,11 +249,30 @@ class TextCollector( ObserverBase.Collector ):
                     self.getBoard().AnnotateStrokes( singleStrokeList,  dashAnnotation)
 
 
+    def collectionBox( self, anno ):
+        "The scale x scale box around the center of the text's strokes"
+        if len(anno.Strokes) == 0:
+            return None
+        bb = GeomUtils.strokelistBoundingBox( anno.Strokes )
+        center = Point( (bb[0].X + bb[1].X) / 2.0, (bb[0].Y + bb[1].Y) / 2.0)
+        tl = Point (center.X - anno.scale/ 2.0, center.Y + (anno.scale / 2.0) )
+        br = Point (center.X + anno.scale/ 2.0, center.Y - (anno.scale / 2.0) )
+        return (tl, br)
+
+    def mergeCandidateBox( self, anno ):
+        "Texts that anno can merge with are at most HORIZ_DIST_RATIO times the larger scale to either side"
+        maxDist = anno.scale * TextCollector.SCALE_DIFF_RATIO * TextCollector.HORIZ_DIST_RATIO
+        box = self.collectionBox( anno )
+        if box is None:
+            return None
+        tl, br = box
+        return ( Point(tl.X - maxDist, tl.Y), Point(br.X + maxDist, br.Y) )
+
     def mergeCollections( self, from_anno, to_anno ):
         "merge from_anno into to_anno if possible"
         vertOverlapRatio = 0
-        horizDistRatio = 2.3
-        scaleDiffRatio = 2.0
+        horizDistRatio = TextCollector.HORIZ_DIST_RATIO
+        scaleDiffRatio = TextCollector.SCALE_DIFF_RATIO
         #if from_anno.scale > 0:
             #scale_diff = to_anno.scale / from_anno.scale
             #if scale_diff > scaleDiffRatio or scale_diff < 1/ float(scaleDiffRatio) :
@@ -259,17 +286,8 @@ class TextCollector( ObserverBase.Collector ):
         #   |          |
         #   | (0,0)    |
         #   +--------bb[1]
-        bb_from = GeomUtils.strokelistBoundingBox( from_anno.Strokes )
-        center_from = Point( (bb_from[0].X + bb_from[1].X) / 2.0, (bb_from[0].Y + bb_from[1].Y) / 2.0)
-        tl = Point (center_from.X - from_anno.scale/ 2.0, center_from.Y + (from_anno.scale / 2.0) )
-        br = Point (center_from.X + from_anno.scale/ 2.0, center_from.Y - (from_anno.scale / 2.0) )
-        bb_from = (tl, br)
-
-        bb_to = GeomUtils.strokelistBoundingBox( to_anno.Strokes )
-        center_to = Point( (bb_to[0].X + bb_to[1].X) / 2.0, (bb_to[0].Y + bb_to[1].Y) / 2.0)
-        tl = Point (center_to.X - to_anno.scale/ 2.0, center_to.Y + (to_anno.scale / 2.0) )
-        br = Point (center_to.X + to_anno.scale/ 2.0, center_to.Y - (to_anno.scale / 2.0) )
-        bb_to = (tl, br)
+        bb_from = self.collectionBox( from_anno )
+        bb_to = self.collectionBox( to_anno )
 
         # check that they are next to each other
         if    abs( bb_from[1].X - bb_to[0].X ) > to_anno.scale * horizDistRatio \
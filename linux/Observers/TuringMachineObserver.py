@@ -276,7 +276,7 @@ class BoxMarker(BoardObserver):
             cornerStroke = Stroke(c_list + c_list[:2])
             boxStroke = GeomUtils.strokeNormalizeSpacing(Stroke(c_list + [c_list[0]]))
             origStroke = GeomUtils.strokeNormalizeSpacing(Stroke(stroke.Points + [stroke.Points[0]]))
-            approxAcc = GeomUtils.strokeDTWDist(boxStroke, origStroke)
+            approxAcc = GeomUtils.strokeDTWDist(boxStroke, origStroke, threshold = boxApproxThresh)
             print "Box approximates original with %s accuracy" % (approxAcc)
             if approxAcc < boxApproxThresh:
                 self.getBoard().AnnotateStrokes([stroke], BoxAnnotation(c_list))
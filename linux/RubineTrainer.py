@@ -38,6 +38,7 @@ from Utils.StrokeStorage import StrokeStorage
 from Utils.GeomUtils import getStrokesIntersection, strokeContainsStroke, strokeSmooth, strokeLength, strokeApproximateCubicCurves
 from Utils import Logger, DataManager, GeomUtils
 from Utils import Rubine #import RubineClassifier, RubineFeatureSet, BCPFeatureSet, BCP_ShapeFeatureSet
+from Utils import RubineBatch
 
 
 
@@ -338,30 +339,42 @@ if __name__ == "__main__":
     args = sys.argv
     if len(args) > 1:
         if args[1] == "batch" and len(args) > 2:
+            outfname = "RubineData.xml"
+            processes = None
+            cacheFname = None
             if len(args) > 3:
                 outfname = args[3]
-            else:
-                outfname = "RubineData.xml"
-            trainFile = open(args[2], "r")
-            trainer = Rubine.RubineClassifier(featureSet = FEATURESET())
-            for line in trainFile.readlines():
-                if line.startswith("#"):
-                    continue
-                name, strokeFname = line.strip().split()
-                print "Training %s from %s" % (name, strokeFname)
-                trainer.newClass (name = name)
-                strokes = StrokeStorage(filename = strokeFname).loadStrokes()
-                for stk in strokes:
-                    try:
-                        trainer.addStroke(stk, name)
-                    except Exception as e:
-                        print e
+            if len(args) > 4:
+                processes = int(args[4])
+            if len(args) > 5:
+                cacheFname = args[5]
+            featureSet = FEATURESET()
+            featureSet.enableTiming()
+            trainer = Rubine.RubineClassifier(featureSet = featureSet)
+            examples = RubineBatch.trainingSpecExamples(args[2])
+            print "Training on %s examples" % (len(examples))
+            numUsed = RubineBatch.trainClassifier(trainer, examples, processes = processes, cacheFname = cacheFname)
+            print "Used %s examples in %s classes" % (numUsed, len(trainer.symbolClasses))
             print "Saving Weights to %s" % (outfname)
             #pickle.dump(trainer, open("trainer.dmp", "wb"))
             trainer.saveWeights(outfname)
+            if processes == 1:
+                print "Feature extraction times:"
+                print featureSet.timingReport()
+
+        elif args[1] == "convert" and len(args) > 2:
+            outfname = None
+            featureSetClass = FEATURESET
+            if len(args) > 3:
+                outfname = args[3]
+            if len(args) > 4:
+                featureSetClass = getattr(Rubine, args[4])
+            outfname = Rubine.convertXMLWeights(args[2], outfname, featureSetClass = featureSetClass)
+            print "Saved binary weights to %s" % (outfname)
 
         else:   
-            print "Usage: %s batch <training_spec>" % (args[0])
+            print "Usage: %s batch <training_spec> [out.xml|out%s] [processes] [featurecache]" % (args[0], Rubine.BINARY_MODEL_EXT)
+            print "       %s convert <weights.xml> [out%s] [FeatureSetClass]" % (args[0], Rubine.BINARY_MODEL_EXT)
             exit(1)
 
     else:
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+from sketchvision import ImageStrokeConverter
+import cv
+import numpy
+import random
+import sys
+
+def main(args):
+    """Check that the array-backed SkeletonGraph traces the same graph as the
+    dictionary graph, on fixed images of random crossing bars"""
+    if len(args) > 1 and args[1] in ("-h", "--help"):
+        print "Usage: %s [numImages]" % (args[0])
+        exit(1)
+    numImages = 30
+    if len(args) > 1:
+        numImages = int(args[1])
+
+    failures = 0
+    for seed in range(numImages):
+        img = barsImage(seed)
+        pointSet = thinnedPoints(img)
+        ImageStrokeConverter.CACHE = {}
+        random.seed(seed)
+        dictGraph = ImageStrokeConverter.pointsToGraph(set(pointSet), img)
+        ImageStrokeConverter.CACHE = {}
+        random.seed(seed)
+        arrayGraph = ImageStrokeConverter.pointsToArrayGraph(set(pointSet), img).toGraphDict()
+
+        if normalizeGraph(dictGraph) != normalizeGraph(arrayGraph):
+            failures += 1
+            print "Image %s: graphs differ (%s dict points, %s array points)" % (seed, len(dictGraph), len(arrayGraph))
+    print "%s of %s graphs differ" % (failures, numImages)
+    if failures > 0:
+        exit(1)
+
+def barsImage(seed):
+    """A white image with a few black horizontal and vertical bars, some of them crossing"""
+    rand = random.Random(seed)
+    height, width = rand.randint(40, 120), rand.randint(40, 120)
+    imgArr = numpy.empty( (height, width), dtype=numpy.uint8)
+    imgArr.fill(255)
+    for i in range(rand.randint(3, 10)):
+        x, y = rand.randint(0, width - 1), rand.randint(0, height - 1)
+        if rand.random() < 0.5:
+            imgArr[y:y + rand.randint(2, 6), x:x + rand.randint(10, 50)] = 0
+        else:
+            imgArr[y:y + rand.randint(10, 50), x:x + rand.randint(2, 6)] = 0
+    return cv.fromarray(imgArr)
+
+def thinnedPoints(img):
+    """The points left after thinning the ink in img, as blobsToStrokes finds them"""
+    ImageStrokeConverter.CACHE = {}
+    ImageStrokeConverter.FILLEDVAL = 240
+    pointSet, thinImg = ImageStrokeConverter._thinBlobsImageArray(cv.CloneMat(img))
+    numChanged, pointSet, thinImg = ImageStrokeConverter.thinBlobsPoints(pointSet, thinImg, finalPass = True)
+    return pointSet
+
+def normalizeGraph(graph):
+    """The graph as {point : (sorted kids, thickness)}, to compare graphs"""
+    normGraph = {}
+    for pt, ptDict in graph.items():
+        normGraph[pt] = (sorted(ptDict['kids']), float(ptDict['thickness']))
+    return normGraph
+
+if __name__ == "__main__":
+    main(sys.argv)
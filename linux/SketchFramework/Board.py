@@ -1,5 +1,6 @@
 from SketchFramework.SketchGUI import DummyGUI
 from SketchFramework.Stroke import Stroke
+from SketchFramework.StrokeIndex import StrokeIndex
 from Utils import GeomUtils
 from Utils import Logger
 from xml.etree import ElementTree as ET
@@ -7,7 +8,6 @@ import datetime
 import pdb 
 import sys 
 import threading
-from Utils.GeomUtils import pointDistance
 
 
 
@@ -38,6 +38,20 @@ class BoardObserver(object):
     
     def onStrokeEdited( self, oldStroke, newStroke ):
         pass
+
+    def onStrokesAdded( self, strokes ):
+        "Called with all the strokes added in a Board.batch(). Override to handle them together."
+        for stroke in strokes:
+            self.onStrokeAdded( stroke )
+
+    def onStrokesRemoved( self, strokes ):
+        "Called with all the strokes removed in a Board.batch(). Override to handle them together."
+        for stroke in strokes:
+            self.onStrokeRemoved( stroke )
+
+    def onBatchFinished( self ):
+        "Called on every board observer once the notifications for a Board.batch() are done"
+        pass
     
     def onAnnotationAdded( self, obj, annotation ):
         pass
@@ -60,6 +74,20 @@ class BoardObserver(object):
         return self._parentBoard._GUI
         
 
+#--------------------------------------------
+class BoardBatch(object):
+    "Context manager returned by Board.batch()"
+    def __init__(self, board):
+        self._board = board
+
+    def __enter__(self):
+        self._board._beginBatch()
+        return self._board
+
+    def __exit__(self, excType, excValue, tb):
+        self._board._endBatch()
+        return False
+
 #--------------------------------------------
 
 # TODO: Does Board really need to be a sigleton?  If we want 
@@ -91,6 +119,7 @@ class Board(object):
 
     def Reset(self):
         self.Strokes = [] #All the strokes on the board
+        self._strokeIndex = StrokeIndex() #Spatial index of self.Strokes, for FindStrokes
         self.StrokeObservers=[] #All of the stroke observers to be called onStrokeAdded
         self.AnnoObservers={} #Dict indexed by annotation type to be called onAnnotationAdded
         self.BoardObservers=[] #Generic list of all board observers. Deprecated?
@@ -98,6 +127,14 @@ class Board(object):
         #Ensure that we don't add something after its removal
         self._removed_annotations = {}
         self._removed_strokes = {}
+        #Which annotations were derived from which, see AddAnnotationDependency
+        self._annoSources = {} #derived annotation : list of the annotations it was built from
+        self._annoDerived = {} #source annotation : list of the annotations built from it
+        #Stroke changes waiting to be announced at the end of a batch()
+        self._batchDepth = 0
+        self._batchAdded = []
+        self._batchRemoved = []
+        self._batchEdited = []
         
 
     def xml(self, width, height):
@@ -123,8 +160,13 @@ class Board(object):
         logger.debug( "Adding Stroke: %d", newStroke.ident )
         
         self.Strokes.append( newStroke )
+        if isinstance(newStroke, Stroke):
+            self._strokeIndex.add(newStroke)
         newStroke.setBoard(self)
         
+        if self._batchDepth > 0:
+            self._batchAdded.append(newStroke)
+            return
         for so in self.StrokeObservers:
             if newStroke not in self._removed_strokes: #Nobody has removed this stroke yet
                 so.onStrokeAdded( newStroke )
@@ -136,25 +178,86 @@ class Board(object):
 
         self._removed_strokes[oldStroke] = True
 
-        for so in self.StrokeObservers:
-            so.onStrokeRemoved( oldStroke )
+        if self._batchDepth > 0:
+            if oldStroke in self._batchAdded:
+                self._batchAdded.remove(oldStroke) #Never announced, so nothing to take back
+            else:
+                self._batchRemoved.append(oldStroke)
+        else:
+            for so in self.StrokeObservers:
+                so.onStrokeRemoved( oldStroke )
         if oldStroke in self.Strokes:
             self.Strokes.remove( oldStroke )
+            self._strokeIndex.remove( oldStroke )
         else:
             logger.warn("Removing an unknown stroke!")
         
     def EditStroke ( self, oldStroke, newStroke ):
         "Input: Stroke oldStroke, newStroke.  Edits oldStroke to be newStroke on the board; calls any Stroke Observers as needed"
         logger.debug( "Edit stroke (FIXME: Not Fully Implemented)" );
-        for so in self.StrokeObservers:
-            so.onStrokeEdited( oldStroke, newStroke )
+        if self._batchDepth > 0:
+            if oldStroke in self._batchAdded:
+                #Never announced: announce the new stroke as added instead
+                self._batchAdded[self._batchAdded.index(oldStroke)] = newStroke
+            else:
+                self._batchEdited.append( (oldStroke, newStroke) )
+        else:
+            for so in self.StrokeObservers:
+                so.onStrokeEdited( oldStroke, newStroke )
         if oldStroke in self.Strokes:
             idx = self.Strokes.index(oldStroke)
             self.Strokes[idx] = newStroke
+            if isinstance(newStroke, Stroke):
+                self._strokeIndex.replace(oldStroke, newStroke)
+            else:
+                self._strokeIndex.remove(oldStroke)
         else:
             logger.warn("Editing a non-existant stroke!")
             
             
+    def batch( self ):
+        """Group stroke changes and announce them together:
+            with board.batch():
+                for stk in strokes:
+                    board.AddStroke(stk)
+        Strokes are added to (and removed from) the board straight away, but the
+        stroke observers are only told when the outermost batch ends. Each observer
+        then gets onStrokesRemoved, onStrokeEdited and onStrokesAdded calls covering
+        the whole batch, before the next observer is called. A stroke both added and
+        removed in the batch is never announced. Finally every board observer gets
+        onBatchFinished."""
+        return BoardBatch(self)
+
+    def IsBatching( self ):
+        "Returns true while a batch() is open or its notifications are being sent"
+        return self._batchDepth > 0
+
+    def _beginBatch( self ):
+        self._batchDepth += 1
+
+    def _endBatch( self ):
+        if self._batchDepth > 1:
+            self._batchDepth -= 1
+            return
+        try:
+            #Observers may change strokes while being notified; those changes are
+            #announced in another round
+            while len(self._batchAdded) + len(self._batchRemoved) + len(self._batchEdited) > 0:
+                added, removed, edited = self._batchAdded, self._batchRemoved, self._batchEdited
+                self._batchAdded, self._batchRemoved, self._batchEdited = [], [], []
+                for so in list(self.StrokeObservers):
+                    if len(removed) > 0:
+                        so.onStrokesRemoved( list(removed) )
+                    for oldStroke, newStroke in edited:
+                        so.onStrokeEdited( oldStroke, newStroke )
+                    newStrokes = [s for s in added if s not in self._removed_strokes] #Nobody has removed these yet
+                    if len(newStrokes) > 0:
+                        so.onStrokesAdded( newStrokes )
+        finally:
+            self._batchDepth = 0
+        for obs in list(self.BoardObservers):
+            obs.onBatchFinished()
+
     def RegisterForStroke( self, strokeObserver ):
         "Input: BoardObserver stroke.  Registers with the board an Observer to be called when strokes are added"
         self.StrokeObservers.append( strokeObserver )
@@ -230,6 +333,36 @@ class Board(object):
                 if anno not in self._removed_annotations: #Will fail if someone has called "RemoveAnnotation"
                     i.onAnnotationAdded(strokes, anno)
 
+    def AddAnnotationDependency(self, derived, source):
+        """Input: Annotations derived and source.  Record that derived was built from source, so that
+        whoever maintains derived can find it (with GetDerivedAnnotations) when source is removed.
+        The record is dropped when either annotation is removed."""
+        sources = self._annoSources.setdefault(derived, [])
+        if source not in sources:
+            sources.append(source)
+            self._annoDerived.setdefault(source, []).append(derived)
+
+    def GetSourceAnnotations(self, derived):
+        "Input: Annotation derived.  Returns the annotations it was recorded as being built from"
+        return list(self._annoSources.get(derived, []))
+
+    def GetDerivedAnnotations(self, source):
+        "Input: Annotation source.  Returns the annotations recorded as being built from it"
+        return list(self._annoDerived.get(source, []))
+
+    def _dropAnnotationDependencies(self, anno):
+        "Forget everything anno was built from and everything built from it"
+        for source in self._annoSources.pop(anno, []):
+            derivedList = self._annoDerived.get(source, [])
+            derivedList.remove(anno)
+            if len(derivedList) == 0:
+                del(self._annoDerived[source])
+        for derived in self._annoDerived.pop(anno, []):
+            sourceList = self._annoSources.get(derived, [])
+            sourceList.remove(anno)
+            if len(sourceList) == 0:
+                del(self._annoSources[derived])
+
     def SuggestAnnotation(self, anno_type, strokelist):
         """Send these strokes back to whoever manages anno_type Annotations and try to get a good annotation from them"""
         logger.debug("Suggesting %s strokes be annotated with %s" % (len(strokelist), anno_type.__name__))
@@ -285,6 +418,8 @@ class Board(object):
         if anno.__class__ in self.AnnoObservers:
             for obs in self.AnnoObservers[anno.__class__]:
                 obs.onAnnotationRemoved(anno)
+        # the observers have had the chance to look up what depended on anno
+        self._dropAnnotationDependencies(anno)
         # remove the annotation from the strokes. 
         # do this second, since observers may need to check the old strokes' properties
         for stroke in list(anno.Strokes):
@@ -330,10 +465,11 @@ class Board(object):
                     retlist.append(obj)
             return retlist
 
-    def FindAnnotations( self, location=None, radius=None, strokelist = None, anno_type = None):
+    def FindAnnotations( self, location=None, radius=None, strokelist = None, anno_type = None, anyPoint = False):
+        "Annotations (of anno_type, if given) on the strokes in strokelist, or else on FindStrokes(location, radius, anyPoint)"
         anno_set = set()
         if strokelist is None:
-            stroke_list = self.FindStrokes(location, radius )
+            stroke_list = self.FindStrokes(location, radius, anyPoint = anyPoint)
         else:
             stroke_list = strokelist
         for s in stroke_list:
@@ -341,21 +477,25 @@ class Board(object):
             # keep a set to avoid adding annotations redundantly
         return list(anno_set)
 
-    #FIXME: I think FindStrokes would be better if it returned any stroke that had any points
-    #       in the query region?  Much more computationally expensive, but much more useful?
-    def FindStrokes( self, location=None, radius=None ):
-        "Input: Point location, int/double radius. Searches for Strokes on the board within the location and radius. Radius of -1 means find all strokes."
+    def FindStrokes( self, location=None, radius=None, anyPoint = False ):
+        """Input: Point location, int/double radius. Searches for Strokes on the board within the location and radius. Radius of None means find all strokes.
+        Strokes match if their center point is within radius, or with anyPoint, if any of their points is."""
+        if radius == None:
+            return [s for s in self.Strokes if isinstance(s, Stroke)]
         if location != None:
             x,y = location.X, location.Y
         else:
             x = y = 0
 
-	# find all the strokes that have a center point within radius of given location
-        stroke_list = []
-        for s in self.Strokes:
-            if isinstance(s, Stroke) and (radius==None or pointDistance(s.X,s.Y,x,y) < radius): 
-                stroke_list.append(s)
-        return stroke_list
+        if anyPoint:
+            return self._strokeIndex.touchingCircle(x, y, radius)
+        else:
+            return self._strokeIndex.nearCenter(x, y, radius)
+
+    def FindStrokesInRect( self, topLeft, bottomRight, anyPoint = False ):
+        """Input: Points topLeft, bottomRight. Searches for Strokes on the board whose bounding box overlaps the rectangle,
+        or with anyPoint, that have a point inside it."""
+        return self._strokeIndex.inRect(topLeft, bottomRight, anyPoint = anyPoint)
                 
 #--------------------------------------------
 
@@ -6,7 +6,12 @@ requisite port number.
 On a connection being accepted, it spawns a new
 NetworkReceiver thread to handle the traffic for
 the connection.
+Requests from every connection share one request queue,
+and are tagged with the id of their connection. A
+ResponseRouter thread hands each response put on the shared
+response queue back to the connection with the same id.
 """
+import collections
 import tempfile
 import socket
 import Queue
@@ -14,7 +19,6 @@ import sys
 import time
 import os
 import threading
-import StringIO
 import pdb
 import struct
 
@@ -25,25 +29,45 @@ class Message:
     TYPE_XML = "Xml"
     TYPE_INFO = "Info"
 
+    #Binary framing: <magic><type, NUL padded><data length>, then the data
+    BINARY_MAGIC = "SKB1"
+    BINARY_HEADER = struct.Struct("!4s4sI")
+    MAX_BINARY_LENGTH = 64 * 1024 * 1024 #Longest data accepted, so a bad header can't allocate 4GB
+
     @classmethod
     def parse(cls, inString):
         """Factory method that returns a message parsed from the string,
         or None if the string is poorly formatted"""
         retMsg = None
-        strIO = StringIO.StringIO(inString)
-
-        msgType = strIO.readline()
-        dataString = inString[len(msgType):]
-        msgType = msgType.rstrip()
+        typeEnd = inString.find("\n")
+        if typeEnd < 0:
+            typeEnd = len(inString)
+        msgType = str(inString[:typeEnd]).rstrip()
+        dataString = inString[typeEnd + 1:]
 
         if msgType in [Message.TYPE_XML, Message.TYPE_IMG, Message.TYPE_INFO]:
             retMsg = Message(msgType, dataString)
         return retMsg
 
-    def __init__(self, msgType, data):
-        """Create a new message with type msgType, and data"""
+    @classmethod
+    def parseBinaryHeader(cls, header):
+        """Returns (msgType, length) from a binary message header,
+        or None if the header is poorly formatted or the data is longer
+        than MAX_BINARY_LENGTH"""
+        magic, msgType, length = Message.BINARY_HEADER.unpack(header)
+        msgType = msgType.rstrip("\0")
+        if magic != Message.BINARY_MAGIC \
+           or msgType not in [Message.TYPE_XML, Message.TYPE_IMG, Message.TYPE_INFO] \
+           or length > Message.MAX_BINARY_LENGTH:
+            return None
+        return (msgType, length)
+
+    def __init__(self, msgType, data, connId = None):
+        """Create a new message with type msgType, and data.
+        connId is the connection a request came from, or a response should go to"""
         self._type = msgType
         self._data = data
+        self._connId = connId
 
     def getType(self):
         return self._type
@@ -57,30 +81,50 @@ class Message:
     def setData (self, data):
         self_data = data
 
+    def getConnId(self):
+        return self._connId
+
+    def setConnId(self, connId):
+        self._connId = connId
+
     def __str__(self):
         return str(self._type) + "\n" + str(self._data)
     def __len__(self):
         return len(str(self))
 
+    def binaryHeader(self):
+        "Returns the header that precedes this message's data in binary framing"
+        return Message.BINARY_HEADER.pack(Message.BINARY_MAGIC, self._type, len(self._data))
+
 class NetworkHandler(threading.Thread):
     """A class to handle sending and receiving of raw information packets. 
     Protocol for sending and receiving looks like:
 
         <number of bytes in data>\n
         <data>
+
+    or, for binary framing (detected by the first byte of each request,
+    and used for its response as well):
+
+        <Message.BINARY_HEADER: magic, type, number of bytes in data>
+        <data>
     """
-    def __init__(self, data_q, resp_q, sock, addr):
+    def __init__(self, data_q, resp_q, sock, addr, connId = None, server = None):
         """Set up thread object.
             data_q : queue to put data received into
             resp_q : queue to read responses from
             sock : socket of active connection
             addr : socket address of active connection
+            connId : id that received messages are tagged with
+            server : ServerThread to notify of requests and disconnects
         """
         threading.Thread.__init__(self)
         self.sock = sock
         self.addr = addr
         self.recv_queue = data_q
         self.resp_queue = resp_q
+        self.connId = connId
+        self.server = server
     def run(self):
         """Perform the network management loop forever.
             1) Wait on the socket for data
@@ -93,6 +137,14 @@ class NetworkHandler(threading.Thread):
         try:
             while True:
                 print "Connected by %s" % (str(self.addr))
+                first = self.sock.recv(1, socket.MSG_PEEK)
+                if len(first) == 0:
+                    #Disconnected before more data received
+                    break
+                if first == Message.BINARY_MAGIC[0]:
+                    if not self.handleBinaryMessage():
+                        break
+                    continue
                 buf = ''
                 infp = self.sock.makefile()
                 #length = struct.unpack(infp.read(4))
@@ -104,6 +156,13 @@ class NetworkHandler(threading.Thread):
                     buf = infp.read(length)
                     print "Read %s bytes" % (length)
                     msg = Message.parse(buf)
+                    if msg is not None:
+                        msg.setConnId(self.connId)
+                    if self.server is not None:
+                        self.server.requestReceived(self.connId)
+                    if self.recv_queue.full():
+                        #Backpressure: stop reading from the client until there is room
+                        print "Request queue full, %s waiting" % (str(self.addr))
                     self.recv_queue.put(msg)
 
                     #self.resp_queue.put("Finished receiving %s" % (time.time()))
@@ -120,8 +179,53 @@ class NetworkHandler(threading.Thread):
                     #Disconnected before more data received
                     break
         finally:
+            if self.server is not None:
+                self.server.connectionClosed(self.connId)
             self.sock.shutdown(socket.SHUT_RDWR)
             self.sock.close()
+
+    def recvExactly(self, length):
+        """Read exactly length bytes from the socket straight into a new bytearray.
+        Returns None if the connection closes first."""
+        buf = bytearray(length)
+        view = memoryview(buf)
+        numRead = 0
+        while numRead < length:
+            n = self.sock.recv_into(view[numRead:], length - numRead)
+            if n == 0:
+                return None
+            numRead += n
+        return buf
+
+    def handleBinaryMessage(self):
+        """Receive one binary framed request, queue it, and send back the
+        response with binary framing. Returns False if the connection closed."""
+        header = self.recvExactly(Message.BINARY_HEADER.size)
+        if header is None:
+            return False
+        parsed = Message.parseBinaryHeader(str(header))
+        if parsed is None:
+            print "NetworkHandler: bad binary header from %s, closing" % (str(self.addr))
+            return False
+        msgType, length = parsed
+        data = self.recvExactly(length)
+        if data is None:
+            return False
+        print "Read %s bytes" % (length)
+        msg = Message(msgType, data, connId = self.connId)
+        if self.server is not None:
+            self.server.requestReceived(self.connId)
+        if self.recv_queue.full():
+            #Backpressure: stop reading from the client until there is room
+            print "Request queue full, %s waiting" % (str(self.addr))
+        self.recv_queue.put(msg)
+
+        response = self.resp_queue.get()
+        self.sock.sendall(response.binaryHeader())
+        self.sock.sendall(response.getData())
+        print "NetworkHandler: successfully sent %s bytes" % (len(response.getData()))
+        self.resp_queue.task_done()
+        return True
     
 
 class Printer(threading.Thread):
@@ -161,23 +265,56 @@ class FilePrinter(Printer):
 
 
 
+class ResponseRouter(threading.Thread):
+    """Moves responses from a server's shared response queue to the queue of the
+    connection they belong to"""
+    def __init__(self, server):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = server
+
+    def run(self):
+        while True:
+            msg = self.server.response_queue.get()
+            connQueue = self.server.responseQueueFor(msg)
+            if connQueue is None:
+                print "ResponseRouter: no connection for response, dropping it"
+            else:
+                connQueue.put(msg)
+
+
 class ServerThread(threading.Thread):
     """Thread class to manage incoming connections and spawn off receive/response threads"""
-    def __init__(self, host = '', port = 30000):
+    def __init__(self, host = '', port = 30000, request_queue = None, response_queue = None,
+                 maxQueued = 0):
         """Constructor. Sets up the a response queue and a request queue for external use.
             host: default hostname to use for server
             port: port to listen on
+            request_queue, response_queue: queues to use instead of new Queue.Queues,
+                e.g. multiprocessing queues shared with worker processes
+            maxQueued: limit on waiting requests before clients stop being read (0 = none)
         """
         threading.Thread.__init__(self)
         self.daemon = True
         self.host = host
         self.port = port
-        self.request_queue = Queue.Queue()
-        self.response_queue = Queue.Queue()
+        if request_queue is None:
+            request_queue = Queue.Queue(maxQueued)
+        if response_queue is None:
+            response_queue = Queue.Queue()
+        self.request_queue = request_queue
+        self.response_queue = response_queue
         self.sock = None
         self._alive = True
         self.networkThreads = []
 
+        self._connLock = threading.Lock()
+        self._nextConnId = 0
+        self._connQueues = {} #connId : that connection's response queue
+        self._pending = collections.deque() #connIds of requests awaiting responses, oldest first
+        self._router = ResponseRouter(self)
+        self._router.start()
+
     def getRequestQueue(self):
         "Returns the queue used to receive data from connected clients"
         return self.request_queue
@@ -192,12 +329,39 @@ class ServerThread(threading.Thread):
         self._alive = False
         self.finish()
 
+    def requestReceived(self, connId):
+        "Called by a NetworkHandler just before it queues a request"
+        with self._connLock:
+            self._pending.append(connId)
+
+    def connectionClosed(self, connId):
+        "Called by a NetworkHandler when its client disconnects"
+        with self._connLock:
+            self._connQueues.pop(connId, None)
+
+    def responseQueueFor(self, msg):
+        """Returns the response queue of the connection msg should be sent to, or None.
+        Responses without a connection id go to the oldest request still waiting."""
+        with self._connLock:
+            connId = msg.getConnId() if msg is not None else None
+            if connId is None and len(self._pending) > 0:
+                connId = self._pending[0]
+            if connId in self._pending:
+                self._pending.remove(connId)
+            return self._connQueues.get(connId, None)
+
     def acceptConnection(self):
         """Accept a connection and spawn a receiver thread"""
         print "Accepting"
         conn, addr = self.sock.accept()
         print "Accepted"
-        nThread = NetworkHandler(self.request_queue, self.response_queue, conn, addr)
+        connQueue = Queue.Queue()
+        with self._connLock:
+            connId = self._nextConnId
+            self._nextConnId += 1
+            self._connQueues[connId] = connQueue
+        nThread = NetworkHandler(self.request_queue, connQueue, conn, addr,
+                                 connId = connId, server = self)
         nThread.daemon=True
         self.networkThreads.append(nThread)
         nThread.start()
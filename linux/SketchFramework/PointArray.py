@@ -0,0 +1,141 @@
+"""
+description:
+   Compact storage for the points of a stroke. A PointArray keeps the X, Y and
+   T values of its points in three float arrays instead of one Point object per
+   sample, and can be used as a Stroke's Points list. Indexing or iterating over
+   it builds Point objects on the fly, which read and write through to the
+   arrays, so code written for lists of Points keeps working. GeomUtils works
+   on the arrays directly where it can (see GeomUtils.strokeGetPointsCurvature,
+   pointlistNormalizeSpacing).
+
+   A Point from a PointArray is a new object each time it is indexed, so
+   annotations and other attributes set on it are not kept.
+
+Doctest Examples:
+
+>>> from SketchFramework.Point import Point
+>>> pts = PointArray([0, 3, 3], [0, 4, 8])
+>>> len(pts)
+3
+>>> pts[1]
+P(3.0,4.0)
+>>> pts[-1].X, pts[-1].Y
+(3.0, 8.0)
+>>> pts[1:]
+[P(3.0,4.0), P(3.0,8.0)]
+>>> pts[0].Y = 1
+>>> [(x, y) for x, y in pts]
+[(0.0, 1.0), (3.0, 4.0), (3.0, 8.0)]
+>>> pts + [Point(5, 5)]
+[P(0.0,1.0), P(3.0,4.0), P(3.0,8.0), P(5.0,5.0)]
+>>> toPointArray([(1, 2), Point(3, 4, 10)]).T.tolist()
+[0.0, 10.0]
+"""
+
+import numpy
+
+from SketchFramework.Point import Point
+
+#--------------------------------------------
+class PointArray(object):
+    "The points of a stroke, stored as arrays of X, Y and T"
+
+    def __init__(self, xs, ys, ts = None):
+        self.X = numpy.array(xs, dtype = float)
+        self.Y = numpy.array(ys, dtype = float)
+        if ts is None:
+            self.T = numpy.zeros(len(self.X))
+        else:
+            self.T = numpy.array(ts, dtype = float)
+        assert len(self.X) == len(self.Y) == len(self.T)
+
+    def __len__(self):
+        return len(self.X)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [_ArrayPoint(self, i) for i in xrange(*key.indices(len(self)))]
+        if key < 0:
+            key += len(self)
+        if key < 0 or key >= len(self):
+            raise IndexError("point index out of range")
+        return _ArrayPoint(self, key)
+
+    def __setitem__(self, key, point):
+        self.X[key] = point.X
+        self.Y[key] = point.Y
+        self.T[key] = point.T
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield _ArrayPoint(self, i)
+
+    def __add__(self, other):
+        return self[:] + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self[:]
+
+    def __repr__(self):
+        return repr(self[:])
+
+    def append(self, point):
+        self.X = numpy.append(self.X, point.X)
+        self.Y = numpy.append(self.Y, point.Y)
+        self.T = numpy.append(self.T, point.T)
+
+    def xy(self):
+        "The points as a new (n, 2) array of X, Y"
+        return numpy.column_stack((self.X, self.Y))
+
+def toPointArray(points):
+    "Input: a list of Points or (x, y) tuples. Returns a PointArray of them"
+    if isinstance(points, PointArray):
+        return points
+    xs, ys, ts = [], [], []
+    for p in points:
+        if type(p) == tuple:
+            xs.append(p[0])
+            ys.append(p[1])
+            ts.append(0)
+        else:
+            xs.append(p.X)
+            ys.append(p.Y)
+            ts.append(p.T)
+    return PointArray(xs, ys, ts)
+
+class _ArrayPoint(Point):
+    "A Point whose X, Y and T are stored at index idx of a PointArray"
+    def __init__(self, pointArray, idx):
+        #Point and AnnotatableObject would overwrite X and Y, so set up the rest by hand
+        self._pointArray = pointArray
+        self._idx = idx
+        self.DrawMe = False
+        self.Annotations = {}
+        self.Parents = []
+        self.Center = None
+
+    def _getX(self):
+        return float(self._pointArray.X[self._idx])
+    def _setX(self, value):
+        self._pointArray.X[self._idx] = value
+    X = property(_getX, _setX)
+
+    def _getY(self):
+        return float(self._pointArray.Y[self._idx])
+    def _setY(self, value):
+        self._pointArray.Y[self._idx] = value
+    Y = property(_getY, _setY)
+
+    def _getT(self):
+        return float(self._pointArray.T[self._idx])
+    def _setT(self, value):
+        self._pointArray.T[self._idx] = value
+    T = property(_getT, _setT)
+
+#-------------------------------------
+# if executed by itself, run all the doc tests
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
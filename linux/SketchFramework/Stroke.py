@@ -2,6 +2,7 @@ import sys
 import traceback
 from Utils import Logger
 from SketchFramework.Point import Point
+from SketchFramework.PointArray import PointArray, toPointArray
 from SketchFramework.Annotation import Annotation, AnnotatableObject
 from xml.etree import ElementTree as ET
 
@@ -43,22 +44,28 @@ class Stroke(AnnotatableObject):
         self.Y = None
         self.Center = None
         self.Color = Stroke.DefaultStrokeColor
-        self._featureVectors = {} #Rubine Feature vector for this stroke. Set by calling setFeatureVector(...)
+        self._featureVectors = {} #Rubine Feature vector for this stroke, by feature set type. Filled by getFeatureVector(...)
+        self._geometry = {} #Derived geometry shared by the feature sets. Filled by getCachedGeometry(...)
 
         self._length = None
         self._resample = {}
         self.setBoard(board)# self._board = board
 
         if points and len(points)>0:
-            # if passed a sequence of tuples, covert them all to points
-            if all(type(i)==tuple for i in points):
-                points = [ Point(x,y) for (x,y) in points ]
+            if isinstance(points, PointArray):
+                # compact storage: bound it with the arrays instead of building points
+                ( left , right ) = float(points.X.min()), float(points.X.max())
+                ( bottom, top ) = float(points.Y.min()), float(points.Y.max())
+            else:
+                # if passed a sequence of tuples, covert them all to points
+                if all(type(i)==tuple for i in points):
+                    points = [ Point(x,y) for (x,y) in points ]
+                xlist = [p.X for p in points]
+                ylist = [p.Y for p in points]
+                ( left , right ) = min(xlist), max(xlist)
+                ( bottom, top ) = min(ylist), max(ylist)
             # turning smoothing off is very handy for testing
             self.Points = points
-            xlist = [p.X for p in points]
-            ylist = [p.Y for p in points]
-            ( left , right ) = min(xlist), max(xlist)
-            ( bottom, top ) = min(ylist), max(ylist)
             self.BoundTopLeft = Point(left, top)
             self.BoundBottomRight = Point(right, bottom)
 
@@ -92,13 +99,35 @@ class Stroke(AnnotatableObject):
     
     def getFeatureVector(self, featureSet):
         """Get the feature vector for this stroke given featureSet, a FeatureSet() instance."""
-        if type(featureSet) in self._featureVectors:
+        retVect = self._featureVectors.get(type(featureSet), None)
+        if retVect is not None:
             logger.debug("Reusing feature vector for stroke %s" % (self.ident))
         else:
             logger.debug("GENERATING feature vector for stroke %s" % (self.ident))
-        retVect = self._featureVectors.setdefault(type(featureSet), featureSet.generateVector([self]))
+            retVect = self._featureVectors[type(featureSet)] = featureSet.generateVector([self])
         return retVect
 
+    def getCachedGeometry(self, key, func):
+        """Return func(self), only calling func the first time key is asked for.
+        Used for geometry derived from the points (convex hull, resampling...)"""
+        geometry = self.__dict__.setdefault('_geometry', {}) #Strokes pickled before the cache existed
+        if key not in geometry:
+            geometry[key] = func(self)
+        return geometry[key]
+
+    def invalidateCache(self):
+        """Forget the cached length, feature vectors and geometry. Call after
+        changing the stroke's points in place."""
+        self._length = None
+        self._featureVectors = {}
+        self._geometry = {}
+
+    def compact(self):
+        """Store this stroke's points in a PointArray, which takes a fraction of the
+        memory of a list of Points. Returns the stroke."""
+        self.Points = toPointArray(self.Points)
+        return self
+
     def drawMyself(self, color = None):
 
         board = self.getBoard()
@@ -113,12 +142,9 @@ class Stroke(AnnotatableObject):
         between points."""
         if self._length is None or force:
             if len(self.Points) > 0:
-                self._length = 0
-                prev = self.Points[0]
-                for next in self.Points:
-                    #Sum up the pairwise distance between points
-                    self._length += prev.distance(next)
-                    prev = next
+                #Sum up the pairwise distance between points
+                from Utils import GeomUtils
+                self._length = GeomUtils.pointlistLength(self.Points)
             else:
                 self._length = 0
         return self._length
@@ -160,6 +186,7 @@ class Stroke(AnnotatableObject):
         self.X = (self.BoundTopLeft.X + self.BoundBottomRight.X) / 2
         self.Y = (self.BoundTopLeft.Y + self.BoundBottomRight.Y) / 2
         self.Center = Point(self.X, self.Y)
+        self.invalidateCache()
 
     def translate(self, xDist, yDist, overWrite = False):
         "Input: Stroke, and the distance in points to translate in X- and Y-directions. Returns a new translated stroke"
@@ -177,6 +204,7 @@ class Stroke(AnnotatableObject):
             self.X = (self.BoundTopLeft.X + self.BoundBottomRight.X) / 2
             self.Y = (self.BoundTopLeft.Y + self.BoundBottomRight.Y) / 2
             self.Center = Point(self.X, self.Y)
+            self.invalidateCache()
             return self
         else:
             pointList = []
@@ -0,0 +1,169 @@
+"""
+description:
+   A uniform grid over the bounding boxes of the strokes on a board, so that
+   Board.FindStrokes and friends only look at strokes near the query region
+   instead of every stroke on the board.
+
+   Each stroke is listed in every grid cell its bounding box overlaps. Queries
+   collect the strokes from the cells overlapping the query's bounding box, then
+   apply the exact test. Results are returned in the order the strokes were
+   added (as in Board.Strokes).
+
+   The index records each stroke's bounding box when it is added. Strokes on a
+   board must not be moved in place; replace them with Board.EditStroke.
+
+Doctest Examples:
+
+>>> from SketchFramework.Point import Point
+>>> from SketchFramework.Stroke import Stroke
+>>> idx = StrokeIndex(cellSize = 10)
+>>> s1 = Stroke([Point(0, 0), Point(10, 10)])
+>>> s2 = Stroke([Point(100, 0), Point(150, 50)])
+>>> idx.add(s1); idx.add(s2)
+>>> idx.nearCenter(0, 0, 10) == [s1]
+True
+>>> idx.touchingCircle(0, 0, 1) == [s1]
+True
+>>> idx.inRect(Point(-5, 200), Point(120, 30)) == [s2]
+True
+>>> idx.inRect(Point(-5, 200), Point(120, 30), anyPoint = True)
+[]
+>>> idx.overlapping(10, 10, 100, 20) == [s1, s2]
+True
+"""
+
+import math
+
+from Utils.GeomUtils import pointDistance
+
+#--------------------------------------------
+class StrokeIndex(object):
+    "Grid of cellSize x cellSize cells over the bounding boxes of a set of strokes"
+
+    def __init__(self, cellSize = 64):
+        self.cellSize = float(cellSize)
+        self._cells = {} #(column, row) : set of strokes overlapping that cell
+        self._entries = {} #stroke : (sequence number, list of its cells)
+        self._nextSeq = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, stroke):
+        return stroke in self._entries
+
+    def add(self, stroke, seq = None):
+        """Index stroke. Strokes without points are kept, but never match a query."""
+        if stroke in self._entries:
+            self.remove(stroke)
+        if seq is None:
+            seq = self._nextSeq
+            self._nextSeq += 1
+        cells = []
+        box = self.boxOf(stroke)
+        if box is not None:
+            cells = self._cellKeys(*box)
+            for key in cells:
+                self._cells.setdefault(key, set()).add(stroke)
+        self._entries[stroke] = (seq, cells, box)
+
+    def boxOf(self, stroke):
+        """The (left, bottom, right, top) box to index stroke under, or None.
+        Override to index other objects by their own extent."""
+        if len(stroke.Points) == 0:
+            return None
+        return (stroke.BoundTopLeft.X, stroke.BoundBottomRight.Y,
+                stroke.BoundBottomRight.X, stroke.BoundTopLeft.Y)
+
+    def remove(self, stroke):
+        "Remove stroke from the index, if it is there"
+        seq, cells, box = self._entries.pop(stroke, (None, [], None))
+        for key in cells:
+            cellStrokes = self._cells[key]
+            cellStrokes.discard(stroke)
+            if len(cellStrokes) == 0:
+                del(self._cells[key])
+
+    def replace(self, oldStroke, newStroke):
+        "Index newStroke in oldStroke's place (and order)"
+        seq = self._entries.get(oldStroke, (None, [], None))[0]
+        self.remove(oldStroke)
+        self.add(newStroke, seq = seq)
+
+    def nearCenter(self, x, y, radius):
+        "Strokes whose center is less than radius from (x, y)"
+        return self._ordered([s for s in self._candidates(x - radius, y - radius, x + radius, y + radius)
+                                if pointDistance(s.X, s.Y, x, y) < radius])
+
+    def touchingCircle(self, x, y, radius):
+        "Strokes with any point less than radius from (x, y)"
+        retList = []
+        for s in self._candidates(x - radius, y - radius, x + radius, y + radius):
+            for p in s.Points:
+                if pointDistance(p.X, p.Y, x, y) < radius:
+                    retList.append(s)
+                    break
+        return self._ordered(retList)
+
+    def inRect(self, topLeft, bottomRight, anyPoint = False):
+        """Strokes whose bounding box overlaps the rectangle from topLeft to
+        bottomRight (Y increases upwards), or with anyPoint, strokes with a point
+        inside it"""
+        left, top, right, bottom = topLeft.X, topLeft.Y, bottomRight.X, bottomRight.Y
+        strokes = self.overlapping(left, bottom, right, top)
+        if not anyPoint:
+            return strokes
+        retList = []
+        for s in strokes:
+            for p in s.Points:
+                if left <= p.X <= right and bottom <= p.Y <= top:
+                    retList.append(s)
+                    break
+        return retList
+
+    def overlapping(self, left, bottom, right, top):
+        "Indexed objects whose box overlaps (or touches) the box from (left, bottom) to (right, top)"
+        retList = []
+        for s in self._candidates(left, bottom, right, top):
+            sLeft, sBottom, sRight, sTop = self._entries[s][2]
+            if sRight < left or sLeft > right or sTop < bottom or sBottom > top:
+                continue
+            retList.append(s)
+        return self._ordered(retList)
+
+    def _cellRange(self, left, bottom, right, top):
+        "The first and last columns and rows of the cells overlapping the box"
+        return (int(math.floor(left / self.cellSize)), int(math.floor(right / self.cellSize)),
+                int(math.floor(bottom / self.cellSize)), int(math.floor(top / self.cellSize)))
+
+    def _cellKeys(self, left, bottom, right, top):
+        c0, c1, r0, r1 = self._cellRange(left, bottom, right, top)
+        return [(c, r) for c in range(c0, c1 + 1) for r in range(r0, r1 + 1)]
+
+    def _candidates(self, left, bottom, right, top):
+        "Strokes in the cells overlapping the box, each once"
+        candidates = set()
+        if left > right or bottom > top:
+            return candidates
+        #Don't walk more empty cells than there are occupied ones
+        c0, c1, r0, r1 = self._cellRange(left, bottom, right, top)
+        if (c1 - c0 + 1) * (r1 - r0 + 1) > len(self._cells):
+            for (c, r), cellStrokes in self._cells.items():
+                if c0 <= c <= c1 and r0 <= r <= r1:
+                    candidates.update(cellStrokes)
+        else:
+            for key in self._cellKeys(left, bottom, right, top):
+                cellStrokes = self._cells.get(key, None)
+                if cellStrokes is not None:
+                    candidates.update(cellStrokes)
+        return candidates
+
+    def _ordered(self, strokes):
+        return sorted(strokes, key = lambda s: self._entries[s][0])
+
+#-------------------------------------
+# if executed by itself, run all the doc tests
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,83 @@
+"""Pluggable destinations for the debug images written by the vision pipeline.
+
+* NullSink drops everything and is the default, so production requests do no
+  debug disk I/O at all.
+* ImageSink writes each image synchronously with ImageUtils.saveimg.
+* AsyncImageSink copies the image and hands it to a writer thread through a
+  bounded queue. When the queue is full the image is dropped rather than
+  blocking the request.
+
+ImageSink and AsyncImageSink take a sampleRate (0-1): beginRequest() decides
+once per request whether that request's images are kept."""
+from Utils import Logger
+from Utils.ImageUtils import saveimg
+import Queue
+import cv
+import random
+import threading
+
+log = Logger.getLogger("DbgSink", Logger.DEBUG)
+
+class NullSink(object):
+    "Debug sink that ignores everything"
+    enabled = False
+
+    def beginRequest(self):
+        """Called at the start of each request. Returns whether debug images
+        should be generated for it."""
+        return False
+
+    def save(self, cv_img, name="", outdir="./temp/", filename=None):
+        "Store a debug image. Arguments are the same as ImageUtils.saveimg"
+        pass
+
+    def close(self):
+        "Flush any pending images and release resources"
+        pass
+
+class ImageSink(NullSink):
+    "Debug sink that writes images synchronously"
+    enabled = True
+
+    def __init__(self, sampleRate = 1.0):
+        self.sampleRate = sampleRate
+
+    def beginRequest(self):
+        return self.sampleRate >= 1.0 or random.random() < self.sampleRate
+
+    def save(self, cv_img, name="", outdir="./temp/", filename=None):
+        saveimg(cv_img, name=name, outdir=outdir, filename=filename)
+
+class AsyncImageSink(ImageSink):
+    """Debug sink that writes images from a background thread. At most maxQueued
+    images wait to be written; any more are counted in self.dropped and discarded."""
+    def __init__(self, sampleRate = 1.0, maxQueued = 32):
+        ImageSink.__init__(self, sampleRate = sampleRate)
+        self.dropped = 0
+        self._queue = Queue.Queue(maxQueued)
+        self._thread = threading.Thread(target = self._writeImages, name = "DebugImageWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, cv_img, name="", outdir="./temp/", filename=None):
+        #Copy now: the pipeline keeps modifying its images in place
+        try:
+            self._queue.put_nowait( (cv.CloneMat(cv_img), name, outdir, filename) )
+        except Queue.Full:
+            self.dropped += 1
+            log.debug("Debug image queue full, dropping %s" % (name))
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _writeImages(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            cv_img, name, outdir, filename = item
+            try:
+                saveimg(cv_img, name=name, outdir=outdir, filename=filename)
+            except Exception as e:
+                log.warn("Could not save debug image %s: %s" % (name, e))
@@ -85,6 +85,10 @@ True
 >>> strokeDTWDist( instroke, instroke )
 0.0
 
+- with a threshold, it stops as soon as the distance is known to be at least that much
+>>> strokeDTWDist( Stroke(circlepoints), instroke, threshold = 100 ) >= 100
+True
+
 
 --- lists of strokes ---
 - computes the bounding box of a list of strokes, and returns a tuple of
@@ -97,9 +101,11 @@ True
 
 from SketchFramework.Curve import CubicCurve
 from SketchFramework.Point import Point
+from SketchFramework.PointArray import PointArray
 from SketchFramework.Stroke import Stroke
 from Utils import Logger
 import math
+import numpy
 import pdb
 import sys
 import time
@@ -111,28 +117,33 @@ logger = Logger.getLogger('GeomUtils', Logger.DEBUG )
 #--------------------------------------------------------------
 # Functions on Points
 
+def _pointsXYT(inPoints):
+    "Input: list of points (or a PointArray). Returns arrays of their X, Y and T values"
+    if isinstance(inPoints, PointArray):
+        return inPoints.X, inPoints.Y, inPoints.T
+    return ( numpy.array([p.X for p in inPoints], dtype = float),
+             numpy.array([p.Y for p in inPoints], dtype = float),
+             numpy.array([p.T for p in inPoints], dtype = float) )
+
+def _squared(values):
+    "Square an array the way ** does on floats (libm pow), which is not always bit-identical to values * values"
+    return numpy.power(values, numpy.repeat(2.0, len(values)))
+
+def _segmentLengths(X, Y):
+    "Input: arrays of point coordinates. Returns the length of each segment between them, as pointDistance"
+    return numpy.sqrt(_squared(numpy.diff(X)) + _squared(numpy.diff(Y)))
+
 # FIXME: maybe these should be functions on "cordinates" rather than points
 
 
 def pointlistAnglesVector(ptlist):
     """Return the relative angle of each point, where angle 
     counterclockwise is >0, clockwise is <0. Endpoints have 0 angle."""
-    prevAngle = None
-    prevPt = None
-    relAngles = []
-    #totalAngle = None
-    for pt in ptlist:
-        if prevPt != None:
-            absAngle = math.atan2(pt.Y - prevPt.Y, pt.X - prevPt.X) #The absolute angle from 0deg
-            if prevAngle != None:
-                relAngles.append (absAngle - prevAngle)
-            else:
-                relAngles.append(0.0)
-            prevAngle = absAngle
-        prevPt = pt
-    relAngles.append(0.0)
-    assert len(relAngles) == len(ptlist)
-    return relAngles
+    X, Y, _ = _pointsXYT(ptlist)
+    relAngles = numpy.zeros(len(X))
+    #The absolute angle from 0deg of each segment, relative to the one before
+    relAngles[1:-1] = numpy.diff(numpy.arctan2(numpy.diff(Y), numpy.diff(X)))
+    return relAngles.tolist()
 
 def pointlistAverage(ptList):
     if len(ptList) > 0:
@@ -331,46 +342,86 @@ def angleSub( a, b ):
 # Functions on Strokes
 
 def strokeApproximatePolyLine(stroke, error= 0.002):
-    """Approximate a stroke with a polyline, returned as a stroke"""
+    """Approximate a stroke with a polyline, returned as a stroke. Each line runs from the end
+    of the last one along the stroke, 1/20th of the points at a time, until the average distance
+    between it and the stroke (as strokeSumDists) is more than error * (the stroke's length)"""
     #logger.debug("Approximating Stroke with PolyLine")
-    start = 0
-    curIdx = 0
+    X, Y, _ = _pointsXYT(stroke.Points)
+    numPts = len(X)
     errorThresh = error * strokeLength(stroke) #Per point error threshold in pixels
-    end = len(stroke.Points)
-    inc = max(len(stroke.Points) / 20, 1)
-    polylinePts = []
+    inc = max(numPts / 20, 1)
+    polylineIdx = [0]
 
-    polylinePts.append(stroke.Points[0])
-
-    totalError = 0
-
-    while curIdx < len(stroke.Points) - inc :
-        startPt = stroke.Points[start]
-        prevIdx = curIdx = start
-        curPt = startPt
+    start = curIdx = 0
+    while curIdx < numPts - inc:
+        curIdx = start
         curError = 0
-        while curIdx < len(stroke.Points) - 1 \
-            and curError <= errorThresh:
-            curIdx = min(curIdx + inc, len(stroke.Points) - 1)
-            curPt = stroke.Points[curIdx]
-            subStroke = Stroke(stroke.Points[start:curIdx + 1])
-            curError = strokeSumDists(subStroke, \
-                                      Stroke([startPt, curPt]) ) / float(len(subStroke.Points))
-            prevIdx = curIdx
-            #logger.debug("Trying %s -> %s" % (start, curIdx))
-            #logger.debug("%s ?> %s" % (curError, errorThresh))
-        #logger.debug("PolyLine, using  %s->%s" % (start, curIdx))
-        totalError += curError
-        polylinePts.append(stroke.Points[prevIdx])
-        start = prevIdx
-    #logger.debug("Stroke approximated with polyline, error/pt: %s" % (totalError/len(stroke.Points) ))
-
-    return Stroke(polylinePts)
-
-
-def strokeApproximateCubicCurves(stroke, strokeLen, error = 0.005):
-    """Approximate the incoming stroke with a list of cubic curves. Optionally give a
-    point before the stroke and after the stroke for better joining of curves."""
+        while curIdx < numPts - 1 and curError <= errorThresh:
+            curIdx = min(curIdx + inc, numPts - 1)
+            curError = _lineSumDists(X, Y, start, curIdx) / float(curIdx + 1 - start)
+        polylineIdx.append(curIdx)
+        start = curIdx
+
+    return Stroke([stroke.Points[i] for i in polylineIdx])
+
+def _lineSumDists(X, Y, first, last):
+    """Input: arrays of point coordinates, and the indexes of two of the points. Returns
+    strokeSumDists of the points from first to last, and the line between those two points"""
+    numPts = last + 1 - first
+    if numPts == 2:
+        return 0.0
+    subPts = pointlistNormalizeSpacing(PointArray(X[first:last + 1], Y[first:last + 1]), numPts)
+    linePts = pointlistNormalizeSpacing(PointArray(X[[first, last]], Y[[first, last]]), numPts)
+    numDists = len(subPts.X)
+    dists = numpy.sqrt(_squared(linePts.X[:numDists] - subPts.X) + _squared(linePts.Y[:numDists] - subPts.Y))
+    return float(numpy.cumsum(dists)[-1]) #Summed in order, like a loop would
+
+def strokeApproximatePolyLineDP(stroke, error= 0.01):
+    """Approximate a stroke with a polyline, returned as a stroke. The polyline's vertices are points
+    of the stroke, picked by Douglas-Peucker so that no point of the stroke is further than
+    error * (the stroke's length) from the polyline. Fewer and better placed vertices than
+    strokeApproximatePolyLine, which the trained Rubine models expect."""
+    X, Y, _ = _pointsXYT(stroke.Points)
+    if len(X) < 3:
+        return Stroke(list(stroke.Points))
+    errorThresh = error * numpy.sum(_segmentLengths(X, Y))
+    return Stroke([stroke.Points[i] for i in _douglasPeucker(X, Y, errorThresh)])
+
+def _douglasPeucker(X, Y, errorThresh):
+    "Input: arrays of point coordinates. Returns the sorted indexes of the points Douglas-Peucker keeps"
+    keep = [0, len(X) - 1]
+    spans = [(0, len(X) - 1)]
+    while len(spans) > 0:
+        first, last = spans.pop()
+        if last - first < 2:
+            continue
+        #Distance of each point between first and last from the line through them
+        dx, dy = X[last] - X[first], Y[last] - Y[first]
+        relX, relY = X[first + 1 : last] - X[first], Y[first + 1 : last] - Y[first]
+        chord = math.sqrt(dx * dx + dy * dy)
+        if chord == 0:
+            dists = numpy.sqrt(relX * relX + relY * relY)
+        else:
+            dists = numpy.abs(relX * dy - relY * dx) / chord
+        farthest = int(numpy.argmax(dists))
+        if dists[farthest] > errorThresh:
+            split = first + 1 + farthest
+            keep.append(split)
+            spans.append( (first, split) )
+            spans.append( (split, last) )
+    return sorted(keep)
+
+CUBIC_LEAST_SQUARES = False #Fit cubic curves by least squares (see _fitCubicCurve). The trained Rubine models expect the grid search fit
+
+def strokeApproximateCubicCurves(stroke, strokeLen, error = 0.005, leastSquares = None):
+    """Approximate the incoming stroke with a list of cubic curves. Each curve covers as many
+    points as it can while its average error per point stays within error * strokeLen (and at
+    least a pixel). The curves are fit by least squares if leastSquares is set (defaults to
+    CUBIC_LEAST_SQUARES), and by strokeApproximateSingleCurve's grid search otherwise."""
+    if leastSquares is None:
+        leastSquares = CUBIC_LEAST_SQUARES
+    if leastSquares:
+        return _leastSquaresCubicCurves(stroke, strokeLen, error)
 
     #logger.debug("Approximating stroke with curves")
     #strokeLen = strokeLength(stroke)
@@ -382,21 +433,21 @@ def strokeApproximateCubicCurves(stroke, strokeLen, error = 0.005):
     subStroke = Stroke(stroke.Points[start:end+1])
     totalError = 0.0
     while start < end:
-	if start > 0:
-	    prePt = stroke.Points[start - 1]
-	else:
-	    prePt = None
+        if start > 0:
+            prePt = stroke.Points[start - 1]
+        else:
+            prePt = None
 
         #subErrorThresh = max(len(subStroke.Points) * error, 1.0)
         subError = errorThresh + 1
 
         while subError > errorThresh and end > start:
-	    #logger.debug( "Trying %s -> %s" % (start, end) )
-	    subStroke = Stroke(stroke.Points[start:end+1])
-	    if end < len(stroke.Points) - 1:
-		postPt = stroke.Points[end + 1]
-	    else:
-		postPt = None
+            #logger.debug( "Trying %s -> %s" % (start, end) )
+            subStroke = Stroke(stroke.Points[start:end+1])
+            if end < len(stroke.Points) - 1:
+                postPt = stroke.Points[end + 1]
+            else:
+                postPt = None
             curve = strokeApproximateSingleCurve(subStroke, strokeLength(subStroke), prePt = prePt, postPt = postPt)
             subError = strokeSumDists(subStroke, curve.toStroke()) / float(len(subStroke.Points))
             end -= inc
@@ -409,6 +460,89 @@ def strokeApproximateCubicCurves(stroke, strokeLen, error = 0.005):
 
     return allCurves
 
+def _leastSquaresCubicCurves(stroke, strokeLen, error):
+    """strokeApproximateCubicCurves with each curve a least squares fit to a run of the stroke's
+    points (see _fitCubicCurve), covering as many points as a binary search finds it can"""
+    #logger.debug("Approximating stroke with curves")
+    errorThresh = max(error * strokeLen, 1.0)
+    X, Y, _ = _pointsXYT(stroke.Points)
+    last = len(X) - 1
+    allCurves = []
+    start = 0
+    while start < last:
+        end = last
+        curve, curError = _fitCubicCurve(X, Y, start, end)
+        if curError > errorThresh:
+            #Two points always fit. Assume the error grows with the number of points fit.
+            goodEnd, badEnd = start + 1, end
+            curve, curError = _fitCubicCurve(X, Y, start, goodEnd)
+            while badEnd - goodEnd > 1:
+                mid = (goodEnd + badEnd) / 2
+                midCurve, midError = _fitCubicCurve(X, Y, start, mid)
+                if midError <= errorThresh:
+                    goodEnd, curve = mid, midCurve
+                else:
+                    badEnd = mid
+            end = goodEnd
+        allCurves.append(curve)
+        start = end
+    return allCurves
+
+def _fitCubicCurve(X, Y, start, end):
+    """Input: arrays of point coordinates, and the indexes of the first and last points to fit.
+    Returns a CubicCurve through the first and last points, and its average distance from the points.
+    The inner control points go along the tangents at each end (through the points before start and
+    after end, as pointGetTangentLine) at the distances that fit the points best in the least squares
+    sense, with the points spread along the curve by chord length [Schneider90]."""
+    P = numpy.column_stack( (X[start:end + 1], Y[start:end + 1]) )
+    p0, p3 = P[0], P[-1]
+    chordLen = math.sqrt(numpy.sum((p3 - p0) ** 2))
+    prePt, postPt = p0, p3
+    if start > 0:
+        prePt = numpy.array( (X[start - 1], Y[start - 1]) )
+    if end < len(X) - 1:
+        postPt = numpy.array( (X[end + 1], Y[end + 1]) )
+    tangent1 = _unitVector(P[1] - prePt)
+    tangent2 = _unitVector(P[-2] - postPt)
+
+    #Chord length parameter of each point
+    params = numpy.concatenate( ([0.0], numpy.cumsum(numpy.sqrt(numpy.sum(numpy.diff(P, axis = 0) ** 2, axis = 1)))) )
+    if params[-1] > 0:
+        params = params / params[-1]
+    else:
+        params = numpy.linspace(0, 1, len(P))
+    u = params[:, numpy.newaxis]
+    b0, b1, b2, b3 = (1 - u) ** 3, 3 * (1 - u) ** 2 * u, 3 * (1 - u) * u ** 2, u ** 3
+
+    #Solve for the distances of the control points along the tangents
+    A1 = b1 * tangent1
+    A2 = b2 * tangent2
+    residual = P - (b0 + b1) * p0 - (b2 + b3) * p3
+    c11, c12, c22 = numpy.sum(A1 * A1), numpy.sum(A1 * A2), numpy.sum(A2 * A2)
+    x1, x2 = numpy.sum(A1 * residual), numpy.sum(A2 * residual)
+    det = c11 * c22 - c12 * c12
+    alpha1 = alpha2 = 0.0
+    if det != 0:
+        alpha1 = (x1 * c22 - x2 * c12) / det
+        alpha2 = (c11 * x2 - c12 * x1) / det
+    if alpha1 <= 1e-6 * chordLen or alpha2 <= 1e-6 * chordLen:
+        #No good fit along the tangents, use a third of the chord
+        alpha1 = alpha2 = chordLen / 3.0
+    p1 = p0 + alpha1 * tangent1
+    p2 = p3 + alpha2 * tangent2
+
+    fit = b0 * p0 + b1 * p1 + b2 * p2 + b3 * p3
+    curError = numpy.mean(numpy.sqrt(numpy.sum((fit - P) ** 2, axis = 1)))
+    curve = CubicCurve(Point(*p0), Point(*p1), Point(*p2), Point(*p3))
+    return curve, float(curError)
+
+def _unitVector(vect):
+    "Input: array vector. Returns it scaled to length 1, or as is if it is 0"
+    length = math.sqrt(numpy.sum(vect ** 2))
+    if length == 0:
+        return vect
+    return vect / length
+
     
 def lineGetPoint(line, dist):
     """Get a point that is dist from the starting point along line"""
@@ -459,8 +593,6 @@ def strokeApproximateSingleCurve(sNorm, strokeLen, prePt = None, postPt = None):
     #print "Best stretch: %s" % (str(bestStretch))
     return bestCurve
 
-
-    
 def strokeContainsStroke(outerStk, innerStk, granularity = None):
     "Returns whther outerStk contains innerStk"
     #if granularity == None:
@@ -526,87 +658,64 @@ def pointlistSegments( inPoints ):
 def strokeGetPointsCurvature( inStroke ):
     "Input: stroke. Returns a list of curvatures at each point. *CAUTION* Endpoints have -1 curvature! "
     endPointCurvature = -1
-    prev_vect = None
-    prev_pt = None
-    curvature_list = []
-    if len(inStroke.Points) > 0: #Handle the nonsense curvature at the first point
-       curvature_list.append(endPointCurvature)
-
-    for point in inStroke.Points:
-	if prev_pt != point:
-	    if prev_vect == None:
-		if prev_pt is not None:
-		    prev_vect = (point.X - prev_pt.X, point.Y - prev_pt.Y)
-		prev_pt = point
-		continue
-	    vector = [point.X - prev_pt.X, point.Y - prev_pt.Y]
-	    if vector == (0.0, 0.0) or prev_vect == (0.0, 0.0):
-		curvature = 0.0
-	    else:
-		curvature = vectorDistance(vector, prev_vect)
-	    curvature_list.append(curvature)
-	    prev_vect = vector
-        prev_pt = point
-
-    if len(inStroke.Points) > 1: #Nonsense curvature for the last point
+    X, Y, _ = _pointsXYT(inStroke.Points)
+    if len(X) == 0:
+        return []
+    dX = numpy.diff(X)
+    dY = numpy.diff(Y)
+    # skip repeated points (as Point's != does)
+    moved = (numpy.abs(dX) >= 0.0001) | (numpy.abs(dY) >= 0.0001)
+    dX, dY = dX[moved], dY[moved]
+    # the angle between each vector and the one before it, as vectorDistance
+    mags = numpy.sqrt(_squared(dX) + _squared(dY))
+    cosines = (dX[1:] * dX[:-1] + dY[1:] * dY[:-1]) / (mags[1:] * mags[:-1])
+
+    curvature_list = [endPointCurvature] #Handle the nonsense curvature at the first point
+    curvature_list.extend([math.acos(round(c, 5)) for c in cosines.tolist()])
+    if len(X) > 1: #Nonsense curvature for the last point
        curvature_list.append(endPointCurvature)
-
-    #assert len(curvature_list) == len(inStroke.Points), "%s != %s" % (len(curvature_list), len(inStroke.Points))
     return curvature_list
 
-
 def pointlistNormalizeSpacing(inPoints, numpoints):
-    """Input, a list of points and the number of points that should be generated"""
-    normalized_points = []
-
-    # calculate the total euclidean distance traveled
-    total_dist = float(pointlistLength(inPoints))
+    """Input, a list of points and the number of points that should be generated.
+    Returns a list of points (a PointArray for a PointArray)"""
+    X, Y, T = _pointsXYT(inPoints)
+    # the distance walked along the points at the end of each segment
+    seg_dists = _segmentLengths(X, Y)
+    cum_dists = numpy.cumsum(seg_dists)
+    total_dist = 0.0
+    if len(cum_dists) > 0:
+        total_dist = float(cum_dists[-1])
 
     #Single point strokes case
     if len(inPoints) == 1 or numpoints <= 1 or total_dist == 0: 
+        if isinstance(inPoints, PointArray):
+            idx = numpy.zeros(int(numpoints), dtype = int)
+            return PointArray(X[idx], Y[idx], T[idx])
         return int(numpoints) * [inPoints[0]]
         
-    # set the new distance between points
+    # set the new distance between points, and how far along each new point goes
+    # (summed up one gap at a time)
     gap = total_dist/( numpoints - 1)
-    # turn the list of point into a list of line segements
-    segments = pointlistSegments( inPoints )
-
-    # start at first point
-    i = 0; current_dist = 0; 
-    # the first point in the new list of points should be the same as the old
-    normalized_points.append( inPoints[0] ) 
-
-    # for each new segment (which should be end at length target_dist)
     stop_dist = total_dist * (1 - (1/(2*float(numpoints))) )
-    # target_dist will be the running total distance done so far
-    target_dist = gap
-    while target_dist < stop_dist :
-
-        # walk until we hit the segment containing the target dist
-        while current_dist<target_dist:
-            (ax,ay),(bx,by) = segments[i]
-            current_dist += pointDistance(ax,ay,bx,by)
-            i += 1
-            # now we should know that segment i-1 contains the best stopping point
-            target_seg = segments[i-1]
-            (p1x,p1y),(p2x,p2y) = target_seg
-
-        # find the new best point in the middle of that segment
-        # figure out how much we overshot the target
-        overshot_dist = current_dist - target_dist;
-        seg_dist = pointDistance( p1x,p1y, p2x,p2y );
-
-        # the new point should lie on that last segment
-        newx = ( (p1x*overshot_dist) + (p2x*(seg_dist-overshot_dist)) ) / float(seg_dist)
-        newy = ( (p1y*overshot_dist) + (p2y*(seg_dist-overshot_dist)) ) / float(seg_dist)
-
-	# add this new point to the list        
-        normalized_points.append( Point(newx,newy) )
-
-        # move on to the next point
-        target_dist += gap
-    # make sure not to drop that last point
-    normalized_points.append( inPoints[-1] ) # should be final point 
+    target_dists = numpy.cumsum(numpy.repeat(gap, int(numpoints) + 2))
+    target_dists = target_dists[target_dists < stop_dist]
+
+    # each new point lies on the first segment that ends at least that far along
+    seg_idx = numpy.searchsorted(cum_dists, target_dists)
+    overshot_dists = cum_dists[seg_idx] - target_dists
+    seg_lens = seg_dists[seg_idx]
+    newX = ( (X[seg_idx] * overshot_dists) + (X[seg_idx + 1] * (seg_lens - overshot_dists)) ) / seg_lens
+    newY = ( (Y[seg_idx] * overshot_dists) + (Y[seg_idx + 1] * (seg_lens - overshot_dists)) ) / seg_lens
+
+    # the first and last points stay the same
+    if isinstance(inPoints, PointArray):
+        return PointArray(numpy.concatenate(([X[0]], newX, [X[-1]])),
+                          numpy.concatenate(([Y[0]], newY, [Y[-1]])),
+                          numpy.concatenate(([T[0]], numpy.zeros(len(newX)), [T[-1]])))
+    normalized_points = [ inPoints[0] ]
+    normalized_points.extend( [ Point(x, y) for x, y in zip(newX.tolist(), newY.tolist()) ] )
+    normalized_points.append( inPoints[-1] )
     return normalized_points
 
 def strokeNormalizeSpacing( inStroke, numpoints=None):
@@ -621,14 +730,10 @@ def strokeNormalizeSpacing( inStroke, numpoints=None):
     
 def pointlistLength(inPoints):
     """Input: List of points. Returns the total length of the path"""
-    totalLength = 0.0
-    for i in range(0, len(inPoints) - 1):
-        cur = inPoints[i]
-        nxt = inPoints[i + 1]
-        
-        totalLength += vectorLength(cur.X - nxt.X, cur.Y - nxt.Y)
-        
-    return totalLength
+    if len(inPoints) < 2:
+        return 0.0
+    X, Y, _ = _pointsXYT(inPoints)
+    return float(numpy.cumsum(_segmentLengths(X, Y))[-1]) #Summed in order, like a loop would
 
 def strokeLength(inStroke):
     "Input: Stroke.  Returns the total length of the stroke by summing up all of the segments."
@@ -711,13 +816,117 @@ def strokeSmooth(inStroke, width = 1, preserveEnds = False):
     outPoints = _smooth(inPoints, width = width, preserveEnds = preserveEnds)
     return Stroke(outPoints)
 
-def strokeDTWDist( testStroke, refStroke):
-    "Input: 2 strokes, a cost function Return the Dynamic-Time-Warping distance between this and the reference stroke."
-
-    INFINITY = 1e300
+DTW_BAND = 0.1 #Sakoe-Chiba band: how far (as a fraction of each stroke) a DTW alignment may stray from the diagonal
 
+def strokeDTWDist( testStroke, refStroke, threshold = None):
+    """Input: 2 strokes, and optionally a threshold. Return the Dynamic-Time-Warping distance between this and the reference stroke.
+    With a threshold, gives up as soon as the distance is known to be at least threshold, and returns that lower bound (>= threshold) instead."""
     ref_angles =  strokeLineSegOrientations( refStroke, normalize=True )
     test_angles = strokeLineSegOrientations( testStroke, normalize=True )
+    return _DTWDist(ref_angles, test_angles, threshold)
+
+def strokeDTWDists( testStroke, refStrokes, threshold = None):
+    "Input: a stroke and a list of reference strokes. Returns a list of the strokeDTWDist from testStroke to each reference stroke."
+    test_angles = strokeLineSegOrientations( testStroke, normalize=True )
+    return [_DTWDist(strokeLineSegOrientations( ref, normalize=True ), test_angles, threshold) for ref in refStrokes]
+
+def strokeDTWNearest( testStroke, refStrokes, threshold = None):
+    """Input: a stroke and a list of reference strokes. Returns (index, distance) of the reference stroke with the smallest
+    strokeDTWDist from testStroke, or (None, None) if none is less than threshold. Each comparison gives up as soon as
+    it can't beat the nearest stroke so far."""
+    test_angles = strokeLineSegOrientations( testStroke, normalize=True )
+    nearest = (None, None)
+    for idx, ref in enumerate(refStrokes):
+        dist = _DTWDist(strokeLineSegOrientations( ref, normalize=True ), test_angles, threshold)
+        if threshold is None or dist < threshold:
+            nearest = (idx, dist)
+            threshold = dist
+    return nearest
+
+def _DTWDist( ref_angles, test_angles, threshold = None ):
+    """Input: lists of segment orientations. Returns their DTW distance, computed only inside the DTW_BAND band,
+    one anti-diagonal of the DTW matrix at a time. The cells of an anti-diagonal only depend on the two before it,
+    so each anti-diagonal is computed at once."""
+    INFINITY = 1e300
+    n = len(ref_angles)
+    m = len(test_angles)
+    if n == 0 or m == 0:
+        return _DTWDistFull(ref_angles, test_angles)
+
+    #The DTW matrix stores the first computed element at 1,1 (not 0,0). Anti-diagonal d holds the
+    #   cells (i, d - i), and its cells inside the band are rows lo[d] to hi[d]
+    diags = numpy.arange(2, n + m + 1)
+    lo, hi = _DTWBandRows(diags, n, m)
+    if numpy.any(lo > hi):
+        #The band doesn't connect the ends of the matrix
+        return _DTWDistFull(ref_angles, test_angles)
+    width = int(numpy.max(hi - lo)) + 1
+
+    #The costs of every cell in the band, at once, as _DTWCostFunc
+    rows = lo[:, numpy.newaxis] + numpy.arange(width)
+    outside = rows > hi[:, numpy.newaxis]
+    ref = numpy.array([angleNormalize(a) for a in ref_angles], dtype = float)
+    test = numpy.array([angleNormalize(a) for a in test_angles], dtype = float)
+    basediff = numpy.abs(ref[numpy.minimum(rows, n) - 1] - test[numpy.maximum(diags[:, numpy.newaxis] - rows, 1) - 1])
+    diff = numpy.minimum(basediff, numpy.abs(basediff - 360))
+    costs = diff * diff
+    halfCosts = costs / 2
+
+    #dtw[d] holds anti-diagonal d, starting at row lo[d], padded with INFINITY on both sides
+    PAD = 2
+    lo = [0, 0] + lo.tolist()
+    dtw = numpy.empty( (n + m + 1, width + 2 * PAD) )
+    dtw.fill(INFINITY)
+    dtw[0, PAD] = 0
+    for d in range(2, n + m + 1):
+        prevShift = PAD + lo[d] - lo[d - 1] - 1
+        prevPrevShift = PAD + lo[d] - lo[d - 2] - 1
+        insertion = dtw[d - 1, prevShift : prevShift + width] + halfCosts[d - 2]
+        deletion = dtw[d - 1, prevShift + 1 : prevShift + 1 + width] + halfCosts[d - 2]
+        match = dtw[d - 2, prevPrevShift : prevPrevShift + width] + costs[d - 2]
+        cells = dtw[d, PAD : PAD + width]
+        numpy.minimum(numpy.minimum(insertion, deletion), match, out = cells)
+        cells[outside[d - 2]] = INFINITY
+
+        if threshold is not None:
+            #Every path crosses anti-diagonal d - 1 or d
+            bound = min(cells.min(), dtw[d - 1].min())
+            if INFINITY > bound >= threshold:
+                return float(bound)
+
+    retval = dtw[n + m, PAD + n - lo[n + m]]
+    if retval >= INFINITY:
+        return _DTWDistFull(ref_angles, test_angles)
+    return float(retval)
+
+def _DTWBandRows( diags, n, m ):
+    """Input: array of anti-diagonal indexes, and the DTW matrix size. Returns arrays of the first and last row
+    of each anti-diagonal inside the band (as _DTWCostFunc), and outside the matrix's edges"""
+    def inBand(rows):
+        return numpy.abs((rows - 1) / float(n) - (diags - rows - 1) / float(m)) <= DTW_BAND
+    rowMin = numpy.maximum(1, diags - m)
+    rowMax = numpy.minimum(n, diags - 1)
+    #The band's edges, from a little outside, moved in until they are inside it
+    scale = 1.0 / n + 1.0 / m
+    lo = numpy.floor(((diags - 2) / float(m) - DTW_BAND) / scale).astype(int) - 1
+    hi = numpy.ceil(((diags - 2) / float(m) + DTW_BAND) / scale).astype(int) + 3
+    lo = numpy.minimum(numpy.maximum(lo, rowMin), rowMax + 1)
+    hi = numpy.maximum(numpy.minimum(hi, rowMax), rowMin - 1)
+    while True:
+        move = (lo <= hi) & ~inBand(lo)
+        if not move.any():
+            break
+        lo[move] += 1
+    while True:
+        move = (lo <= hi) & ~inBand(hi)
+        if not move.any():
+            break
+        hi[move] -= 1
+    return lo, hi
+
+def _DTWDistFull( ref_angles, test_angles ):
+    "Input: lists of segment orientations. Returns their DTW distance, computing every cell of the DTW matrix"
+    INFINITY = 1e300
 
     # the dtw matrix stores the first computed element at 1,1 (not 0,0)
     n = len(ref_angles)
@@ -741,7 +950,7 @@ def strokeDTWDist( testStroke, refStroke):
 def _DTWCostFunc( a, b, i, j, n, m ):
         diff = angleDiff( a,b )
         c = diff * diff  
-        if ( abs( (i/float(n)) - (j/float(m)) ) > 0.1 ): return 1e30  
+        if ( abs( (i/float(n)) - (j/float(m)) ) > DTW_BAND ): return 1e30  
         return c 
 
 def strokeMonotonicity(inStroke):
@@ -1053,44 +1262,41 @@ def _smooth(inPoints, width = 1, preserveEnds = False):
     if len(inPoints) < 3:
         logger.debug("trying to smooth less than three points")
         return inPoints
-    newPoints = []
 
     #Double the amount of points, and then smooth that.
-    for i in range(0, len(inPoints) - 1):
-        cur = inPoints[i]
-        nxt = inPoints[i + 1]
-        newPoints.append(cur)
-
-        avgpt = Point((cur.X + nxt.X) / 2.0, (cur.Y + nxt.Y) / 2.0, (cur.T + nxt.T) / 2.0)
-        newPoints.append(avgpt)
-
-    newPoints.append(inPoints[len(inPoints) - 1]) #add the last point into the list, but do NOT add in a point between the first & last.
+    #Add the midpoint after every point but the last (do NOT add in a point between the first & last).
     #TODO: Maybe instead of disregarding it, check to see if stroke is a closedAnno, and if so, smooth between beginning and end?
+    doubled = []
+    for vals in _pointsXYT(inPoints):
+        dbl = numpy.empty(2 * len(vals) - 1)
+        dbl[0::2] = vals
+        dbl[1::2] = (vals[:-1] + vals[1:]) / 2.0
+        doubled.append(dbl)
+    numNew = len(doubled[0])
 
     #Decision time: Smooth and modify both new and old points, or old points only?  Currently does both
-    finalPoints = []
-    #finalPoints.append(newPoints[0]) # First Point remains unchanged... See above TODO to possibly contradict this statement
-
-    #new and old point smoothing
-    for i in range(len(newPoints)):
-        pointRange = range( max(0, i - width), min (len(newPoints), i + 1 + width) )  #Average over a range
-        pointListX = [newPoints[j].X for j in pointRange]
-        pointListY = [newPoints[j].Y for j in pointRange]
-        pointListT = [newPoints[j].T for j in pointRange]
-        if preserveEnds:
-            while len(pointListX) < (2 * width + 1):
-                pointListX.append(newPoints[i].X)
-                pointListY.append(newPoints[i].Y)
-                pointListT.append(newPoints[i].T)
-
-        x = sum(pointListX) / float(len(pointListX))
-        y = sum(pointListY) / float(len(pointListY))
-        t = sum(pointListT) / float(len(pointListT))
-        finalPoints.append( Point(x,y,t) )
-
-    #finalPoints.append(newPoints[len(newPoints) - 1]) #As with first point remaining unchanged...
-    return finalPoints
-
+    #Average each point over the points up to width away, adding them up in order
+    idx = numpy.arange(numNew)
+    counts = numpy.zeros(numNew)
+    sums = [numpy.zeros(numNew) for _ in doubled]
+    for offset in range(-width, width + 1):
+        inRange = (idx + offset >= 0) & (idx + offset < numNew)
+        src = numpy.clip(idx + offset, 0, numNew - 1)
+        counts += inRange
+        for total, dbl in zip(sums, doubled):
+            total += numpy.where(inRange, dbl[src], 0.0)
+    if preserveEnds:
+        #Pad the averages near the ends with the point itself
+        for pad in range(2 * width):
+            needPad = counts < (2 * width + 1)
+            counts += needPad
+            for total, dbl in zip(sums, doubled):
+                total += numpy.where(needPad, dbl, 0.0)
+    finalX, finalY, finalT = [s / counts for s in sums]
+
+    if isinstance(inPoints, PointArray):
+        return PointArray(finalX, finalY, finalT)
+    return [ Point(x, y, t) for x, y, t in zip(finalX.tolist(), finalY.tolist(), finalT.tolist()) ]
 
 def perimeter(inPoints):
     "Input: List inPoints.  returns the perimeter of the input set of points."
@@ -15,16 +15,18 @@ import pdb
 import sys
 import math
 import traceback
-import random
+import os
+import re
+import struct
 import time
 from Utils import Logger
 from Utils import GeomUtils
 from Utils.Timer import Timed
 
-from multiprocessing import Process, Queue
 from functools import partial
 
 from SketchFramework.Point import Point
+from SketchFramework.PointArray import PointArray
 from SketchFramework.Stroke import Stroke
 
 from xml.etree import ElementTree as ET
@@ -36,6 +38,7 @@ rb_logger = Logger.getLogger('Rubine', Logger.WARN )
 #------------------------------------------------------------
 class FeatureSet(object):
     """An abstract class for running sets of feature methods on strokes"""
+    VERSION = 3 #Increase when the features change, to invalidate cached vectors
     def __init__(self):
         rb_logger.debug("Using Feature set %s" % (self.__class__.__name__))
         pass
@@ -46,13 +49,191 @@ class FeatureSet(object):
         """Return how many feature values are in a vector"""
         return 0
 
+    def geometry(self, stroke):
+        """The shared intermediate geometry of a stroke. See strokeGeometry"""
+        return strokeGeometry(stroke)
+
+    def enableTiming(self):
+        """Start timing every feature method (fN or fN_M) and the shared geometry
+        stage of this feature set. See timingReport"""
+        self.featureTimes = {}
+        for name in dir(self):
+            if name == 'geometry' or FEATURE_NAME.match(name):
+                setattr(self, name, self._timedFeature(name, getattr(self, name)))
+
+    def _timedFeature(self, name, func):
+        def timedFunc(*args):
+            start = time.time()
+            retVal = func(*args)
+            total, calls = self.featureTimes.get(name, (0.0, 0))
+            self.featureTimes[name] = (total + time.time() - start, calls + 1)
+            return retVal
+        return timedFunc
+
+    def timingReport(self):
+        """Return a table of the time spent in each feature since enableTiming(),
+        slowest first. The geometry is cached on each stroke, so its time is only
+        counted by the first feature set that sees the stroke."""
+        times = getattr(self, 'featureTimes', {})
+        totalTime = sum([t for t, _ in times.values()])
+        lines = ["%-10s %7s %10s %9s %6s" % ("Feature", "Calls", "Total ms", "ms/call", "%")]
+        for name, (t, calls) in sorted(times.items(), key = lambda item: item[1][0], reverse = True):
+            lines.append("%-10s %7d %10.2f %9.3f %5.1f%%" % (name, calls, 1000 * t,
+                            1000 * t / calls, 100 * t / totalTime if totalTime > 0 else 0.0))
+        return "\n".join(lines)
+
+FEATURE_NAME = re.compile(r"^f\d+(_\d+)?$")
+
+#------------------------------------------------------------
+# Shared stroke geometry. The stroke points are converted to an (n, 2) array
+# once, and everything else is derived from that array.
+
+def _strokeArray(stroke):
+    if isinstance(stroke.Points, PointArray):
+        return stroke.Points.xy()
+    return array([(p.X, p.Y) for p in stroke.Points], dtype = float).reshape(-1, 2)
+
+def strokeArray(stroke):
+    """The stroke's points as a cached (n, 2) array of X, Y. Do not modify it."""
+    return stroke.getCachedGeometry('array', _strokeArray)
+
+def _pointsAngles(xy):
+    """Vectorized GeomUtils.pointlistAnglesVector for an (n, 2) array"""
+    deltas = diff(xy, axis = 0)
+    absAngles = arctan2(deltas[:, 1], deltas[:, 0])
+    relAngles = zeros(len(xy))
+    relAngles[1:-1] = diff(absAngles)
+    return relAngles
+
+def _pointsArea(xy):
+    """Vectorized GeomUtils.area for an (n, 2) array"""
+    nextPts = roll(xy, -1, axis = 0)
+    return math.fabs(float(((nextPts[:, 0] - xy[:, 0]) * (nextPts[:, 1] + xy[:, 1])).sum()) / 2)
+
+def _pointsDistanceFromLine(xy, line):
+    """Distances of each point in an (n, 2) array from the infinite line through
+    the two points of line, as GeomUtils.pointDistanceFromLine"""
+    ep1, ep2 = line
+    dx = ep2.X - ep1.X
+    dy = ep2.Y - ep1.Y
+    lineLen = math.sqrt(dx * dx + dy * dy)
+    if lineLen == 0:
+        return sqrt(((xy - (ep1.X, ep1.Y)) ** 2).sum(axis = 1))
+    return absolute(dy * (xy[:, 0] - ep1.X) - dx * (xy[:, 1] - ep1.Y)) / lineLen
+
+def _pointsLinearRegression(xy):
+    """GeomUtils.pointListLinearRegression for an (n, 2) array"""
+    n = float(len(xy))
+    xs = xy[:, 0]
+    ys = xy[:, 1]
+    sum_x = xs.sum()
+    sum_y = ys.sum()
+    denom = n * dot(xs, xs) - sum_x ** 2
+    if denom != 0:
+        m = ( n * dot(xs, ys) - sum_y * sum_x ) / denom
+        b = (sum_y - sum_x * m) / n
+        minX = xs.min()
+        maxX = xs.max()
+        return (Point(minX, minX * m + b), Point(maxX, maxX * m + b))
+    else:
+        avgX = sum_x / n
+        return (Point(avgX, ys.min()), Point(avgX, ys.max()))
+
+def _pointsSelfIntersections(xy, blockSize = 256):
+    """Count the crossings between the segments of an (n, 2) polyline exactly as
+    BCPFeatureSet.f5_1 always has: segment i is tested against segments
+    j >= min(i+1, n/3), using GeomUtils.getLinesIntersection's tests, and a
+    crossing at the first point of either segment does not count."""
+    numSegs = len(xy) - 1
+    if numSegs < 1:
+        return 0
+    starts = xy[:-1]
+    ends = xy[1:]
+    #Order each segment's endpoints by X, as getLinesIntersection does
+    swap = starts[:, 0] > ends[:, 0]
+    left = where(swap[:, newaxis], ends, starts)
+    right = where(swap[:, newaxis], starts, ends)
+    A = right[:, 1] - left[:, 1]
+    B = left[:, 0] - right[:, 0]
+    C = A * left[:, 0] + B * left[:, 1]
+    top = maximum(left[:, 1], right[:, 1])
+    bottom = minimum(left[:, 1], right[:, 1])
+
+    segIdx = arange(numSegs)
+    firstJ = minimum(segIdx + 1, len(xy) / 3)
+    count = 0
+    for blk in range(0, numSegs, blockSize):
+        i = segIdx[blk:blk + blockSize, newaxis]
+        p1x, p1y, p2x, p2y = left[i, 0], left[i, 1], right[i, 0], right[i, 1]
+        q1x, q1y, q2x, q2y = left[:, 0], left[:, 1], right[:, 0], right[:, 1]
+        candidates = (segIdx >= firstJ[i]) \
+            & ~((p1y > q1y) & (p2y > q2y) & (p1y > q2y) & (p2y > q1y)) \
+            & ~((p1y < q1y) & (p2y < q2y) & (p1y < q2y) & (p2y < q1y)) \
+            & ~(p2x < q1x) & ~(p1x > q2x)
+        det = A[i] * B - A * B[i]
+        candidates &= (det != 0.0)
+        det = where(candidates, det, 1.0)
+        crossX = (B * C[i] - B[i] * C) / det
+        crossY = (A[i] * C - A * C[i]) / det
+        candidates &= (crossY <= top[i]) & (crossY >= bottom[i]) \
+                    & (crossX >= p1x) & (crossX <= p2x) \
+                    & (crossY <= top) & (crossY >= bottom) \
+                    & (crossX >= q1x) & (crossX <= q2x)
+        #Point equality is within 0.0001
+        candidates &= ~((absolute(crossX - starts[i, 0]) < 0.0001) & (absolute(crossY - starts[i, 1]) < 0.0001))
+        candidates &= ~((absolute(crossX - starts[:, 0]) < 0.0001) & (absolute(crossY - starts[:, 1]) < 0.0001))
+        count += int(candidates.sum())
+    return count
+
+def _strokeConvexHull(stroke):
+    return Stroke(GeomUtils.convexHull(stroke.Points))
+
+def _strokeNormalized(stroke):
+    return GeomUtils.strokeNormalizeSpacing(stroke, numpoints = max(1, stroke.getCachedGeometry('length', GeomUtils.strokeLength)))
+
+def _strokeCurvature(stroke):
+    strokeLength = stroke.getCachedGeometry('length', GeomUtils.strokeLength)
+    return GeomUtils.strokeGetPointsCurvature(
+                GeomUtils.strokeSmooth(stroke, width = max(1, int(strokeLength*0.05))
+            ))
+
+def _strokeAngles(stroke):
+    return _pointsAngles(strokeArray(stroke))
+
+def _strokeTotalAngles(stroke):
+    angles = stroke.getCachedGeometry('angles', _strokeAngles)
+    return (float(angles.sum()), float(absolute(angles).sum()))
+
+def _strokeSegmentLengths(stroke):
+    return sqrt((diff(strokeArray(stroke), axis = 0) ** 2).sum(axis = 1))
+
+def _strokeArea(stroke):
+    return _pointsArea(strokeArray(stroke))
+
+def _strokeCoarseAngles(sNorm):
+    #Angles at every 30th point of the normalized stroke, for the fragment features
+    return _pointsAngles(strokeArray(sNorm)[::30]).tolist()
+
+def strokeTotalAngles(stroke):
+    """Returns the cached (total angle, total absolute angle) traversed by the stroke"""
+    return stroke.getCachedGeometry('totalAngles', _strokeTotalAngles)
+
+def strokeGeometry(stroke):
+    """Returns the intermediate geometry the BCP features share:
+    (convexHull, strokeLength, strokeNorm, boundingBox, curvatureList, anglesVector)
+    anglesVector is an array, as GeomUtils.pointlistAnglesVector. Each value is cached on the stroke (see Stroke.getCachedGeometry), so it is
+    computed once however many feature sets are run. The values are shared: do
+    not modify them."""
+    return (stroke.getCachedGeometry('convexHull', _strokeConvexHull),
+            stroke.getCachedGeometry('length', GeomUtils.strokeLength),
+            stroke.getCachedGeometry('normalized', _strokeNormalized),
+            (stroke.BoundTopLeft, stroke.BoundBottomRight),
+            stroke.getCachedGeometry('curvature', _strokeCurvature),
+            stroke.getCachedGeometry('angles', _strokeAngles),
+           )
+
 #------------------------------------------------------------
 bcp_logger = Logger.getLogger('BCPFeatureSet', Logger.WARN )
-def spawnGetResult(func, args, retQueue):
-    """Call a function and put it's result in retQueue"""
-    print "calling %s with %s" % (func.__name__, args)
-    retQueue.put(func(*args))
-    
 class BCPFeatureSet(FeatureSet):
     """Feature set found to be best for Rubine's classifier in
     Blagojevic, et al. "The Power of Automatic Feature Selection: 
@@ -61,7 +242,6 @@ class BCPFeatureSet(FeatureSet):
         FeatureSet.__init__(self)
         self.rubineSet = RubineFeatureSet()
         bcp_logger.warn("Feature f1_01 DISABLED")
-        #self.queueList = [Queue() for i in range(len(self))]
 
 
     def __len__(self):
@@ -80,37 +260,11 @@ class BCPFeatureSet(FeatureSet):
         elif len(strokeList) == 1:
             stroke = strokeList[0]
 
-        convexHull = Stroke(GeomUtils.convexHull(stroke.Points))
-        strokeLength = GeomUtils.strokeLength(stroke)
-        strokeNorm = GeomUtils.strokeNormalizeSpacing(stroke, numpoints = max(1,strokeLength))
-        boundingBox = (stroke.BoundTopLeft, stroke.BoundBottomRight)
-        curvatureList = GeomUtils.strokeGetPointsCurvature(
-                            GeomUtils.strokeSmooth(stroke, width = max(1, int(strokeLength*0.05))
-                        ))
-
-        anglesVector = GeomUtils.pointlistAnglesVector(stroke.Points)
+        convexHull, strokeLength, strokeNorm, boundingBox, curvatureList, anglesVector = \
+            self.geometry(stroke)
         #Generate the vector
         #Basic Features
-
-        # BEGINNINGS OF MULTOPROC
-        #func = self.f1_12
-        #f_args = (stroke, strokeLength)
-        #p = Process(target = spawnGetResult, args =(func, f_args, 
-        #            self.queueList[0],))
-        #p.start()
-
-        #func = self.f1_16
-        #f_args = (strokeNorm,)
-        #p = Process(target = spawnGetResult, args =(func, f_args, 
-        #            self.queueList[1],))
-        #p.start()
-
-        #func = self.f1_16
-        #f_args = (strokeNorm,)
-        #p = Process(target = spawnGetResult, args =(func, f_args, 
-        #            self.queueList[1],))
-        #p.start()
-
+        #(Parallel extraction over many examples is in Utils.RubineBatch)
         retVector = [ self.f1_12(stroke, strokeLength) , \
                      self.f1_16(strokeNorm) , \
                      self.f2_6(strokeLength, convexHull) , \
@@ -169,9 +323,7 @@ class BCPFeatureSet(FeatureSet):
     def f1_16(self, sNorm):
         """Number of fragments in a stroke, according to its corners [BSH04]"""
         #pre = time.time()
-        #sNorm = GeomUtils.strokeNormalizeSpacing(stroke, numpoints = max(1,strokeLen/30))
-        sNorm = Stroke([sNorm.Points[i] for i in range(0,len(sNorm.Points),30)])
-        angles = GeomUtils.pointlistAnglesVector(sNorm.Points)
+        angles = sNorm.getCachedGeometry('coarseAngles', _strokeCoarseAngles)
         positive = angles[0] >= 0.0
         segments = 2
         for i in range(len(angles)):
@@ -194,7 +346,7 @@ class BCPFeatureSet(FeatureSet):
     #@Timed
     def f2_6(self, strokeLen, cvxHull):
         """Stroke length / perimeter of the stroke's convex hull [FPJ02]"""
-        cvx_perimeter = GeomUtils.strokeLength(cvxHull)
+        cvx_perimeter = cvxHull.getCachedGeometry('length', GeomUtils.strokeLength)
         if cvx_perimeter > 0.0:
             return strokeLen / cvx_perimeter
         else:
@@ -215,18 +367,8 @@ class BCPFeatureSet(FeatureSet):
         """Number of self intersections at the endpoints of the stroke, adapted
         from [Qin05]"""
         #pre = time.time()
-        selfIntersections = 0
-        for i in range(len(stroke.Points)-1):
-            seg1 = (stroke.Points[i], stroke.Points[i+1])
-            for j in range(i+1, len(stroke.Points)/3) + \
-                     range(len(stroke.Points)/3, len(stroke.Points)-1):
-                seg2 = (stroke.Points[j], stroke.Points[j+1])
-                cross = GeomUtils.getLinesIntersection( seg1, seg2 )
-                if cross is not None \
-                    and cross != seg1[0] \
-                    and cross != seg2[0] :
-                    selfIntersections += 1
-	bcp_logger.debug("Self Intersections: %s" % (selfIntersections))
+        selfIntersections = _pointsSelfIntersections(strokeArray(stroke))
+        bcp_logger.debug("Self Intersections: %s" % (selfIntersections))
         #bcp_logger.debug("%s time %s" % (sys._getframe(-1).f_code.co_name, 1000 * (time.time() - pre) ))
         return selfIntersections
  
@@ -253,7 +395,7 @@ class BCPFeatureSet(FeatureSet):
         right = bbox[1].X
         bottom = bbox[1].Y
 
-        cvxArea = GeomUtils.area(cvxHull.Points)
+        cvxArea = cvxHull.getCachedGeometry('area', _strokeArea)
         bboxArea = GeomUtils.area([Point(left, bottom),
                                    Point(left, top),
                                    Point(right, top),
@@ -273,8 +415,8 @@ class BCPFeatureSet(FeatureSet):
     def f7_16(self, cvxHull):
         """Perimeter efficiency: 2 * sqrt( pi * convex hull area ) / convex hull perimeter
         [LC02]"""
-        cvxArea = GeomUtils.area(cvxHull.Points)
-        cvxPerim = GeomUtils.strokeLength(cvxHull)
+        cvxArea = cvxHull.getCachedGeometry('area', _strokeArea)
+        cvxPerim = cvxHull.getCachedGeometry('length', GeomUtils.strokeLength)
 
         if cvxPerim > 0.0:
             return 2 * math.sqrt( math.pi * cvxArea) / cvxPerim 
@@ -285,8 +427,8 @@ class BCPFeatureSet(FeatureSet):
     def f7_17(self, cvxHull):
         """Ratio of perimeter to area of the stroke's convex hull [FPJ02]"""
         #pre = time.time()
-        cvxArea = GeomUtils.area(cvxHull.Points)
-        cvxPerim = GeomUtils.strokeLength(cvxHull)
+        cvxArea = cvxHull.getCachedGeometry('area', _strokeArea)
+        cvxPerim = cvxHull.getCachedGeometry('length', GeomUtils.strokeLength)
         #bcp_logger.debug("%s time %s" % (sys._getframe(-1).f_code.co_name, 1000 * (time.time() - pre) ))
         if cvxPerim > 0.0:
             return cvxArea / float(cvxPerim)
@@ -364,9 +506,18 @@ class BCPFeatureSet(FeatureSet):
 
     #@Timed
     def f1_23(self, stroke):
-        """Total angle / sum of |Angle at each point| [LLR00]"""
+        """Total angle / sum of |Angle at each point| [LLR00]. Undefined (nan) for
+        strokes that never turn, such as a stroke of two points.
+
+        >>> BCPFeatureSet().f1_23(Stroke([Point(0, 0), Point(10, 0)]))
+        nan
+        """
         #pre = time.time()
-        retVal = self.rubineSet.f09(stroke) / float(self.rubineSet.f10(stroke))
+        totalAngle, totalAbsAngle = strokeTotalAngles(stroke)
+        if totalAbsAngle == 0:
+            #As f09 / f10 (numpy) gave before
+            return nan
+        retVal = totalAngle / totalAbsAngle
         #bcp_logger.debug("%s time %s" % (sys._getframe(-1).f_code.co_name, 1000 * (time.time() - pre) ))
         return retVal
 
@@ -415,7 +566,7 @@ class BCPFeatureSet(FeatureSet):
     def f1_04(self, stroke):
         """Sum of the absolute value of the angle at each point [Rubine91]"""
         #pre = time.time()
-        retVal = self.rubineSet.f10(stroke) / len(stroke.Points)
+        retVal = strokeTotalAngles(stroke)[1] / len(stroke.Points)
         bcp_logger.debug("F1_04: Sum of abs angle value: %s" % (retVal) )
         #bcp_logger.debug("%s time %s" % (sys._getframe(-1).f_code.co_name, 1000 * (time.time() - pre) ))
         return retVal
@@ -427,12 +578,8 @@ class BCPFeatureSet(FeatureSet):
     def f1_11(self, anglesVector):
         """Curviness. Sum of absolute value of the angle at each stroke point below 19deg 
             threshold [LLR01]"""
-        curviness = 0.0
-        for angle in anglesVector:
-            aval = 57.0 *math.fabs(angle)
-            if aval < 19:
-                curviness+= aval
-        return curviness
+        avals = 57.0 * absolute(anglesVector)
+        return float(avals[avals < 19].sum())
             
 
     #@Timed
@@ -440,13 +587,11 @@ class BCPFeatureSet(FeatureSet):
         """(Orthogonal distance squared between the least squares fitted line
         and the stroke points) / stroke length [PRD08, SSD01]"""
         #pre = time.time()
-        linRegLine = GeomUtils.pointListLinearRegression(stroke.Points)
+        points = strokeArray(stroke)
+        linRegLine = _pointsLinearRegression(points)
 
-        sumDists = 0
-        for pt in stroke.Points:
-            sumDists += GeomUtils.pointDistanceFromLine(pt, linRegLine)
-
-        sumDists /= float(len(stroke.Points))
+        sumDists = float(_pointsDistanceFromLine(points, linRegLine).sum())
+        sumDists /= float(len(points))
         #bcp_logger.debug("%s time %s" % (sys._getframe(-1).f_code.co_name, 1000 * (time.time() - pre) ))
         bcp_logger.debug("Orthogonal distance to linear regression / stroke length: %s" % (sumDists))
         return sumDists
@@ -476,9 +621,7 @@ class BCPFeatureSet(FeatureSet):
     def f1_06(self, sNorm):
         """The total absolute curvature of the largest fragment [BSH04]"""
         #pre = time.time()
-        sNorm = Stroke([sNorm.Points[i] for i in range(0,len(sNorm.Points),30)])
-        #sNorm = GeomUtils.strokeNormalizeSpacing(stroke, numpoints = max(1,strokeLen/30))
-        angles = GeomUtils.pointlistAnglesVector(sNorm.Points)
+        angles = sNorm.getCachedGeometry('coarseAngles', _strokeCoarseAngles)
         positive = angles[0] >= 0.0
         segments = 2
         curSegCurv = 0.0
@@ -524,7 +667,7 @@ class BCPFeatureSet(FeatureSet):
         """Overtracing: Total angle / 2pi [PH08]"""
         bcp_logger.debug("Overtracing")
         #pre = time.time()
-        retVal = self.rubineSet.f09(stroke) / (math.pi * 2)
+        retVal = strokeTotalAngles(stroke)[0] / (math.pi * 2)
         #bcp_logger.debug("%s time %s" % (sys._getframe(-1).f_code.co_name, 1000 * (time.time() - pre) ))
         return retVal
 
@@ -537,17 +680,16 @@ class BCPFeatureSet(FeatureSet):
     def f1_21(self, stroke):
         """Total angle traversed by the stroke[Rubine91]"""
         #pre = time.time()
-        retVal =  self.rubineSet.f09(stroke)
+        retVal =  strokeTotalAngles(stroke)[0]
         #bcp_logger.debug("%s time %s" % (sys._getframe(-1).f_code.co_name, 1000 * (time.time() - pre) ))
         return retVal
     #@Timed
     def f10_05(self, stroke):
         """Minimum speed when drawing the stroke. Assume one point captured every time unit"""
         if len(stroke.Points) > 0:
-            minSpeed = GeomUtils.strokeLength(stroke) #Assume it was all drawn at once
-            for i in xrange(1, len(stroke.Points)):
-                dist = GeomUtils.pointDist(stroke.Points[i - 1], stroke.Points[i])
-                minSpeed = min(dist, minSpeed)
+            minSpeed = stroke.getCachedGeometry('length', GeomUtils.strokeLength) #Assume it was all drawn at once
+            if len(stroke.Points) > 1:
+                minSpeed = min(minSpeed, float(stroke.getCachedGeometry('segmentLengths', _strokeSegmentLengths).min()))
         else:
             minSpeed = 0 # Very slow writing zero points
         bcp_logger.debug("Minimum speed %s" %( minSpeed))
@@ -568,14 +710,8 @@ class BCPFeatureSet_Combinable(BCPFeatureSet):
         #Set up the common data
         #---------------------------------
         stroke = strokeList[0]
-        convexHull = Stroke(GeomUtils.convexHull(stroke.Points))
-        strokeLength = GeomUtils.strokeLength(stroke)
-        strokeNorm = GeomUtils.strokeNormalizeSpacing(stroke, numpoints = max(1,strokeLength))
-        boundingBox = (stroke.BoundTopLeft, stroke.BoundBottomRight)
-        anglesVector = GeomUtils.pointlistAnglesVector(stroke.Points)
-        curvatureList = GeomUtils.strokeGetPointsCurvature(
-                            GeomUtils.strokeSmooth(stroke, width = max(1, int(strokeLength*0.05))
-                        ))
+        convexHull, strokeLength, strokeNorm, boundingBox, curvatureList, anglesVector = \
+            self.geometry(stroke)
 
         if len(strokeList) > 1:
             bcp_logger.warn("Concatenating multiple strokes")
@@ -662,15 +798,8 @@ class BCP_ShapeFeatureSet(BCPFeatureSet):
         elif len(strokeList) == 1:
             stroke = strokeList[0]
 
-        convexHull = Stroke(GeomUtils.convexHull(stroke.Points))
-        strokeLength = GeomUtils.strokeLength(stroke)
-        strokeNorm = GeomUtils.strokeNormalizeSpacing(stroke, numpoints = max(1,strokeLength))
-        boundingBox = (stroke.BoundTopLeft, stroke.BoundBottomRight)
-        curvatureList = GeomUtils.strokeGetPointsCurvature(
-                            GeomUtils.strokeSmooth(stroke, width = max(1, int(strokeLength*0.05))
-                        ))
-
-        anglesVector = GeomUtils.pointlistAnglesVector(stroke.Points)
+        convexHull, strokeLength, strokeNorm, boundingBox, curvatureList, anglesVector = \
+            self.geometry(stroke)
         #Generate the vector
         #Basic Features
         retVector = [ self.f1_12(stroke, strokeLength) , \
@@ -725,15 +854,8 @@ class BCP_ShapeFeatureSet_Combinable(BCPFeatureSet):
         elif len(strokeList) == 1:
             stroke = strokeList[0]
 
-        convexHull = Stroke(GeomUtils.convexHull(stroke.Points))
-        strokeLength = GeomUtils.strokeLength(stroke)
-        strokeNorm = GeomUtils.strokeNormalizeSpacing(stroke, numpoints = max(1,strokeLength))
-        boundingBox = (stroke.BoundTopLeft, stroke.BoundBottomRight)
-        curvatureList = GeomUtils.strokeGetPointsCurvature(
-                            GeomUtils.strokeSmooth(stroke, width = max(1, int(strokeLength*0.05))
-                        ))
-
-        anglesVector = GeomUtils.pointlistAnglesVector(stroke.Points)
+        convexHull, strokeLength, strokeNorm, boundingBox, curvatureList, anglesVector = \
+            self.geometry(stroke)
         #Generate the vector
         #Basic Features
         retVector = [ 
@@ -790,15 +912,8 @@ class BCP_ClassFeatureSet(BCPFeatureSet):
         elif len(strokeList) == 1:
             stroke = strokeList[0]
 
-        convexHull = Stroke(GeomUtils.convexHull(stroke.Points))
-        strokeLength = GeomUtils.strokeLength(stroke)
-        strokeNorm = GeomUtils.strokeNormalizeSpacing(stroke, numpoints = max(1,strokeLength))
-        boundingBox = (stroke.BoundTopLeft, stroke.BoundBottomRight)
-        curvatureList = GeomUtils.strokeGetPointsCurvature(
-                            GeomUtils.strokeSmooth(stroke, width = max(1, int(strokeLength*0.05))
-                        ))
-
-        anglesVector = GeomUtils.pointlistAnglesVector(stroke.Points)
+        convexHull, strokeLength, strokeNorm, boundingBox, curvatureList, anglesVector = \
+            self.geometry(stroke)
         #Generate the vector
         #Basic Features
         retVector = [ self.f1_12(stroke, strokeLength) , \
@@ -851,15 +966,8 @@ class BCP_ClassFeatureSet_Combinable(BCPFeatureSet):
         elif len(strokeList) == 1:
             stroke = strokeList[0]
 
-        convexHull = Stroke(GeomUtils.convexHull(stroke.Points))
-        strokeLength = GeomUtils.strokeLength(stroke)
-        strokeNorm = GeomUtils.strokeNormalizeSpacing(stroke, numpoints = max(1,strokeLength))
-        boundingBox = (stroke.BoundTopLeft, stroke.BoundBottomRight)
-        curvatureList = GeomUtils.strokeGetPointsCurvature(
-                            GeomUtils.strokeSmooth(stroke, width = max(1, int(strokeLength*0.05))
-                        ))
-
-        anglesVector = GeomUtils.pointlistAnglesVector(stroke.Points)
+        convexHull, strokeLength, strokeNorm, boundingBox, curvatureList, anglesVector = \
+            self.geometry(stroke)
         #Generate the vector
         #Basic Features
         retVector = [ 
@@ -918,15 +1026,8 @@ class BCP_GraphFeatureSet(BCPFeatureSet):
         elif len(strokeList) == 1:
             stroke = strokeList[0]
 
-        convexHull = Stroke(GeomUtils.convexHull(stroke.Points))
-        strokeLength = GeomUtils.strokeLength(stroke)
-        strokeNorm = GeomUtils.strokeNormalizeSpacing(stroke, numpoints = max(1,strokeLength))
-        boundingBox = (stroke.BoundTopLeft, stroke.BoundBottomRight)
-        curvatureList = GeomUtils.strokeGetPointsCurvature(
-                            GeomUtils.strokeSmooth(stroke, width = max(1, int(strokeLength*0.05))
-                        ))
-
-        anglesVector = GeomUtils.pointlistAnglesVector(stroke.Points)
+        convexHull, strokeLength, strokeNorm, boundingBox, curvatureList, anglesVector = \
+            self.geometry(stroke)
         #Generate the vector
         #Basic Features
         retVector = [ self.f1_12(stroke, strokeLength) , \
@@ -980,15 +1081,8 @@ class BCP_GraphFeatureSet_Combinable(BCPFeatureSet):
         elif len(strokeList) == 1:
             stroke = strokeList[0]
 
-        convexHull = Stroke(GeomUtils.convexHull(stroke.Points))
-        strokeLength = GeomUtils.strokeLength(stroke)
-        strokeNorm = GeomUtils.strokeNormalizeSpacing(stroke, numpoints = max(1,strokeLength))
-        boundingBox = (stroke.BoundTopLeft, stroke.BoundBottomRight)
-        curvatureList = GeomUtils.strokeGetPointsCurvature(
-                            GeomUtils.strokeSmooth(stroke, width = max(1, int(strokeLength*0.05))
-                        ))
-
-        anglesVector = GeomUtils.pointlistAnglesVector(stroke.Points)
+        convexHull, strokeLength, strokeNorm, boundingBox, curvatureList, anglesVector = \
+            self.geometry(stroke)
         #Generate the vector
         #Basic Features
         retVector = [
@@ -1114,13 +1208,13 @@ class RubineFeatureSet(FeatureSet):
 
     def f09(self, stroke):
         #Sum of the angle traversed
-        totalAngle = sum(GeomUtils.pointlistAnglesVector(stroke.Points)) 
+        totalAngle = strokeTotalAngles(stroke)[0]
         rb_logger.debug("Total Angle traversed: %s" %(57 *totalAngle))
         return totalAngle
 
     def f10(self, stroke):
         # 10th and 11th are the sum of the absolute value of the angels and to sum of the angles squared
-        totalAbsAngles = sum([math.fabs(angle) for angle in GeomUtils.pointlistAnglesVector(stroke.Points)])
+        totalAbsAngles = strokeTotalAngles(stroke)[1]
         rb_logger.debug("Total AbsAngle traversed: %s" %(57 *totalAbsAngles))
         return totalAbsAngles
 
@@ -1180,55 +1274,44 @@ class SymbolClass (object):
         #self.examples.append(stroke)
         self.featureVectors.append(self.featureSet.generateVector(strokeList))
 
+    def addFeatureVectors(self, featureVectors):
+        """Add examples whose feature vectors are already computed (e.g. by
+        Utils.RubineBatch)"""
+        self.featureVectors.extend(featureVectors)
+
     def __len__(self):
         """The length of this SymbolClass (the number of examples given to it)"""
         return len(self.featureVectors)
 
+    def getFeatureMatrix(self):
+        """Returns the example feature vectors stacked into an
+        (examples x features) array"""
+        return array(self.featureVectors, dtype = float).reshape( (len(self.featureVectors), len(self.featureSet)) )
+
     def getCovarianceMatrix(self, avgFeatureVals= None):
         """ Calculates the covariance matrix for a class. For Internal use only """
-        numFeatures = len(self.featureSet)
-        cmc = mat( zeros( (numFeatures, numFeatures))  ) 
-
         if avgFeatureVals is None:
             avgFeatureVals = self.getAverageFeatureValues()
 
-        #cmc = mat(zeros((len(self.features[0][0]),len(self.features[0][0]))))
-        #for i in range(len(self.features[c][0])): #Number of features
-            #for j in range(len(self.features[c][0])):
-
-        for f_i in range (numFeatures):
-            for f_j in range (f_i, numFeatures):
-                for sVect in self.featureVectors:
-                    ijInc = (sVect[f_i] - avgFeatureVals[f_i]) * ( sVect[f_j] - avgFeatureVals[f_j])
-                    cmc[f_i,f_j] += ijInc
-                    cmc[f_j,f_i] += ijInc
-        return cmc
+        deviations = self.getFeatureMatrix() - asarray(avgFeatureVals, dtype = float)
+        cmc = dot(deviations.T, deviations)
+        #The original per-element accumulation counted the diagonal twice. Keep
+        #doing so, so that weights match those trained before.
+        cmc += diag(diag(cmc))
+        return mat(cmc)
 
     def getAverageFeatureValues(self):
         """ Given list of example stroke feature vectors, calculates the averages 
         feature values for a class. Returns list of averages indexed by feature 
         number. For Internal use only """
-        averages = zeros(len(self.featureSet))
-        for fvect in self.featureVectors: 
-            for i in range(len(self.featureSet)):
-                averages[i] += fvect[i]
-        
-        for i in range(len(self.featureSet)):
-            averages[i] /= len(self.featureVectors)
-
-        return averages
+        return self.getFeatureMatrix().mean(axis = 0)
 
     def calculateWeights(self, invCovMatrix, avgFeatureVals):
         """Calculate this class's weights based on the common inverser covariance
         matrix."""
-        numFeatures = len(self.featureSet)
-        self.weight0 = 0.0
-        self.weights = zeros( numFeatures )
-        for w_idx in range(numFeatures):
-            for f_i in range(numFeatures):
-                self.weights[w_idx] += invCovMatrix[w_idx, f_i] * avgFeatureVals[f_i]
-            self.weight0 +=  self.weights[w_idx] * avgFeatureVals[w_idx]
-        self.weight0 *= -0.5
+        avgFeatureVals = asarray(avgFeatureVals, dtype = float)
+        self.weights = asarray(dot(asarray(invCovMatrix), avgFeatureVals)).ravel()
+        self.weight0 = -0.5 * float(dot(self.weights, avgFeatureVals))
 
     def getWeights(self):
         """Return the weights for this class. If they're unset, it will be None"""
@@ -1276,11 +1359,14 @@ class RubineClassifier():
             This file can then be used to initate the rubine classifier
     """
 
-    def __init__(self, debug = False, featureSet = BCPFeatureSet()):
-        """Initiates the rubine trainer."""
+    def __init__(self, debug = False, featureSet = BCPFeatureSet(), ridge = 0.0):
+        """Initiates the rubine trainer.
+        ridge is added to the diagonal of the pooled covariance matrix before
+        inverting it. A singular matrix is otherwise inverted with linalg.pinv."""
         self.debug = debug
         self.reset()
         self.featureSet = featureSet
+        self.ridge = ridge
 
         self.count = -1
         self.symbolClasses = {}
@@ -1342,94 +1428,22 @@ class RubineClassifier():
             raise Exception("Not enough examples across the classes")
 
 
-        covMatrices = {}
-        avgCovMat =  mat(zeros((numFeatures, numFeatures))) #Store the weighted average covariance matrix
+        #Pooled covariance: each class's covariance weighted by its number of examples
+        avgCovMat = zeros( (numFeatures, numFeatures) )
         for symCls in self.symbolClasses.values():
             self.averages[symCls.name] = symCls.getAverageFeatureValues()
             covMat = symCls.getCovarianceMatrix(self.averages[symCls.name])
-            for fi in range(numFeatures):
-                for fj in range(numFeatures):
-                    avgCovMat[fi, fj] += covMat[fi, fj] * len(symCls) / float(dividor)
-            covMatrices[symCls.name] = covMat
-        origMat = avgCovMat
-
-        while linalg.det(avgCovMat) == 0.0: #While not invertible
-            logger.warn("Singular Matrix!")
-            avgCovMat = origMat.copy()
-            ignoreFeat = random.randint(0, len(self.featureSet) - 1)
-            print "Ignoring feature %s" % ignoreFeat
-            for x in range(0, len(self.featureSet)):
-                avgCovMat[ignoreFeat, x] = 1.0
-                avgCovMat[x, ignoreFeat] = 1.0
-            """
-            fp = open("ERROR.txt", "a")
-            print >> fp, avgCovMat
-            for symCls in self.symbolClasses.values():
-                print >>fp, symCls.name
-                covMat = symCls.getCovarianceMatrix(self.averages[symCls.name])
-                print >> fp, covMat
-                for featVect in symCls.featureVectors:
-                    print >> fp,  "\t".join([str(f) for f in featVect])
-                print >>fp, "END", symCls.name
-            fp.close()
-
-            """
-            """
-            x = random.randint(0, len(self.featureSet) - 1)
-            y = random.randint(0, len(self.featureSet) - 1)
-            for i in range(len(self.featureSet)): #Swap the rows
-                temp = avgCovMat[x,i]
-                avgCovMat[x,i] = avgCovMat[y,i]
-                avgCovMat[y,i] = temp
-            for j in range(len(self.featureSet)): #Swap the columns
-                temp = avgCovMat[j,x]
-                avgCovMat[j,x] = avgCovMat[j,y]
-                avgCovMat[j,y] = temp
-            """
-            """
-            for i in range(len(self.featureSet)):
-                for j in range(len(self.featureSet)):
-                    if avgCovMat[i,j] > 1:
-                        factor = math.e ** (math.log(avgCovMat[i,j]) - 15)
-                        avgCovMat[i,j] += factor * random.random()
-            """
-        """
-        except Exception as e:
-            #Singular Matrix
-            fp = open("ERROR.txt", "w")
-            print traceback.format_exc()
-            print e
-            print >> fp, avgCovMat
-            for symCls in self.symbolClasses.values():
-                print symCls.name
-
-                covMat = symCls.getCovarianceMatrix(self.averages[symCls.name])
-                print >> fp, covMat
-                for featVect in symCls.featureVectors:
-                    print >> fp,  "\t".join([str(f) for f in featVect])
-                print "END", symCls.name
-            #exit(1)
-            logger.warn("Noising matrix!")
-            #Noise!
-            i = random.randint(0, len(self.featureSet) - 1)
-            j = random.randint(0, len(self.featureSet) - 1)
-            avgCovMat[i,j] += random.random()
-        """
-
-        self.covarianceMatrixInverse = invCovMatrix = avgCovMat.I
-
-        """
-        fp = open("MATRIX_%s_%s.txt" % (type(self.featureSet).__name__, time.time()), "a")
-        print >> fp, self.covarianceMatrixInverse
-        for symCls in self.symbolClasses.values():
-            print >>fp, symCls.name
-            covMat = symCls.getCovarianceMatrix(self.averages[symCls.name])
-            print >> fp, covMat
-            for featVect in symCls.featureVectors:
-                print >> fp,  "\t".join([str(f) for f in featVect])
-            print >>fp, "END", symCls.name
-        fp.close()
-        """
+            avgCovMat += asarray(covMat) * (len(symCls) / float(dividor))
+
+        if self.ridge > 0:
+            avgCovMat += self.ridge * identity(numFeatures)
+        if linalg.matrix_rank(avgCovMat) < numFeatures:
+            #Singular: features that never vary (or vary together) get no weight
+            logger.warn("Singular Matrix! Using the pseudo-inverse")
+            invCovMatrix = mat(linalg.pinv(avgCovMat))
+        else:
+            invCovMatrix = mat(avgCovMat).I
+        self.covarianceMatrixInverse = invCovMatrix
 
         for symCls in self.symbolClasses.values():
             symCls.calculateWeights(invCovMatrix, self.averages[symCls.name])
@@ -1489,13 +1503,72 @@ class RubineClassifier():
         return []
         #self.getBoard().AnnotateStrokes( [stroke],  RubineAnnotation(self.names[maxIndex], height , 0))
 
+    def classifyStrokeLists(self, strokeLists):
+        """Batch version of classifyStrokeList. Returns one list of scores for each
+        list of strokes in strokeLists."""
+        vectors = []
+        for strokeList in strokeLists:
+            if len(strokeList) == 1:
+                vectors.append(strokeList[0].getFeatureVector(self.featureSet))
+            else:
+                vectors.append(self.featureSet.generateVector(strokeList))
+        return self.classifyVectors(vectors)
+
+    def classifyVectors(self, rubineVectors):
+        """Batch version of classifyVector: rubineVectors is a sequence (or
+        (vectors x features) array) of feature vectors. All vectors are scored with
+        one matrix multiply, and their rejection distances computed together.
+        Returns one ranked list of {'symbol', 'score'} (or [] if rejected) per vector."""
+        numFeatures = len(self.featureSet)
+        vectors = asarray(rubineVectors, dtype = float).reshape( (-1, numFeatures) )
+
+        classNames = []
+        classWeights = []
+        for symCls in self.symbolClasses.values():
+            clsWeights = symCls.getWeights()
+            if clsWeights is None: #Have not run calculateWeights yet
+                bcp_logger.warn("Class weights are not set")
+                continue
+            classNames.append(symCls.name)
+            classWeights.append(clsWeights)
+        if len(classNames) == 0 or len(vectors) == 0:
+            return [ [] for _ in range(len(vectors)) ]
+
+        classWeights = array(classWeights, dtype = float)
+        scores = dot(vectors, classWeights[:, 1:].T) + classWeights[:, 0]
+        best = scores.argmax(axis = 1)
+
+        # Mahalanobis distance from each vector to its best class' average
+        if self.debug:
+            logger.debug("Mahalanobis distance")
+        classAverages = array([self.averages[name] for name in classNames], dtype = float)
+        deltas = vectors - classAverages[best]
+        distances = (dot(deltas, asarray(self.covarianceMatrixInverse)) * deltas).sum(axis = 1)
+        rejected = distances > numFeatures ** 2 / 2.0
+
+        retList = []
+        for vIdx in range(len(vectors)):
+            if rejected[vIdx]:
+                logger.debug( "REJECT")
+                retList.append([])
+                continue
+            classScores = [ {'symbol': name, 'score': score}
+                            for name, score in zip(classNames, scores[vIdx].tolist()) ]
+            classScores.sort(key = (lambda x: - x['score']) ) #Sort by the score
+            retList.append(classScores)
+        return retList
+
     def saveWeights(self, fileName):
-        """ Saves the current trainning data to a file given by fileName. This file can then be loaded by the rubine classifier """
+        """ Saves the current trainning data to a file given by fileName. This file can then be loaded by the rubine classifier.
+        A fileName ending in BINARY_MODEL_EXT is saved in the binary model format."""
         
         self.calculateWeights()
 
         if self.debug:
             logger.info("Saving training data to file: " + fileName)
+        if fileName.endswith(BINARY_MODEL_EXT):
+            self.saveBinaryWeights(fileName)
+            return
         
         TB = ET.TreeBuilder()
         TB.start("rubine", {})
@@ -1537,8 +1610,79 @@ class RubineClassifier():
         #print >> fd, ET.tostring(elem)
         #fd.close()
 
+    def saveBinaryWeights(self, fileName):
+        """Save the current weights (from calculateWeights or loadWeights) in the
+        binary model format, which loadBinaryWeights memory-maps. The file holds:
+            header (see _BINARY_HEADER): magic, version, feature set name length,
+                number of classes C, number of features F, class names length
+            the feature set's class name, then the class names joined by newlines
+            padding to a multiple of 8 bytes
+            little-endian float64 arrays: weights (C x F+1, weight0 first),
+                averages (C x F), inverse covariance (F x F)"""
+        numFeatures = len(self.featureSet)
+        names = [name for name, symCls in self.symbolClasses.items() if symCls.getWeights() is not None]
+        weights = array([self.symbolClasses[name].getWeights() for name in names], dtype = '<f8')
+        averages = array([self.averages[name] for name in names], dtype = '<f8')
+        invCovariance = asarray(self.covarianceMatrixInverse, dtype = '<f8')
+        assert invCovariance.shape == (numFeatures, numFeatures), "Weights are not calculated"
+
+        fsName = self.featureSet.__class__.__name__
+        namesBlock = "\n".join([n.encode('utf-8') if isinstance(n, unicode) else n for n in names])
+        header = _BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(fsName),
+                                     len(names), numFeatures, len(namesBlock))
+        fd = open(fileName, "wb")
+        try:
+            fd.write(header + fsName + namesBlock)
+            fd.write("\0" * (_binaryDataOffset(len(fsName) + len(namesBlock)) - fd.tell()))
+            for data in (weights, averages, invCovariance):
+                fd.write(data.tostring())
+        finally:
+            fd.close()
+
+    def loadBinaryWeights(self, fileName):
+        """Load weights saved by saveBinaryWeights. The weight, average and covariance
+        arrays are memory-mapped read-only rather than parsed or copied."""
+        fd = open(fileName, "rb")
+        try:
+            header = fd.read(_BINARY_HEADER.size)
+            if len(header) != _BINARY_HEADER.size or not header.startswith(BINARY_MAGIC):
+                raise ValueError("%s is not a binary Rubine model" % (fileName))
+            magic, version, fsNameLen, numClasses, numFeatures, namesLen = _BINARY_HEADER.unpack(header)
+            strings = fd.read(fsNameLen + namesLen)
+        finally:
+            fd.close()
+        if version != BINARY_VERSION:
+            raise ValueError("%s is version %s, expected version %s" % (fileName, version, BINARY_VERSION))
+        assert numFeatures == len(self.featureSet), "Error, wrong featureset used! Loading %s features, expecting %s" % (numFeatures, len(self.featureSet))
+        fsName = strings[:fsNameLen]
+        if fsName != self.featureSet.__class__.__name__:
+            logger.warn("Weights in %s were trained with %s, not %s" % (fileName, fsName, self.featureSet.__class__.__name__))
+        names = strings[fsNameLen:].split("\n") if numClasses > 0 else []
+
+        weightsSize = numClasses * (numFeatures + 1)
+        averagesSize = numClasses * numFeatures
+        data = memmap(fileName, dtype = '<f8', mode = 'r', offset = _binaryDataOffset(fsNameLen + namesLen),
+                      shape = (weightsSize + averagesSize + numFeatures * numFeatures,))
+        weights = data[:weightsSize].reshape( (numClasses, numFeatures + 1) )
+        averages = data[weightsSize:weightsSize + averagesSize].reshape( (numClasses, numFeatures) )
+
+        self.symbolClasses = {}
+        self.averages = {}
+        for idx, name in enumerate(names):
+            cls = ShellSymbolClass(self.featureSet)
+            cls.name = name
+            cls.weight0 = float(weights[idx, 0])
+            cls.weights = weights[idx, 1:]
+            cls.averages = averages[idx]
+            self.symbolClasses[name] = cls
+            self.averages[name] = cls.getAverageFeatureValues()
+        self.covarianceMatrixInverse = mat(data[weightsSize + averagesSize:].reshape( (numFeatures, numFeatures) ))
+
     def loadWeights(self, file):
-        """ Loads the training data in the file. File is a file name """
+        """ Loads the training data in the file. File is a file name or an open
+        XML file. Binary models (see saveBinaryWeights) are loaded by name only."""
+        if isinstance(file, basestring) and isBinaryModel(file):
+            return self.loadBinaryWeights(file)
         et = ET.parse(file)
         classes = et.findall("class")
 
@@ -1576,6 +1720,68 @@ class RubineClassifier():
             for j in range(len(cols)):
                 self.covarianceMatrixInverse[i,j] = float(cols[j].text)
 
+#------------------------------------------------------------
+BINARY_MAGIC = "RBNM"
+BINARY_VERSION = 1
+BINARY_MODEL_EXT = ".rbm"
+#magic, version, feature set name length, classes, features, class names length
+_BINARY_HEADER = struct.Struct("<4sHHIII")
+
+def _binaryDataOffset(stringsLen):
+    """Offset of the float64 arrays in a binary model, aligned to 8 bytes"""
+    return (_BINARY_HEADER.size + stringsLen + 7) // 8 * 8
+
+def isBinaryModel(fname):
+    """Return whether fname is a binary model saved by saveBinaryWeights"""
+    try:
+        fd = open(fname, "rb")
+    except IOError:
+        return False
+    try:
+        return fd.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+    finally:
+        fd.close()
+
+def binaryModelName(fname):
+    """The binary model file name that goes with the XML weights in fname"""
+    return os.path.splitext(fname)[0] + BINARY_MODEL_EXT
+
+def convertXMLWeights(xmlFname, binFname = None, featureSetClass = BCPFeatureSet):
+    """Convert XML weights (e.g. RL10dash.xml) to the binary model format. The
+    XML does not record its feature set, so give the one it was trained with.
+    Returns the name of the binary file written."""
+    if binFname is None:
+        binFname = binaryModelName(xmlFname)
+    classifier = RubineClassifier(featureSet = featureSetClass())
+    classifier.loadWeights(xmlFname)
+    classifier.saveBinaryWeights(binFname)
+    return binFname
+
+def _newestWeightsFile(fname):
+    """Prefer the binary model beside XML weights in fname, if it is up to date"""
+    binFname = binaryModelName(fname)
+    if binFname != fname and os.path.exists(binFname) \
+            and os.path.getmtime(binFname) >= os.path.getmtime(fname) \
+            and isBinaryModel(binFname):
+        return binFname
+    return fname
+
+_SHARED_CLASSIFIERS = {} #(fname, featureSet class, debug) : RubineClassifier
+
+def getSharedClassifier(fname, featureSetClass = BCPFeatureSet, debug = False):
+    """Return a RubineClassifier with the weights in fname loaded, parsing the file
+    only the first time it is asked for. If an up to date binary model of fname
+    exists (see convertXMLWeights) it is loaded instead. The classifier is shared by every caller,
+    so it must only be used to classify (no addStroke/loadWeights/calculateWeights)."""
+    key = (fname, featureSetClass, debug)
+    classifier = _SHARED_CLASSIFIERS.get(key, None)
+    if classifier is None:
+        loadFname = _newestWeightsFile(fname)
+        logger.debug("Loading shared weights from %s" % (loadFname))
+        classifier = RubineClassifier(featureSet = featureSetClass(), debug = debug)
+        classifier.loadWeights(loadFname)
+        _SHARED_CLASSIFIERS[key] = classifier
+    return classifier
 
 #-------------------------------------
 # if executed by itself, run all the doc tests
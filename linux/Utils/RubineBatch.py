@@ -0,0 +1,199 @@
+"""
+description:
+   Bulk training for the Rubine classifier. Feature vectors for a labelled
+   corpus are extracted in a process pool, and can be cached on disk so that
+   retraining (e.g. after relabelling some examples) only extracts the vectors
+   of strokes it has not seen before.
+
+   A corpus is a list of (label, strokeList) examples. trainingSpecExamples
+   reads RubineTrainer's training spec files (lines of "label strokes.dat"),
+   and datasetExamples reads the group labels of a DataManager dataset.
+
+   Cached vectors are keyed by the stroke points and the feature set's name and
+   VERSION, so bump FeatureSet.VERSION whenever a feature set's features change.
+"""
+
+import hashlib
+import multiprocessing
+import shelve
+import traceback
+
+from SketchFramework.Point import Point
+from SketchFramework.Stroke import Stroke
+from Utils import Logger
+from Utils import Rubine
+from Utils.StrokeStorage import StrokeStorage
+
+logger = Logger.getLogger('RubineBatch', Logger.WARN )
+
+#------------------------------------------------------------
+# Corpora
+
+def trainingSpecExamples(specFname):
+    """Read a training spec (lines of "label strokefile", # for comments) and
+    return [(label, [stroke]), ...] with one example per stroke in each file"""
+    examples = []
+    specFile = open(specFname, "r")
+    try:
+        for line in specFile.readlines():
+            if line.startswith("#") or line.strip() == "":
+                continue
+            label, strokeFname = line.strip().split()
+            for stroke in StrokeStorage(filename = strokeFname).loadStrokes():
+                examples.append( (label, [stroke]) )
+    finally:
+        specFile.close()
+    return examples
+
+def datasetExamples(dataSet, diagramNum = None, participants = None):
+    """Return [(label, strokeList), ...] for the group labels of a DataManager
+    dataset. Only diagram number diagramNum of each participant is used if it is
+    given, and only the participant ids in participants if that is given."""
+    examples = []
+    for participant in dataSet.participants:
+        if participants is not None and participant.id not in participants:
+            continue
+        if diagramNum is None:
+            diagrams = participant.diagrams
+        else:
+            diagrams = participant.diagrams[diagramNum:diagramNum + 1]
+        for diagram in diagrams:
+            for label in diagram.groupLabels:
+                strokeList = [_datasetStroke(diagram.InkStrokes[stkId].stroke) for stkId in label.ids
+                                if stkId in diagram.InkStrokes]
+                if len(strokeList) > 0:
+                    examples.append( (label.type, strokeList) )
+    return examples
+
+def _datasetStroke(dmStroke):
+    """Convert a DataManager stroke (points are Points or (x, y) pairs)"""
+    if hasattr(dmStroke, 'Points'):
+        return dmStroke
+    points = []
+    for pt in dmStroke.points:
+        if isinstance(pt, Point):
+            points.append(pt)
+        else:
+            points.append(Point(pt[0], pt[1]))
+    return Stroke(points)
+
+#------------------------------------------------------------
+# Feature vector cache
+
+def featureSetKey(featureSet):
+    """Identifies the features computed by featureSet, for cache keys"""
+    return "%s.%s" % (type(featureSet).__name__, featureSet.VERSION)
+
+def strokeListKey(featureSet, strokeList):
+    """Cache key for the feature vector of strokeList"""
+    digest = hashlib.sha1(featureSetKey(featureSet))
+    for stroke in strokeList:
+        digest.update("|")
+        digest.update(Rubine.strokeArray(stroke).tostring())
+    return digest.hexdigest()
+
+class FeatureCache(object):
+    """On-disk store of feature vectors, keyed by strokeListKey. Only the
+    training process reads and writes it; pool workers never see it."""
+    def __init__(self, filename):
+        self._store = shelve.open(filename, protocol = 2)
+
+    def get(self, key):
+        return self._store.get(key, None)
+
+    def put(self, key, vector):
+        self._store[key] = list(vector)
+
+    def close(self):
+        self._store.close()
+
+#------------------------------------------------------------
+# Feature extraction
+
+_WORKER_FEATURESET = None
+
+def _initWorker(featureSetClass):
+    global _WORKER_FEATURESET
+    _WORKER_FEATURESET = featureSetClass()
+
+def _workerVector(pointLists):
+    """Runs in a pool process: rebuild the strokes and extract their vector.
+    Returns (vector, None), or (None, error text) if extraction failed."""
+    strokeList = [Stroke([Point(x, y, t) for x, y, t in points]) for points in pointLists]
+    return _extractVector(_WORKER_FEATURESET, strokeList)
+
+def _extractVector(featureSet, strokeList):
+    try:
+        numPoints = sum([len(stk.Points) for stk in strokeList])
+        if numPoints < 3: #As RubineClassifier.addStroke
+            raise Exception("Not enough points in this stroke: %s" % (numPoints))
+        return (list(featureSet.generateVector(strokeList)), None)
+    except Exception as e:
+        logger.debug(traceback.format_exc())
+        return (None, "%s: %s" % (type(e).__name__, e))
+
+def extractFeatureVectors(featureSet, strokeLists, processes = None, cache = None):
+    """Return the feature vector of each list of strokes in strokeLists, or None
+    for those whose features could not be computed. Vectors found in cache (a
+    FeatureCache) are reused, and new ones are added to it. The rest are computed
+    by a pool of processes (default: one per CPU), each with its own instance of
+    featureSet's class. With processes = 1 they are computed here with featureSet
+    itself, e.g. to use its timing report."""
+    vectors = [None] * len(strokeLists)
+    todo = []
+    keys = {}
+    for idx, strokeList in enumerate(strokeLists):
+        if cache is not None:
+            keys[idx] = strokeListKey(featureSet, strokeList)
+            vectors[idx] = cache.get(keys[idx])
+        if vectors[idx] is None:
+            todo.append(idx)
+    logger.debug("%s of %s vectors cached" % (len(strokeLists) - len(todo), len(strokeLists)))
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes <= 1 or len(todo) <= 1:
+        results = [_extractVector(featureSet, strokeLists[idx]) for idx in todo]
+    else:
+        jobs = [ [[(p.X, p.Y, p.T) for p in stk.Points] for stk in strokeLists[idx]] for idx in todo ]
+        pool = multiprocessing.Pool(processes, _initWorker, (type(featureSet),))
+        try:
+            results = pool.map(_workerVector, jobs, max(1, len(jobs) / (4 * processes)))
+        finally:
+            pool.close()
+            pool.join()
+
+    for idx, (vector, error) in zip(todo, results):
+        if vector is None:
+            logger.warn("Could not extract features from example %s: %s" % (idx, error))
+            continue
+        vectors[idx] = vector
+        if cache is not None:
+            cache.put(keys[idx], vector)
+    return vectors
+
+def trainClassifier(classifier, examples, processes = None, cacheFname = None):
+    """Add the examples, a list of (label, strokeList), to classifier's classes,
+    creating the classes as needed, and calculate its weights. The feature
+    vectors are extracted in parallel (see extractFeatureVectors), through the
+    cache file cacheFname if given. Returns the number of examples used."""
+    cache = None
+    if cacheFname is not None:
+        cache = FeatureCache(cacheFname)
+    try:
+        vectors = extractFeatureVectors(classifier.featureSet, [strokeList for _, strokeList in examples],
+                                        processes = processes, cache = cache)
+    finally:
+        if cache is not None:
+            cache.close()
+
+    numUsed = 0
+    for (label, _), vector in zip(examples, vectors):
+        if vector is None:
+            continue
+        if label not in classifier.symbolClasses:
+            classifier.newClass(name = label)
+        classifier.symbolClasses[label].addFeatureVectors([vector])
+        numUsed += 1
+    classifier.calculateWeights()
+    return numUsed
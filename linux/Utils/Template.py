@@ -2,7 +2,12 @@
 filename: Template.py
 
 description:
-
+   Matches strokes against the named templates in a .templ file. Templates are
+   resampled to resampleSize points and centered on their centroid when they
+   are loaded, and every rotation of every template is stacked into one array.
+   Score then compares a stroke with all of them at once, first on a coarse
+   sample of the points, and again on every point for the rotations that came
+   close in the first pass.
 
 Doctest Examples:
 
@@ -11,16 +16,21 @@ Doctest Examples:
 #-------------------------------------
 import itertools #for permutations
 import math
+import numpy
 
 from Utils import GeomUtils
 from Utils import Logger
 
 from SketchFramework import Point
-from SketchFramework import Stroke
 
 
 logger = Logger.getLogger('TemplateDict', Logger.WARN )
 
+ROTATIONS = 16 #Number of angles each template is tried at
+COARSE_SAMPLES = 10 #Points compared in the first pass (out of resampleSize)
+COARSE_MARGIN = 0.1 #A rotation is only scored in full if its first pass score is within this of the best score
+MAX_PERMUTED_STROKES = 3 #Try every ordering of up to this many strokes; more are ordered by _strokeOrders
+
 #-------------------------------------
         
 class TemplateDict( object ):
@@ -28,8 +38,9 @@ class TemplateDict( object ):
     def __init__(self, filename, resampleSize = 64):
         
         self._templates = {}
-        self._loadTemplates(filename = filename)
         self._resampleSize = resampleSize
+        self._loadTemplates(filename = filename)
+        self._compileTemplates()
         
 
     def getTemplates(self):
@@ -73,63 +84,156 @@ class TemplateDict( object ):
         logger.debug("Loaded %s templates" % len(self._templates))
         return self._templates
 
+    def _compileTemplates(self):
+        """Resample and center every template, and stack all of their rotations into
+        self._rotations, an array indexed by (template * ROTATIONS + rotation, point, x/y)"""
+        self._names = [] #The name of each template in self._rotations
+        normalized = []
+        for name, template_set in self._templates.items():
+            for template in template_set:
+                if len(template) > 0:
+                    self._names.append(name)
+                    normalized.append(_normalizeTemplate(template, self._resampleSize))
+
+        angles = [2 * math.pi / ROTATIONS * i for i in range(ROTATIONS)]
+        cosines = numpy.array([math.cos(angle) for angle in angles]).reshape(1, ROTATIONS, 1)
+        sines = numpy.array([math.sin(angle) for angle in angles]).reshape(1, ROTATIONS, 1)
+        points = numpy.array(normalized, dtype = float).reshape(len(normalized), 1, self._resampleSize, 2)
+        X, Y = points[..., 0], points[..., 1]
+        #As GeomUtils.rotatePoint
+        rotations = numpy.stack((X * cosines - Y * sines, X * sines + Y * cosines), axis = -1)
+        self._rotations = rotations.reshape(len(normalized) * ROTATIONS, self._resampleSize, 2)
+
+        self._coarseStep = max(self._resampleSize / COARSE_SAMPLES, 1)
+        self._coarseRotations = self._rotations[:, ::self._coarseStep]
+        self._coarseMagnitudes = _magnitudes(self._coarseRotations)
+        self._magnitudes = _magnitudes(self._rotations)
+
     def Score( self, strokelist, max_return = 1, interest = 0.2):
         "Compare these strokes to all templates, and return the best templates with their scores. "
-        ROTATIONS = 16
         best_templ = None 
-        for stroke_order in itertools.permutations(strokelist):
-            pointlist = []
-            for s in stroke_order:
-                pointlist.extend(s.Points)
-            new_stroke = Stroke.Stroke(points=pointlist)
-            
-            for name, template_set in self._templates.items():
-                for template in template_set:
-                    for angle in [2 * math.pi / ROTATIONS * i for i in range(ROTATIONS)]:
-                        end_template = GeomUtils.rotateStroke(Stroke.Stroke(points=template), angle).Points
-                        firstpass_score = _scoreStroke(new_stroke, end_template, 10)
-                        if best_templ is not None and firstpass_score - 0.1 > best_templ['score']:
-                            continue
-                        score = _scoreStroke(new_stroke, end_template, len(end_template))
-                        logger.debug("   '%s' ... %s" % (name, score))
-                
-                        if best_templ is None:
-                            best_templ = {'score': score + 1}
-                    
-                        if score < best_templ['score']:
-                            best_templ['name'] = name
-                            best_templ['score'] = score
-                            best_templ['template'] = end_template
+        if len(self._names) == 0:
+            return best_templ
+        for stroke_order in _strokeOrders(strokelist):
+            if len(stroke_order) == 1:
+                pointlist = stroke_order[0].Points
+            else:
+                pointlist = []
+                for s in stroke_order:
+                    pointlist.extend(s.Points)
+
+            bestScore = None
+            if best_templ is not None:
+                bestScore = best_templ['score']
+            idx, score = self._bestMatch(_strokeVector(pointlist, self._resampleSize), bestScore)
+            logger.debug("   '%s' ... %s" % (self._names[idx / ROTATIONS], score))
+
+            if best_templ is None or score < best_templ['score']:
+                best_templ = {'name' : self._names[idx / ROTATIONS],
+                              'score' : score,
+                              'template' : [Point.Point(x, y) for x, y in self._rotations[idx]] }
         return best_templ
 
+    def _bestMatch(self, points, bestScore = None):
+        """Input: array of stroke points from _strokeVector, and the best score so far.
+        Returns the index into self._rotations of the rotated template closest
+        to points, and its score. Only the rotations whose coarse score is
+        within COARSE_MARGIN of the best score are scored in full."""
+        if len(points) != self._resampleSize:
+            return 0, math.pi
+        coarse = _angularDistances(self._coarseRotations, points[::self._coarseStep], self._coarseMagnitudes)
+
+        #Score the best coarse match in full first, to bound which others are worth scoring
+        first = numpy.argmin(coarse)
+        firstScore = _angularDistances(self._rotations[first:first + 1], points, self._magnitudes[first:first + 1])[0]
+        if bestScore is None or firstScore < bestScore:
+            bestScore = firstScore
+
+        keep = coarse - COARSE_MARGIN <= bestScore
+        keep[first] = True
+        candidates = numpy.nonzero(keep)[0]
+        scores = _angularDistances(self._rotations[candidates], points, self._magnitudes[candidates])
+        best = numpy.argmin(scores)
+        return int(candidates[best]), float(scores[best])
+
 #-------------------------------------
+_SHARED_TEMPLATES = {} #(filename, resampleSize) : TemplateDict
 
-def _scoreStroke(stroke, template, sample_size = None):
-    
-    if sample_size is None:
-        sample_size = len(template)
-        
-    sNorm = GeomUtils.strokeNormalizeSpacing(stroke, len(template))
-    centr = GeomUtils.centroid(sNorm.Points)
-    numPoints = len(sNorm.Points)
-    
-    point_vect = []
-    templ_vect = []
-
-    numPoints = len(template)
-    if len(template) == len(sNorm.Points):
-        for idx in range(0, numPoints, numPoints/sample_size ):
-            templ_vect.append(template[idx].X)
-            templ_vect.append(template[idx].Y)
-            
-            p = sNorm.Points[idx]
-            point_vect.append(p.X - centr.X)
-            point_vect.append(p.Y - centr.Y)
-       
-        angularDist = GeomUtils.vectorDistance(point_vect, templ_vect)
-    else:
-        angularDist = math.pi
-    return angularDist
+def getSharedTemplateDict(filename, resampleSize = 64):
+    """Return a TemplateDict for filename, loading the templates only the first
+    time it is asked for. The TemplateDict is shared by every caller."""
+    key = (filename, resampleSize)
+    if key not in _SHARED_TEMPLATES:
+        _SHARED_TEMPLATES[key] = TemplateDict(filename, resampleSize = resampleSize)
+    return _SHARED_TEMPLATES[key]
+
+#-------------------------------------
+
+def _normalizeTemplate(template, numPoints):
+    "Input: list of template Points. Returns the template as (x, y) pairs, resampled to numPoints and centered on its centroid"
+    if len(template) != numPoints:
+        template = GeomUtils.pointlistNormalizeSpacing(template, numPoints)
+    centr = GeomUtils.centroid(template)
+    return [(p.X - centr.X, p.Y - centr.Y) for p in template]
+
+def _strokeVector(pointlist, numPoints):
+    "Input: the points of a stroke. Returns an array of them, resampled to numPoints and centered on their centroid"
+    sNorm = GeomUtils.pointlistNormalizeSpacing(pointlist, numPoints)
+    if len(sNorm) == 0:
+        return numpy.zeros( (0, 2) )
+    centr = GeomUtils.centroid(sNorm)
+    return numpy.array([(p.X - centr.X, p.Y - centr.Y) for p in sNorm], dtype = float)
+
+def _magnitudes(templates):
+    "Input: array of templates' points. Returns the magnitude of each template as a vector of its coordinates"
+    return numpy.sqrt((templates ** 2).sum(axis = (1, 2)))
+
+def _angularDistances(templates, points, magnitudes):
+    """Input: array of templates' points, array of points and the templates' magnitudes.
+    Returns the angular distance from points to each template, as GeomUtils.vectorDistance"""
+    dots = numpy.tensordot(templates, points, axes = ([1, 2], [0, 1]))
+    pointsMag = math.sqrt((points ** 2).sum())
+    retList = []
+    for dot, templMag in zip(dots, magnitudes):
+        if pointsMag == 0 or templMag == 0:
+            retList.append(math.pi)
+        else:
+            #Round as vectorDistance does
+            retList.append(math.acos(round(dot / (pointsMag * templMag), 5)))
+    return numpy.array(retList)
+
+def _strokeOrders(strokelist):
+    """The orders to try joining the strokes in strokelist in. Every permutation
+    of up to MAX_PERMUTED_STROKES strokes, otherwise the strokes in the order
+    given, and from each stroke, the chain that always continues with the
+    stroke that starts nearest to where the last one ended."""
+    if len(strokelist) <= MAX_PERMUTED_STROKES:
+        for order in itertools.permutations(strokelist):
+            yield order
+        return
+    seen = set()
+    for order in [tuple(strokelist)] + [_nearestChain(strokelist, start) for start in strokelist]:
+        key = tuple([id(s) for s in order])
+        if key not in seen:
+            seen.add(key)
+            yield order
+
+def _nearestChain(strokelist, start):
+    "Returns a tuple of the strokes in strokelist, starting at start and continuing with the nearest next stroke"
+    chain = [start]
+    remaining = [s for s in strokelist if s is not start]
+    while len(remaining) > 0:
+        nextStroke = min(remaining, key = lambda s: _gap(chain[-1], s))
+        chain.append(nextStroke)
+        remaining.remove(nextStroke)
+    return tuple(chain)
+
+def _gap(stroke, nextStroke):
+    "Distance from the end of stroke to the start of nextStroke"
+    if len(stroke.Points) == 0 or len(nextStroke.Points) == 0:
+        return 0
+    end, begin = stroke.Points[-1], nextStroke.Points[0]
+    return GeomUtils.pointDistance(end.X, end.Y, begin.X, begin.Y)
 
 #-------------------------------------
 
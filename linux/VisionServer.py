@@ -20,6 +20,8 @@ Description:
 import pdb
 import time
 import threading
+import multiprocessing
+import sys
 import Queue
 import StringIO
 import Image
@@ -28,7 +30,7 @@ import traceback
 from xml.etree import ElementTree as ET
 
 from SketchFramework.SketchGUI import _SketchGUI
-from SketchFramework.Point import Point
+from SketchFramework.PointArray import PointArray
 from SketchFramework.Stroke import Stroke
 from SketchFramework.Board import Board
 from SketchFramework.NetworkReceiver import ServerThread, Message
@@ -55,6 +57,8 @@ HEIGHT = int(4.8 * WIDTH / 8)
 MID_W = WIDTH/2
 MID_H = HEIGHT/2
 
+WORKER_CHECK_INTERVAL = 1.0 #Seconds between checks for dead worker processes
+
    
 logger = Logger.getLogger("NetSketchGUI", Logger.DEBUG)
 
@@ -244,6 +248,9 @@ class SketchResponseThread(threading.Thread):
         self._send_q = send_q
         
         self._boards = {}
+        #Build the first board now: it also loads the recognizers' shared data
+        #(Rubine weights, templates) before any request arrives
+        self.resetBoard()
     def run(self):
         """Continually receive and handle requests from clients, and generate appropriate responses"""
         while True:
@@ -257,8 +264,11 @@ class SketchResponseThread(threading.Thread):
                     fp = open("xmlout.xml", "w")
                     print >> fp, ET.tostring(xml_response)
                     fp.close()
-                    respMsg = Message(Message.TYPE_XML, ET.tostring(xml_response))
+                    respMsg = Message(Message.TYPE_XML, ET.tostring(xml_response),
+                                      connId = in_msg.getConnId())
                     self._send_q.put(respMsg)
+                    #Get the next board ready while the client handles the response
+                    self.resetBoard()
                 elif in_msg.getType() == Message.TYPE_XML:
                     logger.debug("Processing XML")
                     pass
@@ -276,18 +286,23 @@ class SketchResponseThread(threading.Thread):
         width, height = stkDict['dims']
         logger.debug("Processed net image, converting strokes")
 
-        self.resetBoard()
+        #self._Board is fresh: built by __init__ or after the previous response
         newBoard = self._Board
         self._boards[newBoard.getID()] = newBoard
 
         retXML = newBoard.xml(width, height)
         try:
-            for stk in stks:
-                pointList = []
-                for x,y in stk.Points:
-                    #scale = WIDTH / float(GETNORMWIDTH())
-                    pointList.append( Point(x, height - y) )
-                newBoard.AddStroke(Stroke(pointList))
+            #Let the observers see the whole image's strokes at once
+            with newBoard.batch():
+                for stk in stks:
+                    #Photos trace into many long strokes: store their points compactly
+                    xList = []
+                    yList = []
+                    for x,y in stk.Points:
+                        #scale = WIDTH / float(GETNORMWIDTH())
+                        xList.append(x)
+                        yList.append(height - y)
+                    newBoard.AddStroke(Stroke(PointArray(xList, yList)))
 
             retXML = newBoard.xml(width, height)
         except Exception as e:
@@ -341,24 +356,71 @@ class SketchResponseThread(threading.Thread):
 
     
 
+def sketchWorker(recv_q, send_q):
+    """Entry point for VisionServer worker processes. Each one handles requests
+    with its own SketchResponseThread, and so its own Board and observers"""
+    SketchResponseThread(recv_q, send_q).run()
+
+
 class VisionServer(object):
-    def __init__(self):
+    def __init__(self, numWorkers = 1, maxQueued = 0):
+        """numWorkers: with more than one, images are processed concurrently in a
+                pool of that many processes instead of a single thread
+            maxQueued: requests allowed to wait before clients stop being read.
+                Defaults to twice the number of workers in pool mode."""
         # Private data members
         self._serverThread = None
         self._recv_q = None
         self._send_q = None
         self._netDispatchThread = None
+        self._workers = []
+        self._workerMonitor = None
+        self._stopping = False
+        self._numWorkers = numWorkers
+        self._maxQueued = maxQueued
         self._setupNetworkDispatcher()
 
 
     def _setupNetworkDispatcher(self):
-        self._serverThread = ServerThread(port = 30000)
-        self._recv_q = self._serverThread.getRequestQueue()
-        self._send_q = self._serverThread.getResponseQueue()
-        self._netDispatchThread = SketchResponseThread(self._recv_q, self._send_q)
-        self._netDispatchThread.start()
+        if self._numWorkers > 1:
+            maxQueued = self._maxQueued
+            if maxQueued <= 0:
+                maxQueued = 2 * self._numWorkers
+            self._serverThread = ServerThread(port = 30000,
+                                              request_queue = multiprocessing.JoinableQueue(maxQueued),
+                                              response_queue = multiprocessing.Queue())
+            self._recv_q = self._serverThread.getRequestQueue()
+            self._send_q = self._serverThread.getResponseQueue()
+            for _ in range(self._numWorkers):
+                self._workers.append(self._startWorker())
+            self._workerMonitor = threading.Thread(target = self._monitorWorkers)
+            self._workerMonitor.daemon = True
+            self._workerMonitor.start()
+        else:
+            self._serverThread = ServerThread(port = 30000, maxQueued = self._maxQueued)
+            self._recv_q = self._serverThread.getRequestQueue()
+            self._send_q = self._serverThread.getResponseQueue()
+            self._netDispatchThread = SketchResponseThread(self._recv_q, self._send_q)
+            self._netDispatchThread.start()
         self._serverThread.start()
 
+    def _startWorker(self):
+        "Start and return a new worker process on the shared queues"
+        worker = multiprocessing.Process(target = sketchWorker, args = (self._recv_q, self._send_q))
+        worker.daemon = True
+        worker.start()
+        return worker
+
+    def _monitorWorkers(self):
+        """Check the worker processes every WORKER_CHECK_INTERVAL seconds, and replace
+        any that have died. The request a worker was handling when it died is lost."""
+        while not self._stopping:
+            time.sleep(WORKER_CHECK_INTERVAL)
+            for i, worker in enumerate(self._workers):
+                if not self._stopping and not worker.is_alive():
+                    logger.error("Worker %s died with exit code %s, restarting it" % (worker.pid, worker.exitcode))
+                    self._workers[i] = self._startWorker()
+
     def run(self):
         """Reset the board and wait for some entity to add strokes to the strokeQueue. 
         Add these strokes to the board, and build the xml view of the board, then queue the
@@ -366,17 +428,27 @@ class VisionServer(object):
         while True:
             action = raw_input()
             if action.strip().upper() == "C":
+                self._stopping = True
                 self._serverThread.stop()
                 self._serverThread.join()
+                for worker in self._workers:
+                    worker.terminate()
                 break
             else:
                 print "unknown action"
             
 
 
-def main():
-    VisionServer().run()
+def main(args):
+    """Usage: VisionServer.py [numWorkers [maxQueued]]"""
+    numWorkers = 1
+    maxQueued = 0
+    if len(args) > 1:
+        numWorkers = int(args[1])
+    if len(args) > 2:
+        maxQueued = int(args[2])
+    VisionServer(numWorkers = numWorkers, maxQueued = maxQueued).run()
     
 
 if __name__ == "__main__":
-    main()
+    main(sys.argv)
@@ -67,6 +67,8 @@ class FileResponseThread(threading.Thread):
             try:
                 output = fp.read()
                 msg = Message(Message.TYPE_XML, output)
+                if image is not None:
+                    msg.setConnId(image.getConnId())
                 #time.sleep(3)
                 self.outQ.put(msg)
             except Exception as e:
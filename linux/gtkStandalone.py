@@ -10,11 +10,11 @@ from SketchFramework.SketchGUI import _SketchGUI
 from SketchFramework.Stroke import Stroke
 from Utils import Logger
 from Utils.GeomUtils import getStrokesIntersection
+from Utils.ImageUtils import saveimg
 from Utils.StrokeStorage import StrokeStorage
 from functools import partial
 from multiprocessing import Queue as ProcQueue, Process
 from sketchvision import ImageStrokeConverter
-from sketchvision.ImageStrokeConverter import saveimg
 from xml.etree import ElementTree
 import Config
 import Queue
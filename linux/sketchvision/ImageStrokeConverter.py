@@ -20,14 +20,17 @@ Todo:
 
 """
 from SketchFramework.Stroke import Stroke
+from sketchvision.SkeletonGraph import SkeletonGraph
 from Utils import Logger
-from Utils.GeomUtils import getLinesIntersection
-from Utils.ImageUtils import saveimg
+from Utils import DebugSink
 import Image
-import StringIO
+import cStringIO
+import collections
 import cv
 import datetime
 import math
+import multiprocessing
+import numpy
 import os
 import pdb
 import pickle
@@ -43,7 +46,8 @@ log = Logger.getLogger("ISC", Logger.DEBUG)
 random.seed("sketchvision")
 
 
-DEBUG = False
+DEBUG = False #Set per request by cvimgToStrokes from DEBUGSINK.beginRequest()
+DEBUGSINK = DebugSink.NullSink() #Where debug images go (see Utils/DebugSink.py)
 
 ISBLACKBOARD = True
 
@@ -69,32 +73,47 @@ PRUNING_ERROR = PRUNING_ERROR * SQUARE_ERROR
 
 CACHE = None
 
+ARRAY_THINNING = True #Thin the whole image at once with numpy (see blobsToStrokes)
+ARRAY_GRAPH = True #Trace strokes with the array-backed SkeletonGraph (see pointsToStrokes)
+NUM_PROCESSES = 1 #Thin ink components in a pool of this many processes (see blobsToStrokes)
+POOL = None #The pool of POOL_SIZE processes, started the first time it is needed (see _getPool)
+POOL_SIZE = 0
+COMPONENT_BATCHING = False #Thin and trace each ink component on its own (see blobsToStrokes)
+NOISE_COMPONENT_SIZE = 2 #Components with this many pixels or fewer never survive thinning
+
 NORMWIDTH = 1280
 #NORMWIDTH = 2592
 #NORMWIDTH = 600
 DEBUGSCALE = 1
 DEBUGIMG = None
+
+BACKGROUND_MODELS = {} #boardId : BackgroundModel (see removeBackground)
+BACKGROUND_MODEL_DIR = None #If set, background models are also kept in this directory
+REUSE_BACKGROUND_IMAGE = False #Reuse the stored background instead of replaying its median kernels
+LIGHTING_DRIFT_THRESH = 8 #Median gray level change that forces a new background search
+BG_PYRAMID_LEVELS = 0 #Halve the image this many times before searching for the background
 #***************************************************
 # Intended module interface functions 
 #***************************************************
 
-def cvimgToStrokes(in_img, targetWidth = None):
-    "External interface to take in an OpenCV image object and return a list of the strokes."
-    global DEBUG, CACHE
+def cvimgToStrokes(in_img, targetWidth = None, numProcesses = None, boardId = None):
+    """External interface to take in an OpenCV image object and return a list of the strokes.
+    numProcesses is passed on to blobsToStrokes, and boardId to removeBackground."""
+    global DEBUG, CACHE, DEBUGSINK
     CACHE = {}
-    DEBUG = True
+    DEBUG = DEBUGSINK.beginRequest()
     if DEBUG:
         saveimg(in_img, name="Raw_ink_image")
-    saveimg(in_img, outdir="./photos/", 
-            filename=datetime.datetime.now().strftime("%F-%T"+".jpg"))
+        saveimg(in_img, outdir="./photos/", 
+                filename=datetime.datetime.now().strftime("%F-%T"+".jpg"))
     small_img = resizeImage(in_img, targetWidth=targetWidth)
     #small_img = in_img
     saveimg(small_img, name="Resized")
-    temp_img, _ = removeBackground(small_img)
+    temp_img, _ = removeBackground(small_img, boardId = boardId)
     #temp_img = cv.CreateMat(small_img.rows, small_img.cols, cv.CV_8UC1)
     #cv.CvtColor(small_img, temp_img, cv.CV_RGB2GRAY)
     #cv.AdaptiveThreshold(temp_img, temp_img, 255, blockSize=39)
-    strokelist = blobsToStrokes(temp_img)
+    strokelist = blobsToStrokes(temp_img, numProcesses = numProcesses)
     DEBUG = False
     if DEBUG:
         prettyPrintStrokes(temp_img, strokelist)
@@ -102,8 +121,9 @@ def cvimgToStrokes(in_img, targetWidth = None):
     return {"strokes": strokelist, "dims" : (small_img.cols, small_img.rows)}
 
 def loadImageBuf(data):
-    """Convert a PIL image buffer to the image expected by cvimgtoStrokes"""
-    pil_img = Image.open(StringIO.StringIO(data))
+    """Convert a PIL image buffer to the image expected by cvimgtoStrokes.
+    data can be a string or a bytearray, which is read in place"""
+    pil_img = Image.open(cStringIO.StringIO(data))
     cv_img = cv.CreateImageHeader(pil_img.size, cv.IPL_DEPTH_8U, 3)
     cv.SetData(cv_img, pil_img.tostring())
     cv_mat = cv.GetMat(cv_img)
@@ -199,14 +219,17 @@ def printPoint(pt, img):
         print "|"
     print "--------------------------"
 
-def thicknessAtPoint(point, img):
+def thicknessAtPoint(point, img, cache = None):
     """Determine the thickness at a point in img. Uses an expanding circle
     from that pixel until it encounters non-ink.
+    Results are stored in cache (defaults to the module CACHE).
     Returns the minimum thickness as twice that radius + 1"""
     global BGVAL, FILLEDVAL, CENTERVAL, OOBVAL, CACHE
+    if cache is None:
+        cache = CACHE
     #Load the cached value
     cacheTag = "Thickness%s%s" % (str(point), str(img))
-    thickness = CACHE.get(cacheTag, None)
+    thickness = cache.get(cacheTag, None)
     if thickness is None:
         px, py = point
         pixval = getImgVal(px, py, img)
@@ -235,7 +258,7 @@ def thicknessAtPoint(point, img):
                     break
                 rad *= 2
             thickness =(startRad + endRad) 
-        CACHE[cacheTag] = thickness
+        cache[cacheTag] = thickness
     
     return thickness
 
@@ -361,7 +384,7 @@ def pointsDistSquared (pt1, pt2):
 # Bitmap thinning functions
 #***************************************************
 
-def _squareIntersections(graphDict, rawImg):
+def _squareIntersections(graphDict, rawImg, cache = None):
     """Take in a graph of {<point> : {'kids' : set(kidpts), 'thickness' : float} } 
     and the original, binary image of strokes and 
     fix errors on intersections introduced by thinnning, 
@@ -443,13 +466,23 @@ def _squareIntersections(graphDict, rawImg):
                 #log.debug( " Intersections empty, reverting to old CP" )
                 newCrossPoint = cp
 
-            cpDict['thickness'] = thicknessAtPoint(newCrossPoint, rawImg)
-            newPoints[newCrossPoint] = cpDict
+            cpDict['thickness'] = thicknessAtPoint(newCrossPoint, rawImg, cache = cache)
+            #Crossing points that move to the same place keep all of their kids
+            newPoints.setdefault(newCrossPoint, {'kids' : set(), 'thickness' : cpDict['thickness']})['kids'].update(cpDict['kids'])
 
     for pt in removedPoints:
         _deletePointFromGraph(pt, graphDict)
+    #Put all of the new points in before linking their kids, so that links between
+    #   new points don't depend on the order they are inserted in
+    for pt , ptDict in newPoints.items():
+        _insertPointIntoGraph(pt, {'kids' : set(), 'thickness' : ptDict['thickness']}, graphDict) 
     for pt , ptDict in newPoints.items():
-        _insertPointIntoGraph(pt,ptDict, graphDict) 
+        for kpt in ptDict['kids']:
+            if kpt in graphDict:
+                graphDict[pt]['kids'].add(kpt)
+                graphDict[kpt]['kids'].add(pt)
+            else:
+                log.debug( "WARNING: Tried to insert point dictionary with invalid children" )
 
 def _deletePointFromGraph(point, graphDict):
     """Given a point and a graphdict, delete the point from the graph, and also remove
@@ -620,18 +653,29 @@ def drawGraph(graph, img):
 #***************************************************
 # Top level processing functions (not helper utils)
 #***************************************************    
-def pointsToStrokes(pointSet, rawImg):
+def pointsToStrokes(pointSet, rawImg, arrayGraph = None, cache = None):
     """Converts a set() of point tuples into a list of strokes making up those
-    points. Mostly glue behind the heavy lifter functions"""
+    points. Mostly glue behind the heavy lifter functions.
+    If arrayGraph is set (defaults to ARRAY_GRAPH), the graph is built as a
+    compact SkeletonGraph instead of a dictionary.
+    cache is used for thickness lookups (defaults to the module CACHE)."""
+    global ARRAY_GRAPH
+    if arrayGraph is None:
+        arrayGraph = ARRAY_GRAPH
     log.debug( "Generating point graph" )
-    graph = pointsToGraph(pointSet, rawImg)
-    log.debug( "Converting graph to strokes" )
-    retStrokes = graphToStrokes(graph, rawImg)
+    if arrayGraph:
+        graph = pointsToArrayGraph(pointSet, rawImg, cache = cache)
+        log.debug( "Converting graph to strokes" )
+        retStrokes = arrayGraphToStrokes(graph, rawImg)
+    else:
+        graph = pointsToGraph(pointSet, rawImg, cache = cache)
+        log.debug( "Converting graph to strokes" )
+        retStrokes = graphToStrokes(graph, rawImg)
     log.debug("Generated %d strokes" % (len(retStrokes)))
     return retStrokes
 
 
-def pointsToGraph(pointSet, rawImg):
+def pointsToGraph(pointSet, rawImg, cache = None):
     """From a raw, binary image and approximate thinned points associated with it, 
     turn the thinned points into a bunch of trees.
     * Thinned strokes are trimmed according to line thickness for better results.
@@ -674,7 +718,7 @@ def pointsToGraph(pointSet, rawImg):
             #    NOT adding those paths that are entirely within range of
             #    a pivot point
             if len(path) > 0:
-                ptThick = allThicknesses.setdefault(pt, thicknessAtPoint(pt, rawImg))
+                ptThick = allThicknesses.setdefault(pt, thicknessAtPoint(pt, rawImg, cache = cache))
                     
                 #If it's the first point or follows an intersection
                 if len(path) == 1:
@@ -682,16 +726,16 @@ def pointsToGraph(pointSet, rawImg):
                          'thickness': ptThick})
                 #If it's out of range of the last pivot
                 elif not pointsOverlap(path[0], pt, rawImg,
-                                               pt1Thickness = allThicknesses.setdefault(path[0], thicknessAtPoint(path[0], rawImg)),
+                                               pt1Thickness = allThicknesses.setdefault(path[0], thicknessAtPoint(path[0], rawImg, cache = cache)),
                                                pt2Thickness = ptThick) \
                                                or (len(addNbors) > 1): #Last case means intersection
                     unusedPaths.remove(path)
                     for idx in xrange(1,len(path)):
                         par = path[idx-1]
                         kid = path[idx]
-                        parThick = allThicknesses.setdefault(par, thicknessAtPoint(par, rawImg))
+                        parThick = allThicknesses.setdefault(par, thicknessAtPoint(par, rawImg, cache = cache))
                         parDict = graphDict.setdefault(par, {'kids': set([]), 'thickness':parThick})
-                        kidThick = allThicknesses.setdefault(kid, thicknessAtPoint(kid, rawImg))
+                        kidThick = allThicknesses.setdefault(kid, thicknessAtPoint(kid, rawImg, cache = cache))
                         kidDict = graphDict.setdefault(kid, {'kids': set([]), 'thickness':kidThick})
                         parDict['kids'].add(kid)
                         kidDict['kids'].add(par)
@@ -733,8 +777,8 @@ def pointsToGraph(pointSet, rawImg):
             for idx in xrange(1,len(upath)):
                 par = upath[idx-1]
                 kid = upath[idx]
-                parDict = graphDict.setdefault(par, {'kids': set([]), 'thickness':thicknessAtPoint(par,rawImg)})
-                kidDict = graphDict.setdefault(kid, {'kids': set([]), 'thickness':thicknessAtPoint(par,rawImg)})
+                parDict = graphDict.setdefault(par, {'kids': set([]), 'thickness':thicknessAtPoint(par, rawImg, cache = cache)})
+                kidDict = graphDict.setdefault(kid, {'kids': set([]), 'thickness':thicknessAtPoint(par, rawImg, cache = cache)})
                 parDict['kids'].add(kid)
                 kidDict['kids'].add(par)
 
@@ -761,15 +805,15 @@ def pointsToGraph(pointSet, rawImg):
 
     log.debug( "Before collapsing, graphdict: %s" % (len(graphDict)) )
 
-    _collapseIntersections(graphDict, rawImg)
+    _collapseIntersections(graphDict, rawImg, cache = cache)
     log.debug( "After collapsing, graphdict: %s" % (len(graphDict)) )
 
-    _squareIntersections(graphDict, rawImg)
+    _squareIntersections(graphDict, rawImg, cache = cache)
     log.debug( "After squaring, graphdict: %s" % (len(graphDict)) )
 
     return graphDict
 
-def _collapseIntersections(graph, rawImg):
+def _collapseIntersections(graph, rawImg, cache = None):
     """Given a graph dictionary and a keypoints list (with edge info),
     Collapse overlapping crossing points into one intersection. """
     keyPointsList = getKeyPoints(graph)
@@ -855,7 +899,7 @@ def _collapseIntersections(graph, rawImg):
             #Merge the avgPoint with existing if necessary
             avgPtDict = graph.setdefault(avgPt, {'kids': set(), 'thickness': 0.0})
             avgPtDict['kids'].update(kidSet)
-            avgPtDict['thickness'] =  thicknessAtPoint(avgPt, rawImg)
+            avgPtDict['thickness'] =  thicknessAtPoint(avgPt, rawImg, cache = cache)
             for k in kidSet:
                 graph[k]['kids'].add(avgPt)
 
@@ -916,14 +960,12 @@ def scoreConcatSmoothness(ptList1, ptList2):
 
 def graphToStrokes(graph, rawImg):
     """Takes in a graph of points and generates a list of strokes that covers them"""
-    retStrokes = []
+    return _keyPointsToStrokes(getKeyPoints(graph))
 
-    keyPointsList = getKeyPoints(graph)
-
-    allEdgeList = [kp['edges'] for kp in keyPointsList]
-
-    endPointMap = {} #Will map { <endPoint> : [ strokes with that ep ] }
-        
+def _keyPointsToStrokes(keyPointsList):
+    """Takes in a list of keypoint dictionaries (with edge info, see getKeyPoints)
+    and generates a list of strokes that covers their edges"""
+    retStrokes = []
 
     for kpDict in keyPointsList:
         #Straightforward, blob with single edge (no intersections)
@@ -987,6 +1029,353 @@ def graphToStrokes(graph, rawImg):
                 
     return retStrokes
 
+#***************************************************
+# Array-backed graph functions (see SkeletonGraph)
+#***************************************************
+
+def pointsToArrayGraph(pointSet, rawImg, cache = None):
+    """SkeletonGraph version of pointsToGraph. Traces the thinned points into trees
+    using flat per-pixel arrays (over the points' bounding box) instead of
+    dictionaries, then collapses and squares the intersections.
+    Returns a SkeletonGraph"""
+    imgWidth = rawImg.cols
+    imgHeight = rawImg.rows
+    inImage = [ (x, y) for x, y in pointSet if x >= 0 and x < imgWidth and y >= 0 and y < imgHeight ]
+    left = top = 0
+    width = height = 1
+    if len(inImage) > 0:
+        left = min(x for x, y in inImage)
+        top = min(y for x, y in inImage)
+        width = max(x for x, y in inImage) - left + 1
+        height = max(y for x, y in inImage) - top + 1
+    numPixels = width * height
+
+    inSet = numpy.zeros(numPixels, dtype=bool)
+    for x, y in inImage:
+        inSet[(y - top) * width + x - left] = True
+    inStack = numpy.zeros(numPixels, dtype=bool)
+    inGraph = numpy.zeros(numPixels, dtype=bool)
+    graphThick = numpy.zeros(numPixels, dtype=numpy.float32)
+    degree = numpy.zeros(numPixels, dtype=numpy.int32)
+    allThicknesses = numpy.empty(numPixels, dtype=numpy.float32)
+    allThicknesses.fill(numpy.nan)
+    edgeSet = set()
+
+    def toPoint(p):
+        return (p % width + left, p // width + top)
+
+    def ptThickness(p):
+        if numpy.isnan(allThicknesses[p]):
+            allThicknesses[p] = thicknessAtPoint(toPoint(p), rawImg, cache = cache)
+        return float(allThicknesses[p])
+
+    def addNode(p, thickness):
+        if not inGraph[p]:
+            inGraph[p] = True
+            graphThick[p] = thickness
+
+    def addEdge(par, kid):
+        edgeKey = min(par, kid) * numPixels + max(par, kid)
+        if par != kid and edgeKey not in edgeSet:
+            edgeSet.add(edgeKey)
+            degree[par] += 1
+            degree[kid] += 1
+
+    while len(pointSet) > 0:
+        #Same breadth first trace as pointsToGraph. The seeds come from pointSet,
+        #   and the neighbors are shuffled, in the same order as there.
+        seed = pointSet.pop()
+        pointSet.add(seed)
+        sx, sy = seed
+        if not (sx >= 0 and sx < imgWidth and sy >= 0 and sy < imgHeight):
+            pointSet.remove(seed)
+            continue
+        seed = (sy - top) * width + sx - left
+        path = []
+        procStack = collections.deque([(seed, path)])
+        inStack[seed] = True
+        allPaths = [path] #Every path started, to find the trimmed ones later
+        usedPathIds = set()
+        while len(procStack) > 0:
+            pt, path = procStack.popleft()
+            inStack[pt] = False
+            if not inSet[pt]:
+                continue
+            path.append(pt)
+            px, py = toPoint(pt)
+
+            addNbors = []
+            nborOffsets = list(NBOR_OFFSETS)
+            random.shuffle(nborOffsets)
+            for dx, dy in nborOffsets:
+                nx = px + dx - left
+                ny = py + dy - top
+                if nx >= 0 and nx < width and ny >= 0 and ny < height:
+                    nPt = ny * width + nx
+                    if inSet[nPt] and not inStack[nPt]:
+                        addNbors.append(nPt)
+
+            ptThick = ptThickness(pt)
+            if len(path) == 1:
+                addNode(pt, ptThick)
+            elif not pointsOverlap(toPoint(path[0]), (px, py), rawImg,
+                                   pt1Thickness = ptThickness(path[0]),
+                                   pt2Thickness = ptThick) \
+                 or (len(addNbors) > 1): #Last case means intersection
+                usedPathIds.add(id(path))
+                for idx in xrange(1, len(path)):
+                    par = path[idx-1]
+                    kid = path[idx]
+                    addNode(par, ptThickness(par))
+                    addNode(kid, ptThickness(kid))
+                    addEdge(par, kid)
+                path = [pt]
+                allPaths.append(path)
+
+            for i, nPt in enumerate(addNbors):
+                if i > 0:
+                    path = list(path)
+                    allPaths.append(path)
+                procStack.append( (nPt, path) )
+                inStack[nPt] = True
+            inSet[pt] = False
+            pointSet.remove( (px, py) )
+
+        #Add back the trimmed paths that extend an endpoint
+        usedEndpoints = set([])
+        addPaths = []
+        for upath in allPaths:
+            if id(upath) in usedPathIds:
+                continue
+            head = upath[0]
+            if head in usedEndpoints or degree[head] != 1:
+                continue
+            usedEndpoints.add(head)
+            addPaths.append(upath)
+        for upath in addPaths:
+            log.debug( "Adding back in a trimmed path" )
+            for idx in xrange(1, len(upath)):
+                par = upath[idx-1]
+                kid = upath[idx]
+                #Matches pointsToGraph, which gives trimmed tails their parent's thickness
+                addNode(par, ptThickness(par))
+                addNode(kid, ptThickness(par))
+                addEdge(par, kid)
+
+    #Link back together broken cycles
+    epImg = (inGraph & (degree == 1)).reshape(height, width)
+    for dx, dy in NBOR_OFFSETS:
+        ys, xs = numpy.nonzero(epImg[max(0, -dy):height - max(0, dy), max(0, -dx):width - max(0, dx)] \
+                             & epImg[max(0, dy):height - max(0, -dy), max(0, dx):width - max(0, -dx)])
+        ys += max(0, -dy)
+        xs += max(0, -dx)
+        for p, k in zip( (ys * width + xs).tolist(), ((ys + dy) * width + xs + dx).tolist() ):
+            addEdge(p, k)
+
+    nodes = numpy.flatnonzero(inGraph)
+    edgeKeys = numpy.fromiter(edgeSet, dtype=numpy.int64, count=len(edgeSet))
+    edgePairs = numpy.column_stack( (numpy.searchsorted(nodes, edgeKeys // numPixels),
+                                     numpy.searchsorted(nodes, edgeKeys % numPixels)) )
+    graph = SkeletonGraph(nodes % width + left, nodes // width + top, graphThick[nodes], edgePairs)
+    log.debug( "Before collapsing, graph: %s" % (len(graph)) )
+
+    graph = _collapseArrayIntersections(graph, rawImg, cache = cache)
+    log.debug( "After collapsing, graph: %s" % (len(graph)) )
+
+    graph = _squareArrayIntersections(graph, rawImg, cache = cache)
+    log.debug( "After squaring, graph: %s" % (len(graph)) )
+    return graph
+
+def _collapseArrayIntersections(graph, rawImg, cache = None):
+    """SkeletonGraph version of _collapseIntersections. Collapse overlapping
+    crossing points into one intersection. Returns the new SkeletonGraph"""
+    thickness = graph.thickness
+    numNodes = len(graph)
+    mergeGroups = [] #List of (avgPt, indices of the points it replaces)
+    for kpDict in graph.getKeyPoints():
+        mergeDict = {}
+        crossPoints = sorted(kpDict['crosspoints'])
+        #Compare each pair of crossing points
+        for i in range(len(crossPoints)):
+            cp1 = crossPoints[i]
+            for j in range(i+1, len(crossPoints)):
+                cp2 = crossPoints[j]
+                if pointsOverlap(graph.point(cp1), graph.point(cp2), rawImg,
+                                 pt1Thickness = thickness[cp1], pt2Thickness = thickness[cp2]):
+                    #Recursively union each set containing any member overlapping
+                    mergeSet = set([cp1, cp2])
+                    procSet = set(mergeSet)
+                    log.debug( "MERGING INTERSECTIONS" )
+                    while len(procSet) > 0:
+                        mergePt = procSet.pop()
+                        mergeSet.add(mergePt)
+                        for k in mergeDict.get(mergePt, set([])):
+                            if k not in mergeSet:
+                                procSet.add(k)
+                        mergeDict[mergePt] = mergeSet
+
+        alreadyMerged = set([])
+        for rep, mergeSet in mergeDict.items():
+            if rep in alreadyMerged: 
+                continue
+            alreadyMerged.update(mergeSet)
+            log.debug( "Found %s crossPoints to collapse" % (len(mergeSet)) )
+
+            mergePoints = graph.points(list(mergeSet))
+            xList = [pt[0] for pt in mergePoints]
+            yList = [pt[1] for pt in mergePoints]
+            avgPt = ( sum(xList) / len(xList), sum(yList) / len(yList) )
+
+            mergedPts = set([])
+            for edge in kpDict['edges']:
+                head = edge[0]
+                tail = edge[-1]
+                if head in mergeSet and tail in mergeSet: 
+                    #All the points had better overlap one of the endpoints. Otherwise, we'd squash down figure-eight's
+                    doMerge = True
+                    for ePt in edge:
+                        if not pointsOverlap(graph.point(ePt), graph.point(head), rawImg,
+                                             pt1Thickness = thickness[ePt],
+                                             pt2Thickness = thickness[head]) \
+                        and not pointsOverlap(graph.point(ePt), graph.point(tail), rawImg,
+                                              pt1Thickness = thickness[ePt],
+                                              pt2Thickness = thickness[tail]):
+                            doMerge = False
+                    if doMerge:
+                        mergedPts.update(edge)
+            mergeGroups.append( (avgPt, sorted(mergedPts)) )
+
+    if len(mergeGroups) == 0:
+        return graph
+
+    #Point every merged node at its replacement, which is added after the old nodes
+    remap = numpy.arange(numNodes, dtype=numpy.int64)
+    for groupIdx, (avgPt, mergedPts) in enumerate(mergeGroups):
+        remap[mergedPts] = numNodes + groupIdx
+    kept = remap < numNodes
+    newPos = numpy.empty(numNodes + len(mergeGroups), dtype=numpy.int64)
+    newPos[:numNodes][kept] = numpy.arange(kept.sum())
+    newPos[numNodes:] = kept.sum() + numpy.arange(len(mergeGroups))
+
+    #Edges between the points of one group go away with them
+    edgePairs = remap[graph.edgePairs()]
+    edgePairs = newPos[edgePairs[(edgePairs[:, 0] != edgePairs[:, 1]) | (edgePairs[:, 0] < numNodes)]]
+    xs = numpy.concatenate( (graph.xs[kept], [pt[0] for pt, _ in mergeGroups]) )
+    ys = numpy.concatenate( (graph.ys[kept], [pt[1] for pt, _ in mergeGroups]) )
+    newThickness = numpy.concatenate( (thickness[kept],
+                                       [thicknessAtPoint(pt, rawImg, cache = cache) for pt, _ in mergeGroups]) )
+    return SkeletonGraph(xs, ys, newThickness, edgePairs)
+
+def _squareArrayIntersections(graph, rawImg, cache = None):
+    """SkeletonGraph version of _squareIntersections. Uses the trajectory of strokes
+    entering an intersection region to pick a better crossing point for them.
+    Returns the new SkeletonGraph"""
+    thickness = graph.thickness
+    numNodes = len(graph)
+    removed = numpy.zeros(numNodes, dtype=bool)
+    newPoints = {} #<point> : (thickness, set(kid points))
+
+    for kpDict in graph.getKeyPoints():
+        for cp in kpDict['crosspoints']:
+            cpPt = graph.point(cp)
+            cpThickness = thickness[cp]
+            edgeList = [] 
+            for edge in kpDict['edges']:
+                if edge[0] == cp:
+                    edgeList.append(list(edge))
+                elif edge[-1] == cp:
+                    edgeList.append(list(reversed(edge)))
+
+            #Remove points from the edges such that they do not enter the "crossing region"
+            for edge in edgeList:
+                for pt in list(edge):
+                    if len(edge) > 1 and \
+                       pointsOverlap(cpPt, graph.point(pt), rawImg, \
+                                     pt1Thickness = cpThickness, \
+                                     pt2Thickness = 1, checkSeparation = False):
+                        edge.remove(pt)
+                        removed[pt] = True
+                    else:   
+                        break
+
+            #Generate a new intersection point from the edge trajectories
+            kids = set()
+            dirSegments = []
+            for edge in edgeList:
+                kids.add(edge[0])
+                if len(edge) > 1:
+                    edgeHead = graph.point(edge[0])
+                    centerPt = ( (edgeHead[0] + cpPt[0]) / 2.0, (edgeHead[1] + cpPt[1]) / 2.0 )
+                    seg = (centerPt, graph.point(edge[:3][-1]))
+                    dirSegments.append(seg)
+
+            allCrossPointsX = []
+            allCrossPointsY = []
+            for i in range(len(dirSegments)):
+                for j in range(i + 1, len(dirSegments)):
+                    cross = getLinesIntersection(dirSegments[i], dirSegments[j])
+                    if cross is not None:
+                        allCrossPointsX.append(cross[0])
+                        allCrossPointsY.append(cross[1])
+
+            if len(allCrossPointsX) > 0 :
+                allCrossPointsX.sort()
+                allCrossPointsY.sort()
+                medianIdx = len(allCrossPointsY) / 2
+                newCrossPoint = (int(allCrossPointsX[medianIdx]), int(allCrossPointsY[medianIdx]))
+            else:
+                newCrossPoint = cpPt
+
+            #Crossing points that move to the same place keep all of their kids
+            newThick, newKids = newPoints.setdefault(newCrossPoint, (thicknessAtPoint(newCrossPoint, rawImg, cache = cache), set()))
+            newKids.update(graph.points(list(kids)))
+
+    if len(newPoints) == 0 and not removed.any():
+        return graph
+
+    #As _squareIntersections: the new points overwrite any points in their place, then
+    #   each is linked to its kids that are in the graph (which can be itself or another new point)
+    alive = ~removed
+    newPtList = newPoints.keys()
+    overwritten = graph.indicesOf([pt[0] for pt in newPtList], [pt[1] for pt in newPtList])
+    alive[overwritten[overwritten >= 0]] = False
+    newEdges = [] #(point, kid point) links made by the new points
+    for pt in newPtList:
+        for kpt in newPoints[pt][1]:
+            kidIdx = graph.indexOf(kpt)
+            if kpt in newPoints or (kidIdx >= 0 and alive[kidIdx]):
+                newEdges.append( (pt, kpt) )
+            else:
+                log.debug( "WARNING: Tried to insert point dictionary with invalid children" )
+
+    numKept = int(alive.sum())
+    newPos = numpy.zeros(numNodes, dtype=numpy.int64) - 1
+    newPos[alive] = numpy.arange(numKept)
+    ptIdx = dict( (pt, numKept + i) for i, pt in enumerate(newPtList) )
+    def ptIndex(pt):
+        if pt in ptIdx:
+            return ptIdx[pt]
+        return newPos[graph.indexOf(pt)]
+
+    oldPairs = graph.edgePairs()
+    oldPairs = newPos[oldPairs[alive[oldPairs[:, 0]] & alive[oldPairs[:, 1]]]]
+    kidPairs = numpy.array([ (ptIndex(p), ptIndex(k)) for p, k in newEdges ], dtype=numpy.int64).reshape(-1, 2)
+    edgePairs = numpy.concatenate( (oldPairs, kidPairs) )
+
+    xs = numpy.concatenate( (graph.xs[alive], [pt[0] for pt in newPtList]) )
+    ys = numpy.concatenate( (graph.ys[alive], [pt[1] for pt in newPtList]) )
+    newThickness = numpy.concatenate( (thickness[alive], [newPoints[pt][0] for pt in newPtList]) )
+    return SkeletonGraph(xs, ys, newThickness, edgePairs)
+
+def arrayGraphToStrokes(graph, rawImg):
+    """SkeletonGraph version of graphToStrokes. Generates a list of strokes that covers the graph"""
+    keyPointsList = []
+    for kpDict in graph.getKeyPoints():
+        keyPointsList.append( {'crosspoints' : graph.points(list(kpDict['crosspoints'])),
+                               'edges' : [graph.points(edge) for edge in kpDict['edges']],
+                              } )
+    return _keyPointsToStrokes(keyPointsList)
+
 #Stolen from GeomUtils
 def getLinesIntersection(line1, line2):
     "Input: two lines specified as 2-tuples of points. Returns the intersection point of two lines or None."
@@ -1144,16 +1533,19 @@ def filledAndCrossingVals(point, img, valsCache, skipCorners = False):
     return retDict
 
 
-def thinBlobsPoints(pointSet, img, cleanNoise = False, evenIter = True, finalPass = False):
+def thinBlobsPoints(pointSet, img, cleanNoise = False, evenIter = True, finalPass = False, cache = None):
     """Implements a single step of thinning over the whole image. 
+    Neighborhood values are kept in cache (defaults to the module CACHE).
     Returns the number of pixels changed, the total set of all remaining points, and the thinned image"""
     global DEBUGIMG, FILLEDVAL, BGVAL, CACHE
+    if cache is None:
+        cache = CACHE
     minFill = 4
     maxFill = 6
     retPoints = set([])
     numChanged = 0
     cacheTag = 'filledVals%s' % (finalPass) #Whatever gets passed to filledAndCrossingVals
-    filledvalsCache = CACHE.setdefault(cacheTag, {})
+    filledvalsCache = cache.setdefault(cacheTag, {})
     if cleanNoise:
         noise = 1
     else:
@@ -1204,6 +1596,87 @@ def thinBlobsPoints(pointSet, img, cleanNoise = False, evenIter = True, finalPas
 
     return ( numChanged, retPoints, outImg )
 
+#Neighbor (dx, dy) offsets, in the same counterclockwise order as filledAndCrossingVals
+NBOR_OFFSETS = ( (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1), (1, 0) )
+
+def filledAndCrossingArrays(imgArr, skipCorners = False):
+    """Whole-image version of filledAndCrossingVals. Takes in a numpy array
+    of the image and returns a dict of arrays (one value per pixel) {
+        'filled' : number of filled pixels (incl center)
+        'crossing' : number of transitions from white to black (tracing around)
+        'esnwne' : is this a E/S/NW/NE region?
+        'wnsesw' : is this a W/N/SE/SW region?
+        }
+    Neighbors in the first row/column or outside the image count as background,
+    just like the per-pixel version."""
+    global CENTERVAL
+    rows, cols = imgArr.shape
+    center = (imgArr == CENTERVAL)
+    padded = numpy.zeros( (rows + 2, cols + 2), dtype=bool)
+    padded[1:-1, 1:-1] = center
+    padded[1, :] = False #Row 0 and column 0 are never counted as neighbors
+    padded[:, 1] = False
+
+    nbors = numpy.empty( (8, rows, cols), dtype=bool)
+    for idx, (dx, dy) in enumerate(NBOR_OFFSETS):
+        nbors[idx] = padded[1 + dy : 1 + dy + rows, 1 + dx : 1 + dx + cols]
+    ne, n, nw, w, sw, s, se, e = nbors
+
+    filled = nbors.sum(axis=0, dtype=numpy.int16) + 1
+    crossing = numpy.zeros( (rows, cols), dtype=numpy.int16)
+    for i in xrange(8):
+        transition = nbors[i - 1] & ~nbors[i]
+        if skipCorners and i in (0, 2, 4, 6): #don't count if the missing corner doesn't affect connectivity
+            transition &= ~nbors[(i + 1) % 8]
+        crossing += transition
+
+    eEdge = ~ne & ~e & ~se & s
+    sEdge = ~sw & ~s & ~se & w & e
+    nwEdge = ~w & ~n & sw & ne
+    neEdge = ~e & ~n & se & nw
+
+    wEdge = ~nw & ~w & ~sw & n
+    nEdge = ~nw & ~n & ~ne & w & e
+    seEdge = ~s & ~e & ne & sw
+    swEdge = ~s & ~w & se & nw
+
+    filled[~center] = 0
+    crossing[~center] = -1
+    return {'filled' : filled,
+            'crossing' : crossing,
+            'esnwne' : (eEdge | sEdge | nwEdge | neEdge) & center,
+            'wnsesw' : (wEdge | nEdge | seEdge | swEdge) & center,
+           }
+
+def thinBlobsArray(pointMask, imgArr, cleanNoise = False, evenIter = True):
+    """Array version of a single (non-final) thinBlobsPoints step. Instead of a set of
+    points, pointMask is a boolean array marking the pixels still being thinned. Every
+    pixel is evaluated at once against the input image, so the result is the same
+    as the per-point pass.
+    Returns the number of pixels changed, the remaining point mask, and the thinned image array"""
+    global FILLEDVAL
+    minFill = 4
+    maxFill = 6
+    if cleanNoise:
+        noise = 1
+    else:
+        noise = -1
+
+    values = filledAndCrossingArrays(imgArr, skipCorners = False)
+    filled = values['filled']
+    if evenIter:
+        badEdge = values['esnwne']
+    else:
+        badEdge = values['wnsesw']
+
+    shouldRemove = pointMask & ( ( (filled >= minFill) & (filled <= maxFill) \
+                                   & (values['crossing'] == 1) & ~badEdge ) \
+                                 | (filled == noise) )
+    outArr = imgArr.copy()
+    outArr[shouldRemove] = FILLEDVAL
+    retMask = pointMask & ~shouldRemove & (filled > 2) #No need to process otherwise
+    return ( int(shouldRemove.sum()), retMask, outArr )
+
 def cleanContours(pointSet, img):
     global BGVAL, CENTERVAL, FILLEDVAL
 
@@ -1420,6 +1893,13 @@ def adaptiveThreshold(img):
         )
     return img
 
+def saveimg(cv_img, name="", outdir="./temp/", filename=None):
+    """Hand a debug image to DEBUGSINK. Does nothing unless the current
+    request is being debugged. Arguments are the same as ImageUtils.saveimg"""
+    global DEBUG, DEBUGSINK
+    if DEBUG:
+        DEBUGSINK.save(cv_img, name=name, outdir=outdir, filename=filename)
+
 def resizeImage(img, scale = None, targetWidth = None):
     "Take in an image and size it according to scale"
     if scale is None:
@@ -1513,9 +1993,10 @@ def isForeGroundGone(img, mask = None, borderThresh = 0.05):
     if mask is not None:
         cv.And(cv.GetSubRect(mask, activeROI), edges, edges)
     edgeAmount = cv.CountNonZero(edges)
-    cv.PutText(edges, "Edges", (20, edges.rows - 20), cv.InitFont(cv.CV_FONT_HERSHEY_PLAIN, 1, 1), 255)
-    log.debug("Saving Edges")
-    saveimg(edges, name="Edges")
+    if DEBUG:
+        cv.PutText(edges, "Edges", (20, edges.rows - 20), cv.InitFont(cv.CV_FONT_HERSHEY_PLAIN, 1, 1), 255)
+        log.debug("Saving Edges")
+        saveimg(edges, name="Edges")
     log.debug("Edge info left: %d" % (edgeAmount))
     if edgeAmount == 0:
         log.debug("Short circuiting background removal")
@@ -1621,17 +2102,160 @@ def getObviousBackgroundMask(image):
     cv.Erode(obviousBackgroundMask, obviousBackgroundMask, iterations = 5)
     return obviousBackgroundMask
 
-def removeBackground(cv_img):
-    """Take in a color image and convert it to a binary image of just ink"""
-    global BGVAL, ISBLACKBOARD, DEBUG
+class BackgroundModel(object):
+    """Remembers how the background of one camera/board was removed, so that later
+    frames of the same board can skip the foreground-removal search.
+    The model stores the median kernel sizes that the search applied, the
+    resulting background image, and a thumbnail of the gray image to
+    detect lighting drift."""
+    def __init__(self, boardId):
+        self.boardId = boardId
+        self.kernelSizes = None #Median kernel sizes applied, in order
+        self.bgImage = None #numpy array of the converged background
+        self.thumbnail = None #Small copy of the gray image the model was built from
+        self.pyramidLevels = 0 #How many times the image was halved for the search
+
+    def isValidFor(self, gray_img, pyramidLevels = 0):
+        """Returns whether the model can be reused for gray_img: same dimensions and
+        pyramid levels, and no more lighting drift than LIGHTING_DRIFT_THRESH"""
+        global LIGHTING_DRIFT_THRESH
+        if self.kernelSizes is None or self.bgImage is None \
+           or self.bgImage.shape != (gray_img.rows, gray_img.cols) \
+           or self.pyramidLevels != pyramidLevels:
+            return False
+        #Median difference, so that new ink does not count as drift
+        drift = numpy.median(numpy.abs(self.thumbnail - _backgroundThumbnail(gray_img)))
+        log.debug( "Background model %s drift: %s" % (self.boardId, drift) )
+        return drift <= LIGHTING_DRIFT_THRESH
+
+    def update(self, gray_img, kernelSizes, bg_img, pyramidLevels = 0):
+        """Store the result of a full background search on gray_img"""
+        self.kernelSizes = list(kernelSizes)
+        self.pyramidLevels = pyramidLevels
+        self.bgImage = numpy.asarray(bg_img).copy()
+        self.thumbnail = _backgroundThumbnail(gray_img)
+
+    def apply(self, gray_img):
+        """Return the background image for gray_img"""
+        global REUSE_BACKGROUND_IMAGE
+        if REUSE_BACKGROUND_IMAGE:
+            return cv.fromarray(self.bgImage.copy())
+        bg_img = pyramidDown(gray_img, self.pyramidLevels)
+        for ksize in self.kernelSizes:
+            bg_img = smooth(bg_img, ksize=ksize, t='median')
+        return resizeToMatch(bg_img, gray_img.rows, gray_img.cols)
+
+    def save(self, filename):
+        """Write the model to filename"""
+        fp = open(filename, "wb")
+        try:
+            pickle.dump( {'boardId' : self.boardId,
+                          'kernelSizes' : self.kernelSizes,
+                          'bgImage' : self.bgImage,
+                          'thumbnail' : self.thumbnail,
+                          'pyramidLevels' : self.pyramidLevels}, fp, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fp.close()
+
+    @classmethod
+    def load(cls, filename):
+        """Read a model written by save()"""
+        fp = open(filename, "rb")
+        try:
+            modelDict = pickle.load(fp)
+        finally:
+            fp.close()
+        model = cls(modelDict['boardId'])
+        model.kernelSizes = modelDict['kernelSizes']
+        model.bgImage = modelDict['bgImage']
+        model.thumbnail = modelDict['thumbnail']
+        model.pyramidLevels = modelDict.get('pyramidLevels', 0)
+        return model
+
+def _backgroundThumbnail(gray_img, width = 32):
+    """Return a small float array of gray_img used to compare lighting between frames"""
+    height = max(1, int(gray_img.rows * width / float(gray_img.cols)))
+    thumb = cv.CreateMat(height, width, cv.CV_8UC1)
+    cv.Resize(gray_img, thumb, interpolation = cv.CV_INTER_AREA)
+    return numpy.asarray(thumb).astype(numpy.float32)
+
+def _backgroundModelFile(boardId):
+    global BACKGROUND_MODEL_DIR
+    return os.path.join(BACKGROUND_MODEL_DIR, "%s.bgmodel" % (boardId))
+
+def getBackgroundModel(boardId):
+    """Return the BackgroundModel for boardId, from memory, from BACKGROUND_MODEL_DIR,
+    or newly created"""
+    global BACKGROUND_MODELS, BACKGROUND_MODEL_DIR
+    model = BACKGROUND_MODELS.get(boardId, None)
+    if model is None:
+        if BACKGROUND_MODEL_DIR is not None and os.path.exists(_backgroundModelFile(boardId)):
+            try:
+                model = BackgroundModel.load(_backgroundModelFile(boardId))
+            except Exception as e:
+                log.warn( "Could not load background model %s: %s" % (boardId, e) )
+        if model is None:
+            model = BackgroundModel(boardId)
+        BACKGROUND_MODELS[boardId] = model
+    return model
+
+def _searchBackground(gray_img):
+    """Grow a median kernel over gray_img until isForeGroundGone says the ink
+    has been smoothed away. Returns the background image and the list of
+    kernel sizes applied."""
+    global DEBUG
     #Values computed relative to image resolution 
-#    denoise_k = 5 / 1000.0 #Used to smooth out noise
-    width = cv_img.cols
     smooth_k  = 3 / 100.0 #Initial smoothing kernel to remove background
-    smooth_k = max (1, int(smooth_k * width))
+    smooth_k = max (1, int(smooth_k * gray_img.cols))
     if smooth_k % 2 == 0:
         smooth_k += 1
 
+    log.debug( "Remove foreground" )
+    smoothScale = 1.15 #How fast do we grow the smoothing kernel
+    bg_img = gray_img
+    kernelSizes = []
+    i = 0
+    while not isForeGroundGone(bg_img) \
+            and smooth_k < gray_img.rows / 2.0:
+        i+= 1
+        bg_img = smooth(bg_img, ksize=smooth_k, t='median')
+        kernelSizes.append(smooth_k)
+        smooth_k = int(smooth_k * smoothScale)
+        if smooth_k % 2 == 0:
+            smooth_k += 1
+        if DEBUG :
+            log.debug( "Background Image:" )
+            saveimg(bg_img, name="SmoothedForeground{}".format(i))
+    log.debug( "Remove foreground -- Done" )
+    return bg_img, kernelSizes
+
+def pyramidDown(img, levels):
+    """Halve the size of img levels times (Gaussian pyramid)"""
+    for _ in xrange(levels):
+        small_img = cv.CreateMat( (img.rows + 1) / 2, (img.cols + 1) / 2, img.type)
+        cv.PyrDown(img, small_img)
+        img = small_img
+    return img
+
+def resizeToMatch(img, rows, cols):
+    """Return a copy of img bilinearly resized to rows x cols"""
+    if img.rows == rows and img.cols == cols:
+        return img
+    retImg = cv.CreateMat(rows, cols, img.type)
+    cv.Resize(img, retImg, interpolation = cv.CV_INTER_LINEAR)
+    return retImg
+
+def removeBackground(cv_img, boardId = None, pyramidLevels = None):
+    """Take in a color image and convert it to a binary image of just ink.
+    If boardId is given, the background found for earlier frames of that board
+    is reused as long as the lighting has not drifted (see BackgroundModel).
+    pyramidLevels (defaults to BG_PYRAMID_LEVELS) is how many times the image is
+    halved before searching for the background, which is then scaled back up.
+    Large median kernels are much cheaper at the smaller size."""
+    global BGVAL, ISBLACKBOARD, DEBUG, BACKGROUND_MODEL_DIR, BG_PYRAMID_LEVELS
+    if pyramidLevels is None:
+        pyramidLevels = BG_PYRAMID_LEVELS
+
     ink_thresh = 90 #Hardcoded value to distinguish between ink and background
 
 #    denoise_k = max (1, int(denoise_k * width))
@@ -1651,21 +2275,19 @@ def removeBackground(cv_img):
 
 
     #Generate the "background image"
-    log.debug( "Remove foreground" )
-    smoothScale = 1.15 #How fast do we grow the smoothing kernel
-    bg_img = gray_img
-    i = 0
-    while not isForeGroundGone(bg_img) \
-            and smooth_k < cv_img.rows / 2.0:
-        i+= 1
-        bg_img = smooth(bg_img, ksize=smooth_k, t='median')
-        smooth_k = int(smooth_k * smoothScale)
-        if smooth_k % 2 == 0:
-            smooth_k += 1
-        if DEBUG :
-            log.debug( "Background Image:" )
-            saveimg(bg_img, name="SmoothedForeground{}".format(i))
-    log.debug( "Remove foreground -- Done" )
+    model = None
+    if boardId is not None:
+        model = getBackgroundModel(boardId)
+    if model is not None and model.isValidFor(gray_img, pyramidLevels):
+        log.debug( "Reusing background model for %s" % (boardId) )
+        bg_img = model.apply(gray_img)
+    else:
+        bg_img, kernelSizes = _searchBackground(pyramidDown(gray_img, pyramidLevels))
+        bg_img = resizeToMatch(bg_img, gray_img.rows, gray_img.cols)
+        if model is not None:
+            model.update(gray_img, kernelSizes, bg_img, pyramidLevels)
+            if BACKGROUND_MODEL_DIR is not None:
+                model.save(_backgroundModelFile(boardId))
     saveimg(bg_img, name="Foreground_Removed")
 
     #Remove the "background" data from the original image
@@ -1728,13 +2350,58 @@ def floodFill(image, seedPt, thresholds = (0, 255), color=0):
                      flags = cv.CV_FLOODFILL_FIXED_RANGE)
      
 
-def blobsToStrokes(img):
-    "Take in a black and white image of a whiteboard, thin the ink, and convert the points to strokes."
-    global DEBUGIMG, BGVAL, FILLEDVAL
+def blobsToStrokes(img, arrayThinning = None, numProcesses = None, byComponent = None):
+    """Take in a black and white image of a whiteboard, thin the ink, and convert the points to strokes.
+    If arrayThinning is set (defaults to ARRAY_THINNING), the even/odd thinning passes run over
+    the whole image at once with numpy instead of point by point.
+    If numProcesses (defaults to NUM_PROCESSES) is more than 1, the connected ink
+    components are thinned in parallel by a pool of that many processes. Daemonic
+    processes (such as VisionServer workers) can't start a pool, and always thin serially.
+    If byComponent is set (defaults to COMPONENT_BATCHING), each connected ink component
+    is thinned and traced on its own (always with the numpy thinning passes). The thinned
+    points and their thickness are the same as with the whole image, but the strokes can
+    differ, since tracing depends on the order of the points (see ComponentBatchingTester.py)."""
+    global DEBUGIMG, BGVAL, FILLEDVAL, ARRAY_THINNING, NUM_PROCESSES, COMPONENT_BATCHING, NOISE_COMPONENT_SIZE
+    if arrayThinning is None:
+        arrayThinning = ARRAY_THINNING
+    if numProcesses is None:
+        numProcesses = NUM_PROCESSES
+    if byComponent is None:
+        byComponent = COMPONENT_BATCHING
+    if numProcesses > 1 and multiprocessing.current_process().daemon:
+        log.debug( "Daemonic processes can't start a pool, thinning in this process" )
+        numProcesses = 1
     log.debug( "Thinning blobs:" )
+    FILLEDVAL = 240
+
     rawImg = cv.CloneMat(img)
+    if byComponent:
+        pointSet, img, labels, components = _thinBlobsImageComponents(img, numProcesses,
+                                                                      minSize = NOISE_COMPONENT_SIZE)
+    elif numProcesses > 1:
+        pointSet, img, labels, components = _thinBlobsImageComponents(img, numProcesses)
+    elif arrayThinning:
+        pointSet, img = _thinBlobsImageArray(img)
+    else:
+        pointSet, img = _thinBlobsImagePoints(img)
 
+    #The final pass depends on the order of the points, so it always runs over the whole image
+    log.debug( "" )
+    numChanged, pointSet, img = thinBlobsPoints(pointSet, img, finalPass = True)
 
+    if DEBUG:
+        saveimg(img, name="Ink_Thinned")
+    log.debug( "Tracing strokes" )
+    if byComponent:
+        strokelist = _componentsToStrokes(pointSet, rawImg, labels, components)
+    else:
+        strokelist = pointsToStrokes(pointSet, rawImg)
+    return strokelist
+
+def _thinBlobsImagePoints(img):
+    """Run the even/odd thinning passes point by point until nothing changes.
+    Returns the set of remaining points and the thinned image."""
+    global BGVAL
     t1 = time.time()
     pointSet = set()
     x = 1
@@ -1754,11 +2421,6 @@ def blobsToStrokes(img):
     changed1 = True
     changed2 = True
     evenIter = True 
-    FILLEDVAL = 240
-    psetSize = None
-    isHollowed = False
-
-    chartFile = open("pointsData.txt", "w")
 
     while changed1 or changed2:
         passnum += 1
@@ -1769,8 +2431,6 @@ def blobsToStrokes(img):
         t1 = time.time()
 
         numChanged, pointSet, img = thinBlobsPoints(pointSet, img, cleanNoise = (passnum <= 2), evenIter = evenIter)
-        if psetSize == None:
-            psetSize = len(pointSet)
 
         t2 = time.time()
         log.debug( "Num changes = %s in %s ms" % (numChanged, (t2-t1) * 1000 ) )
@@ -1778,16 +2438,194 @@ def blobsToStrokes(img):
             changed1 = numChanged > 0
         else:
             changed2 = numChanged > 0
+    return pointSet, img
+
+def _thinBlobsImageArray(img):
+    """Run the even/odd thinning passes over the whole image with numpy until nothing
+    changes. Produces the same points and image as _thinBlobsImagePoints."""
+    imgArr = numpy.asarray(img).copy()
+    pointMask, imgArr = _thinBlobsArrayPasses(imgArr)
+    ys, xs = numpy.nonzero(pointMask)
+    pointSet = set(zip(xs.tolist(), ys.tolist()))
+    return pointSet, cv.fromarray(imgArr)
+
+def _thinBlobsArrayPasses(imgArr, saveDebug = True):
+    """Thin the image array with even/odd thinBlobsArray passes until nothing changes.
+    Returns the mask of the remaining points and the thinned image array"""
+    global BGVAL
+    pointMask = (imgArr != BGVAL)
+    pointMask[0, :] = False #Candidate points skip the first row/column
+    pointMask[:, 0] = False
 
-    log.debug( "" )
-    numChanged, pointSet, img = thinBlobsPoints(pointSet, img, finalPass = True)
+    passnum = 0
+    changed1 = True
+    changed2 = True
+    while changed1 or changed2:
+        passnum += 1
+        log.debug( "Pass %s" % (passnum) )
+        if DEBUG and saveDebug:
+            saveimg(cv.fromarray(imgArr), name="Thinning_Pass_{}".format(passnum))
+        evenIter = (passnum %2 == 0)
+        t1 = time.time()
 
-    chartFile.close()
+        numChanged, pointMask, imgArr = thinBlobsArray(pointMask, imgArr, cleanNoise = (passnum <= 2), evenIter = evenIter)
 
-    if DEBUG:
-        saveimg(img, name="Ink_Thinned")
-    log.debug( "Tracing strokes" )
-    strokelist = pointsToStrokes(pointSet, rawImg)
+        t2 = time.time()
+        log.debug( "Num changes = %s in %s ms" % (numChanged, (t2-t1) * 1000 ) )
+        if passnum % 2 == 0:
+            changed1 = numChanged > 0
+        else:
+            changed2 = numChanged > 0
+    return pointMask, imgArr
+
+def labelInkComponents(inkMask):
+    """Label the 8-connected components of a boolean image. Each pixel in inkMask
+    gets the flat index of the first pixel of its component, all others get -1.
+    Uses whole-image min-label propagation with pointer jumping."""
+    rows, cols = inkMask.shape
+    numPixels = rows * cols
+    flatMask = inkMask.ravel()
+    labels = numpy.where(inkMask, numpy.arange(numPixels).reshape(rows, cols), numPixels)
+    padded = numpy.empty( (rows + 2, cols + 2), dtype=labels.dtype)
+    padded.fill(numPixels)
+    while True:
+        padded[1:-1, 1:-1] = labels
+        nborMin = labels.copy()
+        for dx, dy in NBOR_OFFSETS:
+            numpy.minimum(nborMin, padded[1 + dy : 1 + dy + rows, 1 + dx : 1 + dx + cols], nborMin)
+        newLabels = numpy.where(inkMask, nborMin, numPixels).ravel()
+        #Hook each component root to the smallest label seen, then jump to the roots
+        numpy.minimum.at(newLabels, labels.ravel()[flatMask], newLabels[flatMask])
+        while True:
+            jumped = newLabels[newLabels[flatMask]]
+            if numpy.array_equal(jumped, newLabels[flatMask]):
+                break
+            newLabels[flatMask] = jumped
+        newLabels = newLabels.reshape(rows, cols)
+        if numpy.array_equal(newLabels, labels):
+            break
+        labels = newLabels
+    return numpy.where(inkMask, labels, -1)
+
+def getInkComponents(imgArr):
+    """Find the connected ink components of an image array.
+    Returns the label array (see labelInkComponents) and a list of component dicts
+    {'label', 'left', 'top', 'right', 'bottom', 'size'} (bounds inclusive), largest first"""
+    global BGVAL
+    labels = labelInkComponents(imgArr != BGVAL)
+    cols = imgArr.shape[1]
+    flatLabels = labels.ravel()
+    pixels = numpy.flatnonzero(flatLabels >= 0)
+    if len(pixels) == 0:
+        return labels, []
+    pixels = pixels[numpy.argsort(flatLabels[pixels], kind='mergesort')]
+    sortedLabels = flatLabels[pixels]
+    starts = numpy.flatnonzero(numpy.concatenate( ([True], sortedLabels[1:] != sortedLabels[:-1]) ))
+    xs = pixels % cols
+    ys = pixels // cols
+    sizes = numpy.diff(numpy.concatenate( (starts, [len(pixels)]) ))
+    components = []
+    for label, left, top, right, bottom, size in zip(sortedLabels[starts].tolist(),
+                                               numpy.minimum.reduceat(xs, starts).tolist(),
+                                               numpy.minimum.reduceat(ys, starts).tolist(),
+                                               numpy.maximum.reduceat(xs, starts).tolist(),
+                                               numpy.maximum.reduceat(ys, starts).tolist(),
+                                               sizes.tolist()):
+        components.append( {'label' : label, 'left' : left, 'top' : top,
+                            'right' : right, 'bottom' : bottom, 'size' : size} )
+    components.sort(key = lambda comp: -comp['size'])
+    return labels, components
+
+def _componentSlices(component, imgShape, margin = 1):
+    """Return the (rows, cols) slices of a component's bounding box, grown by margin"""
+    rows, cols = imgShape
+    return ( slice(max(0, component['top'] - margin), min(rows, component['bottom'] + margin + 1)),
+             slice(max(0, component['left'] - margin), min(cols, component['right'] + margin + 1)) )
+
+def _thinComponentWorker(subArr):
+    """Pool worker: run the even/odd thinning passes over one component's sub-image.
+    Returns the remaining point mask and the thinned sub-image"""
+    return _thinBlobsArrayPasses(subArr, saveDebug = False)
+
+def _componentTasks(imgArr, minSize = 0):
+    """Label the ink components of imgArr and cut out a sub-image for each one
+    with more than minSize pixels. Other ink in the sub-image is cleared.
+    Returns the label array, the component dicts, and the list of sub-images"""
+    global BGVAL
+    t1 = time.time()
+    labels, components = getInkComponents(imgArr)
+    log.debug( "Found %s ink components in %s ms" % (len(components), 1000 * (time.time() - t1)) )
+    components = [comp for comp in components if comp['size'] > minSize]
+    tasks = []
+    for comp in components:
+        rows, cols = _componentSlices(comp, imgArr.shape)
+        subArr = imgArr[rows, cols].copy()
+        subArr[labels[rows, cols] != comp['label']] = BGVAL
+        tasks.append(subArr)
+    return labels, components, tasks
+
+def _getPool(numProcesses):
+    """Return the module pool of numProcesses processes. It is started the first time
+    it is needed, and restarted only if numProcesses changes."""
+    global POOL, POOL_SIZE
+    if POOL is not None and POOL_SIZE != numProcesses:
+        POOL.close()
+        POOL.join()
+        POOL = None
+    if POOL is None:
+        POOL = multiprocessing.Pool(numProcesses)
+        POOL_SIZE = numProcesses
+    return POOL
+
+def _thinComponents(tasks, numProcesses):
+    """Run _thinComponentWorker over every component sub-image, in the module
+    pool of numProcesses processes if more than one."""
+    t1 = time.time()
+    if numProcesses > 1:
+        results = _getPool(numProcesses).map(_thinComponentWorker, tasks,
+                               chunksize = max(1, len(tasks) / (4 * numProcesses)))
+    else:
+        results = map(_thinComponentWorker, tasks)
+    log.debug( "Thinned %s components in %s ms" % (len(tasks), 1000 * (time.time() - t1)) )
+    return results
+
+def _thinBlobsImageComponents(img, numProcesses, minSize = 0):
+    """Run the even/odd thinning passes over each connected ink component in its own
+    sub-image, in a pool of numProcesses processes if more than one. Components are not
+    8-adjacent to each other, so they thin independently and their skeletons are pasted
+    straight back into the whole image. Components with minSize pixels or fewer are left
+    out: thinning never leaves any of their points.
+    Produces the same points as _thinBlobsImageArray, and returns them with the thinned
+    image, the label array and the component dicts (see getInkComponents)."""
+    imgArr = numpy.asarray(img).copy()
+    labels, components, tasks = _componentTasks(imgArr, minSize = minSize)
+    results = _thinComponents(tasks, numProcesses)
+
+    allPointMask = numpy.zeros(imgArr.shape, dtype=bool)
+    for comp, (pointMask, subArr) in zip(components, results):
+        rows, cols = _componentSlices(comp, imgArr.shape)
+        compMask = labels[rows, cols] == comp['label']
+        imgArr[rows, cols][compMask] = subArr[compMask]
+        allPointMask[rows, cols] |= pointMask & compMask
+    #Build the set in the same order as _thinBlobsImageArray, for the final pass
+    ys, xs = numpy.nonzero(allPointMask)
+    pointSet = set(zip(xs.tolist(), ys.tolist()))
+    return pointSet, cv.fromarray(imgArr), labels, components
+
+def _componentsToStrokes(pointSet, rawImg, labels, components):
+    """Trace the thinned points of each connected ink component on its own, with its own
+    thickness cache, so the graph work scales with the size of each component rather
+    than the whole image. Thickness is still measured in the whole raw image.
+    Returns the list of strokes."""
+    t1 = time.time()
+    compPoints = {} #label : set of points
+    for pt in pointSet:
+        compPoints.setdefault(labels[pt[1], pt[0]], set()).add(pt)
+    strokelist = []
+    for comp in components:
+        if comp['label'] in compPoints:
+            strokelist.extend(pointsToStrokes(compPoints[comp['label']], rawImg, cache = {}))
+    log.debug( "Traced %s components in %s ms" % (len(components), 1000 * (time.time() - t1)) )
     return strokelist
 
 
@@ -1833,8 +2671,9 @@ def pointDist(p1, p2):
 
 
 def main(args):
-    global SQUARE_ERROR, PRUNING_ERROR, DEBUG
+    global SQUARE_ERROR, PRUNING_ERROR, DEBUG, DEBUGSINK
     DEBUG = True
+    DEBUGSINK = DebugSink.ImageSink()
 
     if len (args) < 2:
         print( "Usage: %s <image_file>" % (args[0]))
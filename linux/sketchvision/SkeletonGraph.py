@@ -0,0 +1,238 @@
+"""
+filename: SkeletonGraph.py
+
+Description:
+A compact, array-backed graph of thinned ink pixels. This replaces the
+{(x,y): {'kids': set(), 'thickness': float}} dictionaries built by
+ImageStrokeConverter.pointsToGraph for large images, where the dict and set
+overhead per pixel dominates memory and time.
+
+* Node coordinates and thicknesses are stored in parallel numpy arrays.
+* Nodes are kept sorted by coordinate, so a pixel is looked up with a binary search.
+* Adjacency is stored CSR-style: the kids of node i are
+  indices[indptr[i]:indptr[i+1]].
+
+Graphs are immutable. The passes that change the graph build a new one
+with SkeletonGraph(...), which merges duplicate points and their edges.
+fromGraphDict/toGraphDict convert to and from the dictionary form so the
+results of both implementations can be compared.
+"""
+import numpy
+
+#Offset used to pack (possibly negative) coordinates into a sortable key
+_KEYOFFSET = 2 ** 31
+
+
+def _pointKeys(xs, ys):
+    """Pack coordinate arrays into one int64 key per point, ordered by (y, x)"""
+    xs = numpy.asarray(xs, dtype=numpy.int64)
+    ys = numpy.asarray(ys, dtype=numpy.int64)
+    return ((ys + _KEYOFFSET) << 32) + (xs + _KEYOFFSET)
+
+
+class SkeletonGraph(object):
+    """Undirected graph over pixel coordinates.
+    xs, ys: integer coordinates of each node
+    thickness: the ink thickness at each node
+    edgePairs: (k, 2) array-like of node index pairs.
+    Duplicate points are merged: the last thickness wins and edges are combined.
+    Duplicate edges are dropped. A self loop makes a node its own kid, as a point
+    can be in its own 'kids' set in the dictionary graphs."""
+    def __init__(self, xs, ys, thickness, edgePairs = None):
+        xs = numpy.asarray(xs, dtype=numpy.int32).ravel()
+        ys = numpy.asarray(ys, dtype=numpy.int32).ravel()
+        thickness = numpy.asarray(thickness, dtype=numpy.float32).ravel()
+        assert len(xs) == len(ys) == len(thickness), "Mismatched node arrays"
+        if edgePairs is None or len(edgePairs) == 0:
+            edgePairs = numpy.zeros( (0, 2), dtype=numpy.int64)
+        edgePairs = numpy.asarray(edgePairs, dtype=numpy.int64).reshape(-1, 2)
+
+        #Sort the nodes by coordinate, and merge duplicates into the last occurrence
+        keys = _pointKeys(xs, ys)
+        order = numpy.argsort(keys, kind='mergesort')
+        sortedKeys = keys[order]
+        isFirst = numpy.ones(len(order), dtype=bool)
+        isFirst[1:] = sortedKeys[1:] != sortedKeys[:-1]
+        isLast = numpy.ones(len(order), dtype=bool)
+        isLast[:-1] = isFirst[1:]
+        newIdx = numpy.empty(len(order), dtype=numpy.int64)
+        newIdx[order] = numpy.cumsum(isFirst) - 1
+        rep = order[isLast]
+
+        self.xs = xs[rep]
+        self.ys = ys[rep]
+        self.thickness = thickness[rep]
+        self._keys = sortedKeys[isLast]
+
+        #Build the symmetric CSR adjacency
+        numNodes = len(rep)
+        src = newIdx[edgePairs[:, 0]]
+        dst = newIdx[edgePairs[:, 1]]
+        allSrc = numpy.concatenate( (src, dst) )
+        allDst = numpy.concatenate( (dst, src) )
+        edgeKeys = numpy.unique(allSrc * max(numNodes, 1) + allDst)
+        allSrc = edgeKeys // max(numNodes, 1)
+        self.indices = (edgeKeys % max(numNodes, 1)).astype(numpy.int32)
+        self.indptr = numpy.zeros(numNodes + 1, dtype=numpy.int64)
+        numpy.cumsum(numpy.bincount(allSrc, minlength=numNodes), out=self.indptr[1:])
+
+    @classmethod
+    def fromGraphDict(cls, graphDict):
+        """Build a SkeletonGraph from {<point> : {'kids' : set(kidpts), 'thickness' : float} }"""
+        points = list(graphDict.keys())
+        ptIdx = dict( (pt, i) for i, pt in enumerate(points) )
+        xs = [pt[0] for pt in points]
+        ys = [pt[1] for pt in points]
+        thickness = [graphDict[pt]['thickness'] for pt in points]
+        edgePairs = [ (ptIdx[pt], ptIdx[k]) for pt in points
+                                            for k in graphDict[pt]['kids'] if k in ptIdx ]
+        return cls(xs, ys, thickness, edgePairs)
+
+    def toGraphDict(self):
+        """Convert back to {<point> : {'kids' : set(kidpts), 'thickness' : float} }"""
+        points = self.points()
+        retDict = {}
+        for i, pt in enumerate(points):
+            kids = set(points[k] for k in self.kids(i))
+            retDict[pt] = {'kids': kids, 'thickness': float(self.thickness[i])}
+        return retDict
+
+    def __len__(self):
+        return len(self.xs)
+
+    def point(self, idx):
+        """Return the (x, y) tuple for node idx"""
+        return (int(self.xs[idx]), int(self.ys[idx]))
+
+    def points(self, idxList = None):
+        """Return a list of (x, y) tuples for the nodes in idxList (default all)"""
+        if idxList is None:
+            return zip(self.xs.tolist(), self.ys.tolist())
+        idxList = numpy.asarray(idxList, dtype=numpy.int64)
+        return zip(self.xs[idxList].tolist(), self.ys[idxList].tolist())
+
+    def indexOf(self, pt):
+        """Return the node index of point pt, or -1 if it is not in the graph"""
+        return int(self.indicesOf([pt[0]], [pt[1]])[0])
+
+    def indicesOf(self, xs, ys):
+        """Vectorized indexOf. Returns an array with -1 for points not in the graph"""
+        keys = _pointKeys(xs, ys)
+        if len(self._keys) == 0:
+            return numpy.zeros(len(keys), dtype=numpy.int64) - 1
+        pos = numpy.searchsorted(self._keys, keys)
+        pos = numpy.minimum(pos, len(self._keys) - 1)
+        return numpy.where(self._keys[pos] == keys, pos, -1)
+
+    def kids(self, idx):
+        """Array of the node indices adjacent to node idx"""
+        return self.indices[self.indptr[idx]:self.indptr[idx + 1]]
+
+    def degrees(self):
+        """Array of the number of kids of each node"""
+        return numpy.diff(self.indptr)
+
+    def edgePairs(self):
+        """(k, 2) array of each undirected edge once, as (lower, higher) node index.
+        A self loop is (i, i)"""
+        src = numpy.repeat(numpy.arange(len(self), dtype=numpy.int64), self.degrees())
+        dst = self.indices.astype(numpy.int64)
+        keep = src <= dst
+        return numpy.column_stack( (src[keep], dst[keep]) )
+
+    def componentLabels(self):
+        """Label each node with the smallest node index in its connected component"""
+        numNodes = len(self)
+        labels = numpy.arange(numNodes, dtype=numpy.int64)
+        if numNodes == 0:
+            return labels
+        degrees = self.degrees()
+        hasKids = degrees > 0
+        starts = self.indptr[:-1][hasKids]
+        while True:
+            newLabels = labels.copy()
+            if len(self.indices) > 0:
+                nborMin = numpy.minimum.reduceat(labels[self.indices], starts)
+                newLabels[hasKids] = numpy.minimum(labels[hasKids], nborMin)
+            #Hook each label's root to the smallest label seen, then jump pointers to the roots
+            numpy.minimum.at(newLabels, labels, newLabels)
+            while True:
+                jumped = newLabels[newLabels]
+                if numpy.array_equal(jumped, newLabels):
+                    break
+                newLabels = jumped
+            if numpy.array_equal(newLabels, labels):
+                return labels
+            labels = newLabels
+
+    def getKeyPoints(self):
+        """Index-based equivalent of ImageStrokeConverter.getKeyPoints. Returns a list
+        of keypoint dictionaries, one per blob, {'seed', 'endpoints', 'crosspoints', 'edges'}
+        where all points are node indices and edges are lists of node indices."""
+        retList = []
+        numNodes = len(self)
+        if numNodes == 0:
+            return retList
+        degrees = self.degrees()
+        labels = self.componentLabels()
+        order = numpy.argsort(labels, kind='mergesort')
+        sortedLabels = labels[order]
+        bounds = numpy.flatnonzero(numpy.diff(sortedLabels)) + 1
+        isKeyPt = degrees != 2
+        for members in numpy.split(order, bounds):
+            memberDegrees = degrees[members]
+            kpDict = {'seed' : int(members[0]),
+                      'endpoints' : set(members[memberDegrees <= 1].tolist()),
+                      'crosspoints' : set(members[memberDegrees > 2].tolist()),
+                     }
+            kpDict['edges'] = self._getBlobEdges(kpDict, isKeyPt)
+            retList.append(kpDict)
+        return retList
+
+    def _getBlobEdges(self, kpDict, isKeyPt):
+        """Walk one blob, linking consecutive points into edges that start and
+        end at keypoints. Mirrors ImageStrokeConverter._getGraphEdges."""
+        indptr = self.indptr
+        indices = self.indices
+        seedPoint = kpDict['seed']
+        edges = []
+
+        #Special case of single point stroke
+        if indptr[seedPoint + 1] == indptr[seedPoint]:
+            edges.append([seedPoint])
+            return edges
+
+        allKeyPts = kpDict['endpoints'] | kpDict['crosspoints']
+        if len(allKeyPts) == 0:
+            #A cycle: just start the edge at the seed
+            allKeyPts = set([seedPoint])
+            isKeyPt = isKeyPt.copy()
+            isKeyPt[seedPoint] = True
+
+        procStack = [ (min(allKeyPts), None, None) ]
+        seen = set([])
+        while len(procStack) > 0:
+            pt, par, curEdge = procStack.pop()
+
+            if pt in seen and not isKeyPt[pt]:
+                continue
+
+            #Keypoint is starting an edge
+            if par is None:
+                seen.add(pt)
+                for k in indices[indptr[pt]:indptr[pt + 1]].tolist():
+                    if k not in seen:
+                        procStack.append( (k, pt, [pt]) )
+            #All other keypoints should end an edge and might start a new one
+            elif isKeyPt[pt]:
+                curEdge.append(pt)
+                edges.append(curEdge)
+                procStack.append( (pt, None, None) )
+            #Otherwise just add it to the current edge and move down the line
+            else:
+                seen.add(pt)
+                curEdge.append(pt)
+                for k in indices[indptr[pt]:indptr[pt + 1]].tolist():
+                    if k != par:
+                        procStack.append( (k, pt, curEdge) )
+        return edges